@@ -52,6 +52,7 @@ from electrum_lbtc import Transaction, mnemonic
 from electrum_lbtc import util, bitcoin, commands, coinchooser
 from electrum_lbtc import SimpleConfig, paymentrequest
 from electrum_lbtc.wallet import Wallet, Multisig_Wallet
+from electrum_lbtc.history_export import export_history
 try:
     from electrum_lbtc.plot import plot_history
 except:
@@ -2048,7 +2049,11 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         # else if the user scanned an offline signed tx
         # transactions are binary, but qrcode seems to return utf8...
         data = data.decode('utf8')
-        z = bitcoin.base_decode(data, length=None, base=43)
+        try:
+            z = bitcoin.base_decode(data, length=None, base=43)
+        except ValueError:
+            self.show_critical(_("Electrum was unable to parse your transaction"))
+            return
         data = ''.join(chr(ord(b)) for b in z).encode('hex')
         tx = self.tx_from_text(data)
         if not tx:
@@ -2221,16 +2226,20 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         self.update()
         if not d.exec_():
             return
-        filename = filename_e.text()
+        filename = unicode(filename_e.text())
         if not filename:
             return
-        try:
-            self.do_export_history(self.wallet, filename, csv_button.isChecked())
-        except (IOError, os.error), reason:
+        is_csv = csv_button.isChecked()
+
+        def on_success(n):
+            self.show_message(_("Your wallet history has been successfully exported."))
+
+        def on_error(exc_info):
             export_error_label = _("Electrum was unable to produce a transaction export.")
-            self.show_critical(export_error_label + "\n" + str(reason), title=_("Unable to export history"))
-            return
-        self.show_message(_("Your wallet history has been successfully exported."))
+            self.show_critical(export_error_label + "\n" + str(exc_info[1]), title=_("Unable to export history"))
+
+        task = partial(self.do_export_history, self.wallet, filename, is_csv)
+        WaitingDialog(self, _('Exporting history...'), task, on_success, on_error)
 
     def plot_history_dialog(self):
         if plot_history is None:
@@ -2242,43 +2251,10 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
             plt.show()
 
     def do_export_history(self, wallet, fileName, is_csv):
-        history = wallet.get_history()
-        lines = []
-        for item in history:
-            tx_hash, height, confirmations, timestamp, value, balance = item
-            if height>0:
-                if timestamp is not None:
-                    time_string = format_time(timestamp)
-                else:
-                    time_string = _("unverified")
-            else:
-                time_string = _("unconfirmed")
-
-            if value is not None:
-                value_string = format_satoshis(value, True)
-            else:
-                value_string = '--'
-
-            if tx_hash:
-                label = wallet.get_label(tx_hash)
-                label = label.encode('utf-8')
-            else:
-                label = ""
-
-            if is_csv:
-                lines.append([tx_hash, label, confirmations, value_string, time_string])
-            else:
-                lines.append({'txid':tx_hash, 'date':"%16s"%time_string, 'label':label, 'value':value_string})
-
+        # non-GUI thread
+        fx = self.fx if self.fx and self.fx.show_history() else None
         with open(fileName, "w+") as f:
-            if is_csv:
-                transaction = csv.writer(f, lineterminator='\n')
-                transaction.writerow(["transaction_hash","label", "confirmations", "value", "timestamp"])
-                for line in lines:
-                    transaction.writerow(line)
-            else:
-                import json
-                f.write(json.dumps(lines, indent = 4))
+            return export_history(wallet, f, 'csv' if is_csv else 'json', fx)
 
 
     def sweep_key_dialog(self):
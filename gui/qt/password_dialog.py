@@ -184,6 +184,10 @@ class ChangePasswordDialog(WindowModalDialog):
         vbox.addStretch(1)
         vbox.addLayout(Buttons(CancelButton(self), OK_button))
         self.playout.encrypt_cb.setChecked(is_encrypted or not wallet.has_password())
+        # SQLite wallet files are written incrementally and not encrypted
+        if wallet.storage.db:
+            self.playout.encrypt_cb.setChecked(False)
+            self.playout.encrypt_cb.setVisible(False)
 
     def run(self):
         if not self.exec_():
@@ -1,14 +1,52 @@
-from version import ELECTRUM_VERSION
-from util import format_satoshis, print_msg, print_error, set_verbosity
-from wallet import Synchronizer, Wallet, Imported_Wallet
-from storage import WalletStorage
-from coinchooser import COIN_CHOOSERS
-from network import Network, pick_random_server
-from interface import Connection, Interface
-from simple_config import SimpleConfig, get_config, set_config
-import bitcoin
-import transaction
-import daemon
-from transaction import Transaction
-from plugins import BasePlugin
-from commands import Commands, known_commands
+'''The names exported by the package are imported on first use, so that
+importing one module of the package does not load all the others.'''
+
+import sys
+import types
+import importlib
+
+# name -> module of the package that defines it
+_exports = {
+    'ELECTRUM_VERSION': 'version',
+    'format_satoshis': 'util',
+    'print_msg': 'util',
+    'print_error': 'util',
+    'set_verbosity': 'util',
+    'Synchronizer': 'wallet',
+    'Wallet': 'wallet',
+    'Imported_Wallet': 'wallet',
+    'WalletStorage': 'storage',
+    'COIN_CHOOSERS': 'coinchooser',
+    'Network': 'network',
+    'pick_random_server': 'network',
+    'Connection': 'interface',
+    'Interface': 'interface',
+    'SimpleConfig': 'simple_config',
+    'get_config': 'simple_config',
+    'set_config': 'simple_config',
+    'Transaction': 'transaction',
+    'BasePlugin': 'plugins',
+    'Commands': 'commands',
+    'known_commands': 'commands',
+}
+
+
+class LazyPackage(types.ModuleType):
+
+    def __getattr__(self, name):
+        module = _exports.get(name)
+        if module is None:
+            raise AttributeError("'module' object has no attribute '%s'" % name)
+        value = getattr(importlib.import_module('.' + module, self.__name__), name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_exports))
+
+
+_package = LazyPackage(__name__, __doc__)
+_package.__dict__.update(globals())
+# keep this module alive: its globals are cleared when it is collected
+_package._module = sys.modules[__name__]
+sys.modules[__name__] = _package
@@ -31,10 +31,11 @@ import re
 import hmac
 
 import version
-from util import print_error, InvalidPassword
+from util import print_error, InvalidPassword, LRUCache
 
 import ecdsa
 import pyaes
+import ecc_backend
 
 # Litebitcoin network constants
 TESTNET = False
@@ -62,6 +63,7 @@ def set_testnet():
     XPUB_HEADER = 0x043587cf
     HEADERS_URL = "http://lbtc.info/testnet_headers"
     GENESIS = "4966625a4b2851d9fdee139e56211a0d88575f59ed816ff5e6a63deb4e3e29a0"
+    clear_address_caches()
 
 def set_nolnet():
     global ADDRTYPE_P2PKH, ADDRTYPE_P2SH, ADDRTYPE_P2WPKH
@@ -76,6 +78,7 @@ def set_nolnet():
     XPUB_HEADER = 0x0488b21e
     HEADERS_URL = "https://headers.electrum.org/nolnet_headers"
     GENESIS = "663c88be18d07c45f87f910b93a1a71ed9ef1946cad50eb6a6f3af4c424625c6"
+    clear_address_caches()
 
 
 
@@ -276,16 +279,42 @@ def hash_160(public_key):
     md.update(sha256(public_key))
     return md.digest()
 
+# number of addresses whose conversions are kept in memory
+ADDRESS_CACHE_SIZE = 10000
+
+# address -> (addrtype, hash160)
+_address_to_hash160 = LRUCache(ADDRESS_CACHE_SIZE)
+# (hash160, addrtype, witness program version) -> address
+_hash160_to_address = LRUCache(ADDRESS_CACHE_SIZE)
+# caches that depend on the network, cleared when it is changed
+address_caches = [_address_to_hash160, _hash160_to_address]
+
+def clear_address_caches():
+    for cache in address_caches:
+        cache.clear()
+
 def hash_160_to_bc_address(h160, addrtype, witness_program_version=1):
+    key = (h160, addrtype, witness_program_version)
+    addr = _hash160_to_address.get(key)
+    if addr is not None:
+        return addr
     s = chr(addrtype)
     if addrtype == ADDRTYPE_P2WPKH:
         s += chr(witness_program_version) + chr(0)
     s += h160
-    return base_encode(s+Hash(s)[0:4], base=58)
+    addr = base_encode(s+Hash(s)[0:4], base=58)
+    _hash160_to_address.put(key, addr)
+    if len(s) == 21:
+        _address_to_hash160.put(addr, (addrtype, h160))
+    return addr
 
 def bc_address_to_hash_160(addr):
-    bytes = base_decode(addr, 25, base=58)
-    return ord(bytes[0]), bytes[1:21]
+    r = _address_to_hash160.get(addr)
+    if r is None:
+        bytes = base_decode(addr, 25, base=58)
+        r = ord(bytes[0]), bytes[1:21]
+        _address_to_hash160.put(addr, r)
+    return r
 
 def hash160_to_p2pkh(h160):
     return hash_160_to_bc_address(h160, ADDRTYPE_P2PKH)
@@ -309,49 +338,58 @@ __b43chars = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ$*+-./:'
 assert len(__b43chars) == 43
 
 
-def base_encode(v, base):
-    """ encode v, which is a string of bytes, to base58."""
+def _base_chars(base):
     if base == 58:
-        chars = __b58chars
+        return __b58chars
     elif base == 43:
-        chars = __b43chars
-    long_value = 0L
-    for (i, c) in enumerate(v[::-1]):
-        long_value += (256**i) * ord(c)
-    result = ''
-    while long_value >= base:
-        div, mod = divmod(long_value, base)
-        result = chars[mod] + result
-        long_value = div
-    result = chars[long_value] + result
+        return __b43chars
+    raise BaseException('unsupported base', base)
+
+# number of digits that fit in a machine word: numbers are converted by
+# dividing or multiplying them by base**n, n digits at a time
+__chunk_digits = {58: 10, 43: 11}
+__digit_values = dict((base, dict((c, i) for i, c in enumerate(_base_chars(base)))) for base in (58, 43))
+
+
+def base_encode(v, base):
+    """ encode v, which is a string of bytes, to base58."""
+    chars = _base_chars(base)
+    n = __chunk_digits[base]
+    chunk = base ** n
+    long_value = long(v.encode('hex'), 16) if v else 0
+    digits = []
+    while long_value:
+        long_value, r = divmod(long_value, chunk)
+        r = int(r)
+        for i in xrange(n):
+            r, mod = divmod(r, base)
+            digits.append(chars[mod])
+    while digits and digits[-1] == chars[0]:
+        digits.pop()
+    result = ''.join(reversed(digits)) or chars[0]
     # Bitcoin does a little leading-zero-compression:
     # leading 0-bytes in the input become leading-1s
-    nPad = 0
-    for c in v:
-        if c == '\0': nPad += 1
-        else: break
+    nPad = len(v) - len(v.lstrip('\0'))
     return (chars[0]*nPad) + result
 
 
 def base_decode(v, length, base):
     """ decode v into a string of len bytes."""
-    if base == 58:
-        chars = __b58chars
-    elif base == 43:
-        chars = __b43chars
-    long_value = 0L
-    for (i, c) in enumerate(v[::-1]):
-        long_value += chars.find(c) * (base**i)
-    result = ''
-    while long_value >= 256:
-        div, mod = divmod(long_value, 256)
-        result = chr(mod) + result
-        long_value = div
-    result = chr(long_value) + result
-    nPad = 0
-    for c in v:
-        if c == chars[0]: nPad += 1
-        else: break
+    chars = _base_chars(base)
+    values = __digit_values[base]
+    n = __chunk_digits[base]
+    long_value = 0
+    try:
+        for i in xrange(0, len(v), n):
+            chunk = 0
+            for c in v[i:i+n]:
+                chunk = chunk * base + values[c]
+            long_value = long_value * base ** len(v[i:i+n]) + chunk
+    except KeyError:
+        raise ValueError('invalid base%d string' % base)
+    h = '%x' % long_value
+    result = ('0' * (len(h) & 1) + h).decode('hex')
+    nPad = len(v) - len(v.lstrip(chars[0]))
     result = chr(0)*nPad + result
     if length is not None and len(result) != length:
         return None
@@ -364,7 +402,10 @@ def EncodeBase58Check(vchIn):
 
 
 def DecodeBase58Check(psz):
-    vchRet = base_decode(psz, None, base=58)
+    try:
+        vchRet = base_decode(psz, None, base=58)
+    except ValueError:
+        return None
     key = vchRet[0:-4]
     csum = vchRet[-4:]
     hash = Hash(key)
@@ -421,8 +462,7 @@ def public_key_from_private_key(sec):
     pkey = regenerate_key(sec)
     assert pkey
     compressed = is_compressed(sec)
-    public_key = GetPubKey(pkey.pubkey, compressed)
-    return public_key.encode('hex')
+    return pkey.get_public_key(compressed)
 
 
 def address_from_private_key(sec):
@@ -479,7 +519,7 @@ def minikey_to_private_key(text):
 
 from ecdsa.ecdsa import curve_secp256k1, generator_secp256k1
 from ecdsa.curves import SECP256k1
-from ecdsa.ellipticcurve import Point
+from ecdsa.ellipticcurve import Point, INFINITY
 from ecdsa.util import string_to_number, number_to_string
 
 def msg_magic(message):
@@ -491,14 +531,14 @@ def msg_magic(message):
 def verify_message(address, sig, message):
     try:
         h = Hash(msg_magic(message))
-        public_key, compressed = pubkey_from_signature(sig, h)
+        pubkey, compressed = recover_pubkey(sig, h)
         # check public key using the address
-        pubkey = point_to_ser(public_key.pubkey.point, compressed)
         addr = public_key_to_p2pkh(pubkey)
         if address != addr:
             raise Exception("Bad signature")
         # check message
-        public_key.verify_digest(sig[1:], h, sigdecode = ecdsa.util.sigdecode_string)
+        if not ecc_backend.get_backend().verify(pubkey, sig[1:], h):
+            raise Exception("Bad signature")
         return True
     except Exception as e:
         print_error("Verification error: {0}".format(e))
@@ -579,7 +619,8 @@ class MyVerifyingKey(ecdsa.VerifyingKey):
         return klass.from_public_point( Q, curve )
 
 
-def pubkey_from_signature(sig, h):
+def parse_message_signature(sig):
+    '''Return recid and compressed flag of a 65-byte message signature'''
     if len(sig) != 65:
         raise Exception("Wrong encoding")
     nV = ord(sig[0])
@@ -591,9 +632,33 @@ def pubkey_from_signature(sig, h):
     else:
         compressed = False
     recid = nV - 27
+    return recid, compressed
+
+
+def pubkey_from_signature(sig, h):
+    recid, compressed = parse_message_signature(sig)
     return MyVerifyingKey.from_signature(sig[1:], recid, h, curve = SECP256k1), compressed
 
 
+def recover_pubkey(sig, h):
+    '''Return the serialized public key of a message signature, and
+    whether it is compressed.'''
+    recid, compressed = parse_message_signature(sig)
+    return ecc_backend.get_backend().recover(sig[1:], recid, h, compressed), compressed
+
+
+def sig_string_to_der(sig):
+    order = generator_secp256k1.order()
+    r, s = ecdsa.util.sigdecode_string(sig, order)
+    return ecdsa.util.sigencode_der(r, s, order)
+
+
+def der_to_sig_string(der):
+    order = generator_secp256k1.order()
+    r, s = ecdsa.util.sigdecode_der(der, order)
+    return ecdsa.util.sigencode_string(r, s, order)
+
+
 class MySigningKey(ecdsa.SigningKey):
     """Enforce low S values in signatures"""
 
@@ -611,18 +676,38 @@ class EC_KEY(object):
 
     def __init__( self, k ):
         secret = string_to_number(k)
-        self.pubkey = ecdsa.ecdsa.Public_key( generator_secp256k1, generator_secp256k1 * secret )
-        self.privkey = ecdsa.ecdsa.Private_key( self.pubkey, secret )
         self.secret = secret
+        self.secret_bytes = ecc_backend.scalar_to_bytes(secret)
+        # compressed -> serialized public key
+        self.public_keys = {}
+        self._pubkey = None
+
+    @property
+    def pubkey(self):
+        # ecdsa public key, for code that works on points
+        if self._pubkey is None:
+            point = ser_to_point(self.get_public_key_bytes(False))
+            self._pubkey = ecdsa.ecdsa.Public_key(generator_secp256k1, point)
+        return self._pubkey
+
+    @property
+    def privkey(self):
+        return ecdsa.ecdsa.Private_key(self.pubkey, self.secret)
+
+    def get_public_key_bytes(self, compressed=True):
+        K = self.public_keys.get(compressed)
+        if K is None:
+            K = ecc_backend.get_backend().pubkey_from_secret(self.secret_bytes, compressed)
+            self.public_keys[compressed] = K
+        return K
 
     def get_public_key(self, compressed=True):
-        return point_to_ser(self.pubkey.point, compressed).encode('hex')
+        return self.get_public_key_bytes(compressed).encode('hex')
 
     def sign(self, msg_hash):
-        private_key = MySigningKey.from_secret_exponent(self.secret, curve = SECP256k1)
-        public_key = private_key.get_verifying_key()
-        signature = private_key.sign_digest_deterministic(msg_hash, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_string)
-        assert public_key.verify_digest(signature, msg_hash, sigdecode = ecdsa.util.sigdecode_string)
+        backend = ecc_backend.get_backend()
+        signature = backend.sign(self.secret_bytes, msg_hash)
+        assert backend.verify(self.get_public_key_bytes(), signature, msg_hash)
         return signature
 
     def sign_message(self, message, is_compressed):
@@ -640,12 +725,13 @@ class EC_KEY(object):
 
     def verify_message(self, sig, message):
         h = Hash(msg_magic(message))
-        public_key, compressed = pubkey_from_signature(sig, h)
+        pubkey, compressed = recover_pubkey(sig, h)
         # check public key
-        if point_to_ser(public_key.pubkey.point, compressed) != point_to_ser(self.pubkey.point, compressed):
+        if pubkey != self.get_public_key_bytes(compressed):
             raise Exception("Bad signature")
         # check message
-        public_key.verify_digest(sig[1:], h, sigdecode = ecdsa.util.sigdecode_string)
+        if not ecc_backend.get_backend().verify(pubkey, sig[1:], h):
+            raise Exception("Bad signature")
 
 
     # ECIES encryption/decryption methods; AES-128-CBC with PKCS7 is used as the cipher; hmac-sha256 is used as the mac
@@ -653,13 +739,10 @@ class EC_KEY(object):
     @classmethod
     def encrypt_message(self, message, pubkey):
 
-        pk = ser_to_point(pubkey)
-        if not ecdsa.ecdsa.point_is_valid(generator_secp256k1, pk.x(), pk.y()):
-            raise Exception('invalid pubkey')
-
         ephemeral_exponent = number_to_string(ecdsa.util.randrange(pow(2,256)), generator_secp256k1.order())
         ephemeral = EC_KEY(ephemeral_exponent)
-        ecdh_key = point_to_ser(pk * ephemeral.privkey.secret_multiplier)
+        # raises if pubkey is invalid
+        ecdh_key = ecc_backend.get_backend().pubkey_tweak_mul(pubkey, ephemeral.secret_bytes)
         key = hashlib.sha512(ecdh_key).digest()
         iv, key_e, key_m = key[0:16], key[16:32], key[32:]
         ciphertext = aes_encrypt_with_iv(key_e, iv, message)
@@ -681,12 +764,9 @@ class EC_KEY(object):
         if magic != 'BIE1':
             raise Exception('invalid ciphertext: invalid magic bytes')
         try:
-            ephemeral_pubkey = ser_to_point(ephemeral_pubkey)
-        except AssertionError, e:
-            raise Exception('invalid ciphertext: invalid ephemeral pubkey')
-        if not ecdsa.ecdsa.point_is_valid(generator_secp256k1, ephemeral_pubkey.x(), ephemeral_pubkey.y()):
+            ecdh_key = ecc_backend.get_backend().pubkey_tweak_mul(ephemeral_pubkey, self.secret_bytes)
+        except Exception:
             raise Exception('invalid ciphertext: invalid ephemeral pubkey')
-        ecdh_key = point_to_ser(ephemeral_pubkey * self.privkey.secret_multiplier)
         key = hashlib.sha512(ecdh_key).digest()
         iv, key_e, key_m = key[0:16], key[16:32], key[32:]
         if mac != hmac.new(key_m, encrypted[:-32], hashlib.sha256).digest():
@@ -702,10 +782,8 @@ BIP32_PRIME = 0x80000000
 
 def get_pubkeys_from_secret(secret):
     # public key
-    private_key = ecdsa.SigningKey.from_string( secret, curve = SECP256k1 )
-    public_key = private_key.get_verifying_key()
-    K = public_key.to_string()
-    K_compressed = GetPubKey(public_key.pubkey,True)
+    K = ecc_backend.get_backend().pubkey_from_secret(secret, False)[1:]
+    K_compressed = chr(2 + (ord(K[-1]) & 1)) + K[:32]
     return K, K_compressed
 
 
@@ -723,8 +801,7 @@ def CKD_priv(k, c, n):
 
 def _CKD_priv(k, c, s, is_prime):
     order = generator_secp256k1.order()
-    keypair = EC_KEY(k)
-    cK = GetPubKey(keypair.pubkey,True)
+    cK = ecc_backend.get_backend().pubkey_from_secret(k, True)
     data = chr(0) + k + s if is_prime else cK + s
     I = hmac.new(c, data, hashlib.sha512).digest()
     k_n = number_to_string( (string_to_number(I[0:32]) + string_to_number(k)) % order , order )
@@ -743,15 +820,23 @@ def CKD_pub(cK, c, n):
 
 # helper function, callable with arbitrary string
 def _CKD_pub(cK, c, s):
-    order = generator_secp256k1.order()
     I = hmac.new(c, cK + s, hashlib.sha512).digest()
-    curve = SECP256k1
-    pubkey_point = string_to_number(I[0:32])*curve.generator + ser_to_point(cK)
-    public_key = ecdsa.VerifyingKey.from_public_point( pubkey_point, curve = SECP256k1 )
+    cK_n = ecc_backend.get_backend().pubkey_tweak_add(cK, I[0:32])
     c_n = I[32:]
-    cK_n = GetPubKey(public_key.pubkey,True)
     return cK_n, c_n
 
+# Derive the public keys of several children of the same parent.
+# With the python backend, the parent point is decoded once for the
+# whole sequence.
+def CKD_pub_batch(cK, c, sequence):
+    tweaks = []
+    for n in sequence:
+        if n & BIP32_PRIME: raise
+        s = rev_hex(int_to_hex(n,4)).decode('hex')
+        I = hmac.new(c, cK + s, hashlib.sha512).digest()
+        tweaks.append(I[0:32])
+    return ecc_backend.get_backend().pubkey_tweak_add_many(cK, tweaks)
+
 
 def xprv_header(xtype):
     return ("%08x"%(XPRV_HEADER + xtype)).decode('hex')
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2017 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+'''Outputs of bulk payments, read from csv or JSON lines.
+
+Each line is one payment: "address,amount" in csv, and either
+{"address": ..., "amount": ...} or ["address", amount] in JSON lines.
+Amounts are in LBTC and kept as strings, like the amounts of
+paytomany; "!" spends the maximum.  Lines are parsed as they are read,
+so a file of thousands of payments is never loaded as a whole.
+'''
+
+import csv
+import json
+from decimal import Decimal, InvalidOperation
+
+
+IMPORT_FORMATS = ['csv', 'json']
+
+
+def guess_format(line):
+    return 'json' if line.lstrip()[:1] in ['{', '['] else 'csv'
+
+
+def parse_amount(x):
+    x = x.strip() if isinstance(x, basestring) else x
+    if x == '!':
+        return '!'
+    try:
+        amount = Decimal(x)
+    except (InvalidOperation, TypeError, ValueError):
+        raise BaseException('invalid amount', x)
+    if amount < 0:
+        raise BaseException('invalid amount', x)
+    return str(amount)
+
+
+def _csv_row(line):
+    return next(csv.reader([line]))
+
+
+def _json_row(line):
+    row = json.loads(line, parse_float=lambda x: str(Decimal(x)))
+    if isinstance(row, dict):
+        row = [row.get('address'), row.get('amount')]
+    return row
+
+
+row_parsers = {
+    'csv': _csv_row,
+    'json': _json_row,
+}
+
+
+def parse_row(row):
+    if not isinstance(row, list) or len(row) != 2:
+        raise BaseException('expected an address and an amount')
+    address, amount = row
+    if not isinstance(address, basestring) or not address.strip():
+        raise BaseException('invalid address', address)
+    return address.strip(), parse_amount(amount)
+
+
+def read_outputs(lines, fmt=None):
+    '''Yield (address, amount) for each payment of lines, which can be
+    a file object.  fmt is one of IMPORT_FORMATS, and is guessed from
+    the first line if None.  A csv header (address,amount) is skipped,
+    as are blank lines.'''
+    parse_line = None
+    for n, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            if parse_line is None:
+                fmt = fmt or guess_format(line)
+                if fmt not in row_parsers:
+                    raise BaseException("Unknown import format: %s" % fmt)
+                parse_line = row_parsers[fmt]
+                row = parse_line(line)
+                if fmt == 'csv' and [x.strip().lower() for x in row] == ['address', 'amount']:
+                    continue
+            else:
+                row = parse_line(line)
+            output = parse_row(row)
+        except BaseException as e:
+            raise BaseException('line %d: %s' % (n, e))
+        yield output
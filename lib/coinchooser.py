@@ -23,11 +23,12 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import time
 from collections import defaultdict, namedtuple
 from math import floor, log10
 
 from bitcoin import sha256, COIN, TYPE_ADDRESS
-from transaction import Transaction
+from transaction import Transaction, pack_compact_size
 from util import NotEnoughFunds, PrintError, profiler
 
 # A simple deterministic PRNG.  Used to deterministically shuffle a
@@ -69,7 +70,34 @@ class PRNG:
             x[i], x[j] = x[j], x[i]
 
 
-Bucket = namedtuple('Bucket', ['desc', 'size', 'value', 'coins'])
+# size is the estimated size of the serialized coins, and witness that
+# of their witnesses, which are only serialized if one coin is segwit
+Bucket = namedtuple('Bucket', ['desc', 'size', 'value', 'coins', 'witness', 'segwit'])
+
+
+class SizeModel(object):
+    '''The size of a transaction, as Transaction.estimated_size() finds
+    it, summed from the sizes of its parts: the outputs, which are sized
+    once, the buckets of coins and the change outputs.  Candidate sets
+    of coins are sized without being serialized.'''
+
+    def __init__(self, tx):
+        outputs = tx.outputs()
+        self.num_outputs = len(outputs)
+        self.outputs_size = sum(len(tx.serialize_output_bytes(o)) for o in outputs)
+
+    def size(self, buckets, change_sizes=[]):
+        num_inputs = sum(len(bucket.coins) for bucket in buckets)
+        # version and locktime
+        size = 8
+        size += len(pack_compact_size(num_inputs)) + sum(bucket.size for bucket in buckets)
+        size += len(pack_compact_size(self.num_outputs + len(change_sizes)))
+        size += self.outputs_size + sum(change_sizes)
+        if any(bucket.segwit for bucket in buckets):
+            # marker, flag, and the witness of each input
+            size += 2 + sum(bucket.witness for bucket in buckets)
+        return size
+
 
 def strip_unneeded(bkts, sufficient_funds):
     '''Remove buckets that are unnecessary in achieving the spend amount'''
@@ -91,11 +119,23 @@ class CoinChooserBase(PrintError):
         for key, coin in zip(keys, coins):
             buckets[key].append(coin)
 
+        # estimated sizes only depend on the kind of script of a coin
+        sizes = {}
+        def coin_size(coin):
+            key = (coin['type'], coin.get('num_sig'), coin.get('redeemScript'), coin.get('scriptSig'))
+            if key not in sizes:
+                sizes[key] = (Transaction.estimated_input_size(coin),
+                              Transaction.estimated_witness_size(coin),
+                              Transaction.is_segwit_input(coin))
+            return sizes[key]
+
         def make_Bucket(desc, coins):
-            size = sum(Transaction.estimated_input_size(coin)
-                       for coin in coins)
+            coin_sizes = map(coin_size, coins)
+            size = sum(x[0] for x in coin_sizes)
             value = sum(coin['value'] for coin in coins)
-            return Bucket(desc, size, value, coins)
+            witness = sum(x[1] for x in coin_sizes)
+            segwit = any(x[2] for x in coin_sizes)
+            return Bucket(desc, size, value, coins, witness, segwit)
 
         return map(make_Bucket, buckets.keys(), buckets.values())
 
@@ -111,9 +151,10 @@ class CoinChooserBase(PrintError):
         max_change = max(max(output_amounts) * 1.25, 0.02 * COIN)
 
         # Use N change outputs
+        fee = tx.get_fee()
         for n in range(1, count + 1):
             # How much is left if we add this many change outputs?
-            change_amount = max(0, tx.get_fee() - fee_estimator(n))
+            change_amount = max(0, fee - fee_estimator(n))
             if change_amount // n <= max_change:
                 break
 
@@ -179,15 +220,19 @@ class CoinChooserBase(PrintError):
 
         # Copy the ouputs so when adding change we don't modify "outputs"
         tx = Transaction.from_io([], outputs[:])
-        # Size of the transaction with no inputs and no change
-        base_size = tx.estimated_size()
+        size_model = SizeModel(tx)
         spent_amount = tx.output_value()
+        # Choosers that look for a precise amount need the costs
+        self.size_model = size_model
+        self.spent_amount = spent_amount
+        self.fee_estimator = fee_estimator
+        self.dust_threshold = dust_threshold
 
         def sufficient_funds(buckets):
             '''Given a list of buckets, return True if it has enough
             value to pay for the transaction'''
             total_input = sum(bucket.value for bucket in buckets)
-            total_size = sum(bucket.size for bucket in buckets) + base_size
+            total_size = size_model.size(buckets)
             return total_input >= spent_amount + fee_estimator(total_size)
 
         # Collect the coins into buckets, choose a subset of the buckets
@@ -196,11 +241,11 @@ class CoinChooserBase(PrintError):
                                       self.penalty_func(tx))
 
         tx.add_inputs([coin for b in buckets for coin in b.coins])
-        tx_size = base_size + sum(bucket.size for bucket in buckets)
+        change_sizes = [len(tx.serialize_output_bytes((TYPE_ADDRESS, addr, 0)))
+                        for addr in change_addrs]
 
-        # This takes a count of change outputs and returns a tx fee;
-        # each pay-to-bitcoin-address output serializes as 34 bytes
-        fee = lambda count: fee_estimator(tx_size + count * 34)
+        # This takes a count of change outputs and returns a tx fee
+        fee = lambda count: fee_estimator(size_model.size(buckets, change_sizes[:count]))
         change = self.change_outputs(tx, change_addrs, fee, dust_threshold)
         tx.add_outputs(change)
 
@@ -306,8 +351,184 @@ class CoinChooserPrivacy(CoinChooserRandom):
         return penalty
 
 
+def branch_and_bound(values, fees, target, window, max_tries, deadline=None):
+    '''Search a subset of values whose sum is between target and
+    target + window.  values are sorted in decreasing order, and are
+    net of fees, the costs of spending them.  Returns the indexes of
+    the subset that wastes the least, by its excess over target and
+    its fees, or None if none is found.  At most max_tries steps are
+    made, and the search stops at deadline, a time.time() value.'''
+    n = len(values)
+    # remaining[i] is the sum of values[i:]: the most that can be added
+    remaining = [0] * (n + 1)
+    for i in xrange(n - 1, -1, -1):
+        remaining[i] = remaining[i + 1] + values[i]
+    if remaining[0] < target:
+        return None
+    best = None
+    best_waste = None
+    selected = []
+    value = 0
+    fee = 0
+    i = 0
+    for tries in xrange(max_tries):
+        # adding values only adds waste
+        waste = value - target + fee
+        if value + remaining[i] < target or value - target > window:
+            backtrack = True
+        elif best is not None and waste >= best_waste:
+            backtrack = True
+        elif value >= target:
+            best = list(selected)
+            best_waste = waste
+            backtrack = True
+        else:
+            backtrack = False
+        if backtrack:
+            # exclude the last value selected, and the equal values
+            # after it: selecting one of them instead gives the same sums
+            if not selected:
+                break
+            j = selected.pop()
+            value -= values[j]
+            fee -= fees[j]
+            i = j + 1
+            while i < n and values[i] == values[j]:
+                i += 1
+        else:
+            selected.append(i)
+            value += values[i]
+            fee += fees[i]
+            i += 1
+        if deadline and tries % 1000 == 0 and time.time() > deadline:
+            break
+    return best
+
+
+def approximate_best_subset(values, target, tries, random_bytes, deadline=None):
+    '''Return the indexes of a subset of values, which are sorted in
+    decreasing order, whose sum is at least target and as small as found
+    in tries random draws.  Each draw includes each value at random, and
+    then the values it left out until target is reached.'''
+    n = len(values)
+    best = range(n)
+    best_value = sum(values)
+    for k in xrange(tries):
+        if best_value == target or (deadline and time.time() > deadline):
+            break
+        bits = random_bytes(n)
+        included = [False] * n
+        total = 0
+        reached = False
+        for npass in range(2):
+            for i in xrange(n):
+                if (bits[i] & 1) if npass == 0 else not included[i]:
+                    total += values[i]
+                    included[i] = True
+                    if total >= target:
+                        reached = True
+                        if total < best_value:
+                            best_value = total
+                            best = [j for j in xrange(n) if included[j]]
+                        total -= values[i]
+                        included[i] = False
+            if reached:
+                break
+    return best
+
+
+class CoinChooserBranchAndBound(CoinChooserBase):
+    '''Avoid change outputs.  Search for a set of coins that pays for the
+    transaction with less than the dust threshold left over, which is
+    then added to the fee instead of creating change.  The search is
+    bounded in steps; if it finds no such set, the coins are chosen to
+    leave as little change as possible.  This suits wallets with many
+    coins.
+    '''
+
+    # budget of the search for an exact amount
+    max_tries = 100000
+    # optional budget in seconds, from the config value
+    # coin_chooser_time_budget.  The selection then depends on the
+    # speed of the machine, and is no longer deterministic.
+    time_budget = None
+    # the random search of the fallback draws from the largest coins
+    knapsack_tries = 1000
+    knapsack_size = 500
+
+    def keys(self, coins):
+        return [coin['prevout_hash'] + ':' + str(coin['prevout_n'])
+                for coin in coins]
+
+    def input_fees(self, buckets):
+        '''The amount to pay without inputs, and the fee of each bucket,
+        at the marginal fee rate of the transaction.'''
+        base_size = self.size_model.size([])
+        base_fee = self.fee_estimator(base_size)
+        fee_rate = (self.fee_estimator(base_size + 1000) - base_fee) / 1000.
+        fees = [fee_rate * (bucket.size + (bucket.witness if bucket.segwit else 0))
+                for bucket in buckets]
+        return self.spent_amount + base_fee, fees
+
+    def choose_buckets(self, buckets, sufficient_funds, penalty_func):
+        deadline = time.time() + self.time_budget if self.time_budget else None
+        target, fees = self.input_fees(buckets)
+        # the buckets worth more than their fee, by decreasing net value
+        items = [(b.value - f, f, b) for b, f in zip(buckets, fees) if b.value > f]
+        items.sort(key=lambda x: -x[0])
+        values = [x[0] for x in items]
+        fees = [x[1] for x in items]
+        buckets = [x[2] for x in items]
+        selected = branch_and_bound(values, fees, target, self.dust_threshold,
+                                    self.max_tries, deadline)
+        if selected is not None:
+            chosen = [buckets[i] for i in selected]
+            if sufficient_funds(chosen):
+                self.print_error("changeless selection of %d buckets" % len(chosen))
+                return chosen
+        chosen = self.knapsack(values, buckets, target, deadline)
+        # the effective values are estimates: add coins until the
+        # exact fee is paid
+        chosen_ids = set(id(b) for b in chosen)
+        rest = [b for b in buckets if id(b) not in chosen_ids]
+        while not sufficient_funds(chosen):
+            if not rest:
+                raise NotEnoughFunds()
+            chosen.append(rest.pop(0))
+        return strip_unneeded(chosen, sufficient_funds)
+
+    def knapsack(self, values, buckets, target, deadline):
+        '''The smallest bucket that pays for the transaction, unless a
+        set of smaller ones leaves less change.'''
+        larger = [i for i, v in enumerate(values) if v >= target]
+        smaller = [i for i, v in enumerate(values) if v < target]
+        lowest_larger = buckets[larger[-1]] if larger else None
+        if sum(values[i] for i in smaller) < target:
+            return [lowest_larger] if lowest_larger else list(buckets)
+        smaller_all = smaller
+        smaller = smaller[:self.knapsack_size]
+        small_values = [values[i] for i in smaller]
+        if sum(small_values) < target:
+            # many buckets are needed: the largest ones, until target
+            chosen = []
+            total = 0
+            for i in smaller_all:
+                if total >= target:
+                    break
+                chosen.append(buckets[i])
+                total += values[i]
+            return chosen
+        subset = approximate_best_subset(small_values, target, self.knapsack_tries,
+                                         self.p.get_bytes, deadline)
+        subset_value = sum(small_values[j] for j in subset)
+        if lowest_larger and subset_value != target and values[larger[-1]] <= subset_value:
+            return [lowest_larger]
+        return [buckets[smaller[j]] for j in subset]
+
+
 COIN_CHOOSERS = {'Priority': CoinChooserOldestFirst,
-                 'Privacy': CoinChooserPrivacy}
+                 'Privacy': CoinChooserPrivacy,
+                 'Changeless': CoinChooserBranchAndBound}
 
 def get_name(config):
     kind = config.get('coin_chooser')
@@ -317,4 +538,8 @@ def get_name(config):
 
 def get_coin_chooser(config):
     klass = COIN_CHOOSERS[get_name(config)]
-    return klass()
+    coin_chooser = klass()
+    time_budget = config.get('coin_chooser_time_budget')
+    if time_budget:
+        coin_chooser.time_budget = float(time_budget)
+    return coin_chooser
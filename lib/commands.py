@@ -37,13 +37,11 @@ from decimal import Decimal
 
 import util
 from util import print_msg, format_satoshis, print_stderr
+from util import PR_PAID, PR_UNPAID, PR_UNKNOWN, PR_EXPIRED
 import bitcoin
 from bitcoin import is_address, hash_160, COIN, TYPE_ADDRESS
 import transaction
 from transaction import Transaction
-import paymentrequest
-from paymentrequest import PR_PAID, PR_UNPAID, PR_UNKNOWN, PR_EXPIRED
-import contacts
 known_commands = {}
 
 
@@ -90,11 +88,12 @@ def command(s):
 
 class Commands:
 
-    def __init__(self, config, wallet, network, callback = None):
+    def __init__(self, config, wallet, network, callback = None, fx = None):
         self.config = config
         self.wallet = wallet
         self.network = network
         self._callback = callback
+        self.fx = fx
 
     def _run(self, method, args, password_getter):
         # this wrapper is called from the python console
@@ -141,6 +140,30 @@ class Commands:
         self.wallet.storage.write()
         return {'password':self.wallet.has_password()}
 
+    @command('w')
+    def convertstorage(self):
+        """Convert the wallet file to the SQLite format, which saves changes
+        incrementally. A copy of the JSON file is kept, with a .json extension.
+        Encrypted wallet files cannot be converted."""
+        json_path = self.wallet.storage.convert_to_sqlite()
+        return {'path': self.wallet.storage.path, 'json_backup': json_path}
+
+    @command('w')
+    def enablejournal(self):
+        """Save changes of the wallet to an append-only journal file, which
+        is folded into the wallet file when the wallet is closed or when
+        the journal grows larger than the wallet file."""
+        self.wallet.storage.enable_journal()
+        return True
+
+    @command('w')
+    def enablecompactmaps(self):
+        """Store the transaction history of the wallet file as a compact
+        binary blob, which is smaller and faster to load. Older versions
+        of Electrum cannot read it, and will synchronize the wallet again."""
+        self.wallet.storage.enable_compact_maps()
+        return True
+
     @command('')
     def getconfig(self, key):
         """Return a configuration variable. """
@@ -245,11 +268,20 @@ class Commands:
             self.wallet.sign_transaction(tx, password)
         return tx.as_dict()
 
+    @command('wp')
+    def signtransactions(self, txs, password=None):
+        """Sign a list of transactions with the wallet keys. The password is checked once, and each key is derived once for the whole list. Transactions are returned in the same order."""
+        txs = [Transaction(tx) for tx in txs]
+        self.wallet.sign_transactions(txs, password)
+        return [tx.as_dict() for tx in txs]
+
     @command('')
     def deserialize(self, tx):
         """Deserialize a serialized transaction"""
         tx = Transaction(tx)
-        return tx.deserialize()
+        d = tx.deserialize()
+        d['inputs'] = [txin.as_dict() for txin in d['inputs']]
+        return d
 
     @command('n')
     def broadcast(self, tx, timeout=30):
@@ -441,7 +473,8 @@ class Commands:
 
     @command('wp')
     def paytomany(self, outputs, tx_fee=None, from_addr=None, change_addr=None, nocheck=False, unsigned=False, rbf=False, password=None, locktime=None):
-        """Create a multi-output transaction. """
+        """Create a multi-output transaction. Outputs can be read from a
+        csv file (address,amount) or a JSON lines file."""
         tx_fee = satoshis(tx_fee)
         domain = [from_addr] if from_addr else None
         tx = self._mktx(outputs, tx_fee, change_addr, domain, nocheck, unsigned, rbf, password, locktime)
@@ -489,6 +522,23 @@ class Commands:
             })
         return out
 
+    @command('w')
+    def exporthistory(self, filename, fmt='csv', show_fiat=False):
+        """Export wallet history to a file. Rows are streamed to the file
+        as CSV or JSON lines, without building the whole export in memory."""
+        from history_export import export_history, EXPORT_FORMATS
+        if fmt not in EXPORT_FORMATS:
+            raise BaseException('Unknown format: %s. Use one of: %s' % (fmt, ', '.join(EXPORT_FORMATS)))
+        fx = None
+        if show_fiat:
+            if not (self.fx and self.fx.show_history()):
+                raise BaseException('Fiat history is not available. Enable use_exchange_rate and history_rates in the daemon.')
+            fx = self.fx
+        path = os.path.join(self.config.get('cwd', ''), os.path.expanduser(filename))
+        with open(path, 'w') as f:
+            n = export_history(self.wallet, f, fmt, fx)
+        return {'path': path, 'rows': n}
+
     @command('w')
     def setlabel(self, key, label):
         """Assign a label to an item. Item may be a Litebitcoin address or a
@@ -684,13 +734,15 @@ param_descriptions = {
     'pos': 'Position',
     'height': 'Block height',
     'tx': 'Serialized transaction (hexadecimal)',
+    'txs': 'List of serialized transactions (JSON)',
     'key': 'Variable name',
     'pubkey': 'Public key',
     'message': 'Clear text message. Use quotes if it contains spaces.',
     'encrypted': 'Encrypted message',
     'amount': 'Amount to be sent (in LBTC). Type \'!\' to send the maximum available.',
     'requested_amount': 'Requested amount (in LBTC).',
-    'outputs': 'list of ["address", amount]',
+    'outputs': 'list of ["address", amount], or a csv or JSON lines file of payments, one per line',
+    'filename': 'Output file path',
 }
 
 command_options = {
@@ -724,22 +776,42 @@ command_options = {
     'pending':     (None, "--pending",     "Show only pending requests."),
     'expired':     (None, "--expired",     "Show only expired requests."),
     'paid':        (None, "--paid",        "Show only paid requests."),
+    'fmt':         (None, "--format",      "Export format: csv or json (JSON lines)"),
+    'show_fiat':   (None, "--fiat",        "Add fiat columns, using historical exchange rates"),
 }
 
 
 # don't use floats because of rounding errors
 from transaction import tx_from_str
 json_loads = lambda x: json.loads(x, parse_float=lambda x: str(Decimal(x)))
+# a list of transactions, each one in hexadecimal or in json
+txs_from_str = lambda x: [tx['hex'] if type(tx) is dict else tx_from_str(tx) for tx in json.loads(x)]
+
+def outputs_from_str(x):
+    "json list, or csv or JSON lines of payments, in a file or in the text"
+    try:
+        outputs = json_loads(x)
+        if type(outputs) is list and all(type(o) is list for o in outputs):
+            return outputs
+    except ValueError:
+        pass
+    from bulk_payments import read_outputs
+    if '\n' not in x and os.path.exists(os.path.expanduser(x)):
+        with open(os.path.expanduser(x)) as f:
+            return map(list, read_outputs(f))
+    return map(list, read_outputs(x.splitlines()))
+
 arg_types = {
     'num': int,
     'nbits': int,
     'imax': int,
     'entropy': long,
     'tx': tx_from_str,
+    'txs': txs_from_str,
     'pubkeys': json_loads,
     'jsontx': json_loads,
     'inputs': json_loads,
-    'outputs': json_loads,
+    'outputs': outputs_from_str,
     'tx_fee': lambda x: str(Decimal(x)) if x is not None else None,
     'amount': lambda x: str(Decimal(x)) if x != '!' else '!',
     'locktime': int,
@@ -824,6 +896,7 @@ def add_global_options(parser):
     group.add_argument("--testnet", action="store_true", dest="testnet", default=False, help="Use Testnet")
     group.add_argument("--segwit", action="store_true", dest="segwit", default=False, help="The Wizard will create Segwit seed phrases (Testnet only).")
     group.add_argument("--nolnet", action="store_true", dest="nolnet", default=False, help="Use Nolnet")
+    group.add_argument("--profile-startup", action="store_true", dest="profile_startup", default=False, help="Report import and initialization times")
 
 def get_parser():
     # create main parser
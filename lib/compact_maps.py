@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2017 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''Compact binary encoding of the wallet accounting maps.
+
+txi, txo, pruned_txo, addr_history and verified_tx3 are written to
+JSON wallet files as a single binary blob instead of nested JSON.
+Each txid is stored once, as 32 bytes, and addresses once, in a
+table; the maps are stored as columns of packed integers, which are
+encoded and decoded with one struct call each.
+
+Decoded maps have the same shape as before: hex txids and 'txid:n'
+strings, with tuple items.  A txid string is created once and shared
+by all the maps, which is where most of the memory goes in large
+wallets.
+
+Layout: MAGIC, a version byte, then length-prefixed sections.
+'''
+
+import gc
+import struct
+import base64
+from itertools import izip
+
+
+MAGIC = 'EWM'
+VERSION = 1
+
+# keys of the storage encoded in the blob
+MAP_KEYS = ['txi', 'txo', 'pruned_txo', 'addr_history', 'verified_tx3']
+
+# key of the blob in the wallet file
+BLOB_KEY = 'compact_maps'
+
+
+class Encoder(object):
+
+    def __init__(self):
+        self.txids = {}
+        self.addresses = {}
+        self.sections = []
+
+    def txid(self, tx_hash):
+        i = self.txids.get(tx_hash)
+        if i is None:
+            if len(tx_hash) != 64:
+                raise ValueError("not a txid: %r" % tx_hash)
+            i = self.txids[tx_hash] = len(self.txids)
+        return i
+
+    def address(self, addr):
+        i = self.addresses.get(addr)
+        if i is None:
+            if '\n' in addr:
+                raise ValueError("invalid address: %r" % addr)
+            i = self.addresses[addr] = len(self.addresses)
+        return i
+
+    def outpoint(self, ser):
+        prevout_hash, n = ser.split(':')
+        return self.txid(prevout_hash), int(n)
+
+    def column(self, fmt, values):
+        self.sections.append(struct.pack('<%d%s' % (len(values), fmt), *values))
+
+    def encode(self, data):
+        txo = data.get('txo', {})
+        keys, rows = [], []
+        for tx_hash, d in txo.iteritems():
+            t = self.txid(tx_hash)
+            keys.append(t)
+            for addr, l in d.iteritems():
+                a = self.address(addr)
+                for n, v, is_cb in l:
+                    rows.append((t, a, n, v, bool(is_cb)))
+        self.column('I', keys)
+        self.columns('IIIqB', rows)
+
+        txi = data.get('txi', {})
+        keys, rows = [], []
+        for tx_hash, d in txi.iteritems():
+            t = self.txid(tx_hash)
+            keys.append(t)
+            for addr, l in d.iteritems():
+                a = self.address(addr)
+                for ser, v in l:
+                    rows.append((t, a) + self.outpoint(ser) + (v,))
+        self.column('I', keys)
+        self.columns('IIIIq', rows)
+
+        rows = [self.outpoint(ser) + (self.txid(tx_hash),)
+                for ser, tx_hash in data.get('pruned_txo', {}).iteritems()]
+        self.columns('III', rows)
+
+        counts, rows = [], []
+        for addr, h in data.get('addr_history', {}).iteritems():
+            counts.append((self.address(addr), len(h)))
+            for tx_hash, height in h:
+                rows.append((self.txid(tx_hash), height))
+        self.columns('II', counts)
+        self.columns('Ii', rows)
+
+        rows = [(self.txid(tx_hash), height, timestamp, pos)
+                for tx_hash, (height, timestamp, pos) in data.get('verified_tx3', {}).iteritems()]
+        self.columns('IiII', rows)
+
+        txids = [None] * len(self.txids)
+        for tx_hash, i in self.txids.iteritems():
+            txids[i] = tx_hash
+        txids = ''.join(txids)
+        raw_txids = txids.decode('hex')
+        # txids must decode to the same strings
+        if raw_txids.encode('hex') != txids:
+            raise ValueError("txids are not lowercase hex")
+        addresses = [None] * len(self.addresses)
+        for addr, i in self.addresses.iteritems():
+            addresses[i] = addr
+        tables = [raw_txids, '\n'.join(addresses).encode('utf-8')]
+        out = [MAGIC, chr(VERSION)]
+        for s in tables + self.sections:
+            out.append(struct.pack('<I', len(s)))
+            out.append(s)
+        return ''.join(out)
+
+    def columns(self, fmt, rows):
+        cols = zip(*rows) if rows else [()] * len(fmt)
+        for f, values in zip(fmt, cols):
+            self.column(f, values)
+
+
+class Decoder(object):
+
+    def __init__(self, blob):
+        if blob[:3] != MAGIC:
+            raise IOError("Not an encoded wallet map")
+        version = ord(blob[3])
+        if version != VERSION:
+            raise IOError("Unsupported wallet map encoding: %d" % version)
+        self.blob = blob
+        self.pos = 4
+
+    def section(self):
+        n, = struct.unpack_from('<I', self.blob, self.pos)
+        self.pos += 4 + n
+        return self.blob[self.pos - n:self.pos]
+
+    def column(self, fmt):
+        s = self.section()
+        return struct.unpack('<%d%s' % (len(s) // struct.calcsize(fmt), fmt), s)
+
+    def columns(self, fmt):
+        return [self.column(f) for f in fmt]
+
+    def decode(self):
+        h = self.section().encode('hex')
+        txids = [h[i:i + 64] for i in xrange(0, len(h), 64)]
+        s = self.section()
+        addresses = s.decode('utf-8').split('\n') if s else []
+        ser = lambda t, n: txids[t] + ':%d' % n
+        booleans = (False, True)
+
+        txo = dict((txids[t], {}) for t in self.column('I'))
+        for t, a, n, v, is_cb in izip(*self.columns('IIIqB')):
+            txo[txids[t]].setdefault(addresses[a], []).append((n, v, booleans[is_cb]))
+
+        txi = dict((txids[t], {}) for t in self.column('I'))
+        for t, a, pt, pn, v in izip(*self.columns('IIIIq')):
+            txi[txids[t]].setdefault(addresses[a], []).append((ser(pt, pn), v))
+
+        pruned_txo = dict((ser(pt, pn), txids[t]) for pt, pn, t in izip(*self.columns('III')))
+
+        addr_history = {}
+        counts = izip(*self.columns('II'))
+        rows = izip(*self.columns('Ii'))
+        for a, count in counts:
+            addr_history[addresses[a]] = [(txids[t], height) for t, height in
+                                          (next(rows) for i in xrange(count))]
+
+        verified_tx3 = dict((txids[t], (height, timestamp, pos))
+                            for t, height, timestamp, pos in izip(*self.columns('IiII')))
+        return {
+            'txi': txi,
+            'txo': txo,
+            'pruned_txo': pruned_txo,
+            'addr_history': addr_history,
+            'verified_tx3': verified_tx3,
+        }
+
+
+def encode_maps(data):
+    '''Encode the maps of data (a wallet storage dict) to a binary string.
+    Raises ValueError if they cannot be encoded.'''
+    try:
+        return Encoder().encode(data)
+    except (struct.error, TypeError) as e:
+        raise ValueError(str(e))
+
+
+def decode_maps(blob):
+    # decoding only allocates containers, which would trigger many
+    # useless collections
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return Decoder(blob).decode()
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def pack_data(data):
+    '''Return a shallow copy of data, with the maps replaced by their
+    encoding.  data is returned unchanged if they cannot be encoded.'''
+    if not any(k in data for k in MAP_KEYS):
+        return data
+    try:
+        blob = encode_maps(data)
+    except ValueError:
+        return data
+    packed = dict((k, v) for k, v in data.iteritems() if k not in MAP_KEYS)
+    packed[BLOB_KEY] = base64.b64encode(blob)
+    return packed
+
+
+def unpack_data(data):
+    '''Replace the encoded blob of data, if any, with the maps.'''
+    blob = data.pop(BLOB_KEY, None)
+    if blob is not None:
+        data.update(decode_maps(base64.b64decode(blob)))
+    return data
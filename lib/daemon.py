@@ -23,67 +23,24 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import ast
 import os
 import sys
 import time
 
-import jsonrpclib
 from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer, SimpleJSONRPCRequestHandler
 
 from version import ELECTRUM_VERSION
 from network import Network
 from util import json_decode, DaemonThread
 from util import print_msg, print_error, print_stderr, UserCancelled
-from wallet import Wallet
+from wallet import Wallet, tx_cache
+from derivation import stop_pool
 from storage import WalletStorage
 from commands import known_commands, Commands
 from simple_config import SimpleConfig
 from plugins import run_hook
 from exchange_rate import FxThread
-
-def get_lockfile(config):
-    return os.path.join(config.path, 'daemon')
-
-def remove_lockfile(lockfile):
-    os.unlink(lockfile)
-
-def get_fd_or_server(config):
-    '''Tries to create the lockfile, using O_EXCL to
-    prevent races.  If it succeeds it returns the FD.
-    Otherwise try and connect to the server specified in the lockfile.
-    If this succeeds, the server is returned.  Otherwise remove the
-    lockfile and try again.'''
-    lockfile = get_lockfile(config)
-    while True:
-        try:
-            return os.open(lockfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY), None
-        except OSError:
-            pass
-        server = get_server(config)
-        if server is not None:
-            return None, server
-        # Couldn't connect; remove lockfile and try again.
-        remove_lockfile(lockfile)
-
-def get_server(config):
-    lockfile = get_lockfile(config)
-    while True:
-        create_time = None
-        try:
-            with open(lockfile) as f:
-                (host, port), create_time = ast.literal_eval(f.read())
-                server = jsonrpclib.Server('http://%s:%d' % (host, port))
-            # Test daemon is running
-            server.ping()
-            return server
-        except:
-            pass
-        if not create_time or create_time < time.time() - 1.0:
-            return None
-        # Sleep a bit and try again; it might have just been started
-        time.sleep(1.0)
-
+from daemon_client import get_lockfile, remove_lockfile, get_fd_or_server, get_server
 
 
 class RequestHandler(SimpleJSONRPCRequestHandler):
@@ -99,6 +56,10 @@ class RequestHandler(SimpleJSONRPCRequestHandler):
         SimpleJSONRPCRequestHandler.end_headers(self)
 
 
+# how often idle wallets are looked for, in seconds
+HIBERNATE_CHECK_INTERVAL = 10
+
+
 class Daemon(DaemonThread):
 
     def __init__(self, config, fd):
@@ -115,8 +76,19 @@ class Daemon(DaemonThread):
 
         self.gui = None
         self.wallets = {}
+        # wallets unloaded after being idle: path -> password.  They are
+        # loaded again when a command uses them.
+        self.hibernated = {}
+        # path -> password of the wallets loaded with load_wallet, kept
+        # only if wallets can be hibernated
+        self.passwords = {}
+        # path -> resource accounting, for 'daemon status'
+        self.wallet_stats = {}
+        self.last_hibernate_check = time.time()
+        # raw transactions are shared by all the wallets
+        tx_cache.resize(config.get('tx_cache_size', tx_cache.size))
         # Setup JSONRPC server
-        self.cmd_runner = Commands(self.config, None, self.network)
+        self.cmd_runner = Commands(self.config, None, self.network, fx=self.fx)
         self.init_server(config, fd)
 
     def init_server(self, config, fd):
@@ -160,6 +132,10 @@ class Daemon(DaemonThread):
             if path in self.wallets:
                 self.stop_wallet(path)
                 response = True
+            elif path in self.hibernated:
+                self.hibernated.pop(path)
+                self.wallet_stats.pop(path, None)
+                response = True
             else:
                 response = False
         elif sub == 'status':
@@ -176,6 +152,8 @@ class Daemon(DaemonThread):
                     'version': ELECTRUM_VERSION,
                     'wallets': {k: w.is_up_to_date()
                                 for k, w in self.wallets.items()},
+                    'wallet_stats': self.get_wallet_stats(),
+                    'tx_cache': tx_cache.get_stats(),
                     'fee_per_kb': self.config.fee_per_kb(),
                 }
             else:
@@ -203,6 +181,7 @@ class Daemon(DaemonThread):
         if path in self.wallets:
             wallet = self.wallets[path]
             return wallet
+        t0 = time.time()
         storage = WalletStorage(path)
         if not storage.file_exists():
             return
@@ -220,6 +199,14 @@ class Daemon(DaemonThread):
         wallet = Wallet(storage)
         wallet.start_threads(self.network)
         self.wallets[path] = wallet
+        self.hibernated.pop(path, None)
+        stats = self.wallet_stats.setdefault(path, {'activations': 0, 'requests': 0})
+        stats['activations'] += 1
+        stats['load_time'] = round(time.time() - t0, 3)
+        stats['last_access'] = time.time()
+        # needed to load the wallet again after hibernation
+        if self.can_hibernate():
+            self.passwords[path] = password if storage.is_encrypted() else None
         return wallet
 
     def add_wallet(self, wallet):
@@ -227,11 +214,73 @@ class Daemon(DaemonThread):
         self.wallets[path] = wallet
 
     def get_wallet(self, path):
-        return self.wallets.get(path)
+        '''Return the wallet of path, and load it again if it was
+        hibernated.'''
+        wallet = self.wallets.get(path)
+        if wallet is None and path in self.hibernated:
+            self.print_error('reactivating wallet', path)
+            wallet = self.load_wallet(path, self.hibernated[path])
+        if wallet is not None and path in self.wallet_stats:
+            stats = self.wallet_stats[path]
+            stats['requests'] += 1
+            stats['last_access'] = time.time()
+        return wallet
 
     def stop_wallet(self, path):
         wallet = self.wallets.pop(path)
         wallet.stop_threads()
+        self.passwords.pop(path, None)
+        self.wallet_stats.pop(path, None)
+
+    def can_hibernate(self):
+        # wallets of the GUI are never hibernated
+        return bool(self.config.get('wallet_idle_timeout', 0)) and self.gui is None
+
+    def hibernate_idle_wallets(self):
+        '''Unload the wallets that have not been used by a command for
+        wallet_idle_timeout seconds.  Their state is saved, and they are
+        loaded again by get_wallet.'''
+        if not self.can_hibernate():
+            return
+        timeout = self.config.get('wallet_idle_timeout')
+        now = time.time()
+        for path, wallet in self.wallets.items():
+            stats = self.wallet_stats.get(path)
+            if stats is None or now - stats['last_access'] < timeout:
+                continue
+            # the default wallet of the RPC server is kept loaded, and
+            # so are wallets that are still synchronizing
+            if wallet is self.cmd_runner.wallet or not wallet.is_up_to_date():
+                continue
+            # wallets loaded before hibernation was enabled cannot be
+            # loaded again without their password
+            if path not in self.passwords:
+                continue
+            self.print_error('hibernating wallet', path)
+            password = self.passwords.pop(path)
+            self.wallets.pop(path)
+            wallet.stop_threads()
+            self.hibernated[path] = password
+            stats['hibernations'] = stats.get('hibernations', 0) + 1
+
+    def get_wallet_stats(self):
+        now = time.time()
+        result = {}
+        for path, stats in self.wallet_stats.items():
+            d = dict(stats)
+            d['idle'] = round(now - stats['last_access'], 1)
+            d['file_size'] = os.path.getsize(path) if os.path.exists(path) else 0
+            wallet = self.wallets.get(path)
+            if wallet is None:
+                d['state'] = 'hibernated'
+            else:
+                d['state'] = 'active'
+                d['up_to_date'] = wallet.is_up_to_date()
+                d['transactions'] = len(wallet.transactions)
+                d['addresses'] = len(wallet.get_addresses())
+                d['storage'] = wallet.storage.get_write_stats()
+            result[path] = d
+        return result
 
     def run_cmdline(self, config_options):
         password = config_options.get('password')
@@ -242,7 +291,7 @@ class Daemon(DaemonThread):
         cmd = known_commands[cmdname]
         if cmd.requires_wallet:
             path = config.get_wallet_path()
-            wallet = self.wallets.get(path)
+            wallet = self.get_wallet(path)
             if wallet is None:
                 return {'error': 'Wallet not open. Use "electrum-lbtc daemon load_wallet"'}
         else:
@@ -253,7 +302,7 @@ class Daemon(DaemonThread):
         args = map(json_decode, args)
         # options
         args += map(lambda x: (config_options.get(x) if x in ['password', 'new_password'] else config.get(x)), cmd.options)
-        cmd_runner = Commands(config, wallet, self.network)
+        cmd_runner = Commands(config, wallet, self.network, fx=self.fx)
         func = getattr(cmd_runner, cmd.name)
         result = func(*args)
         return result
@@ -261,12 +310,16 @@ class Daemon(DaemonThread):
     def run(self):
         while self.is_running():
             self.server.handle_request() if self.server else time.sleep(0.1)
+            if time.time() - self.last_hibernate_check > HIBERNATE_CHECK_INTERVAL:
+                self.last_hibernate_check = time.time()
+                self.hibernate_idle_wallets()
         for k, wallet in self.wallets.items():
             wallet.stop_threads()
         if self.network:
             self.print_error("shutting down network")
             self.network.stop()
             self.network.join()
+        stop_pool()
         self.on_stop()
 
     def stop(self):
@@ -281,3 +334,4 @@ class Daemon(DaemonThread):
         gui = __import__('electrum_lbtc_gui.' + gui_name, fromlist=['electrum_lbtc_gui'])
         self.gui = gui.ElectrumGui(config, self, plugins)
         self.gui.main()
+        stop_pool()
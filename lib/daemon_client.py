@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2017 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''Client side of the daemon: finding a running daemon, and the
+lockfile.  Kept apart from daemon.py, so that commands sent to a
+running daemon do not load the wallet and network code.'''
+
+import ast
+import os
+import time
+
+import jsonrpclib
+
+
+def get_lockfile(config):
+    return os.path.join(config.path, 'daemon')
+
+def remove_lockfile(lockfile):
+    os.unlink(lockfile)
+
+def get_fd_or_server(config):
+    '''Tries to create the lockfile, using O_EXCL to
+    prevent races.  If it succeeds it returns the FD.
+    Otherwise try and connect to the server specified in the lockfile.
+    If this succeeds, the server is returned.  Otherwise remove the
+    lockfile and try again.'''
+    lockfile = get_lockfile(config)
+    while True:
+        try:
+            return os.open(lockfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY), None
+        except OSError:
+            pass
+        server = get_server(config)
+        if server is not None:
+            return None, server
+        # Couldn't connect; remove lockfile and try again.
+        remove_lockfile(lockfile)
+
+def get_server(config):
+    lockfile = get_lockfile(config)
+    while True:
+        create_time = None
+        try:
+            with open(lockfile) as f:
+                (host, port), create_time = ast.literal_eval(f.read())
+                server = jsonrpclib.Server('http://%s:%d' % (host, port))
+            # Test daemon is running
+            server.ping()
+            return server
+        except:
+            pass
+        if not create_time or create_time < time.time() - 1.0:
+            return None
+        # Sleep a bit and try again; it might have just been started
+        time.sleep(1.0)
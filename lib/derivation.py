@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2017 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''Public key derivation and transaction signing over a pool of
+worker processes.
+
+EC point multiplication is done in pure Python, so deriving long
+address chains (wallet restore, large gap limits, multisig) and signing
+batches of transactions are CPU bound.  Large batches are cut into
+chunks that are processed in parallel; results are reassembled in
+order, so the output is the same as the serial path.
+'''
+
+import os
+import sys
+import threading
+import multiprocessing
+
+from bitcoin import CKD_pub_batch, address_caches
+from util import print_error
+
+
+# Below this many keys, work is done in-process: sending a small
+# batch to the pool costs more than it saves.
+MIN_PARALLEL_SIZE = 64
+
+# Below this many transactions, signing is done in-process.
+MIN_PARALLEL_TXS = 4
+
+# chunks sent to the pool per worker process, for load balancing
+CHUNKS_PER_PROCESS = 4
+
+_pool = None
+_pool_lock = threading.Lock()
+_num_processes = None
+
+
+def get_num_processes():
+    # frozen executables cannot always start worker processes
+    if getattr(sys, 'frozen', False):
+        return 1
+    if _num_processes is not None:
+        return _num_processes
+    if 'ANDROID_DATA' in os.environ:
+        return 1
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def set_num_processes(n):
+    '''Set the size of the worker pool.  0 or 1 disables it.'''
+    global _num_processes
+    stop_pool()
+    _num_processes = n
+
+
+def _init_worker():
+    # Workers are forked from whichever thread needs the pool, maybe
+    # while another thread holds the lock of a module-level cache.  The
+    # copy of that lock in the worker would never be released.
+    for cache in address_caches:
+        cache.lock = threading.Lock()
+
+
+def get_pool():
+    global _pool, _num_processes
+    with _pool_lock:
+        if _pool is None and get_num_processes() > 1:
+            try:
+                _pool = multiprocessing.Pool(get_num_processes(), _init_worker)
+            except BaseException as e:
+                print_error("[derivation] cannot start process pool:", e)
+                _num_processes = 1
+        return _pool
+
+
+def stop_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.terminate()
+            _pool.join()
+            _pool = None
+
+
+def _derive_chunk(args):
+    cK, c, sequence = args
+    return CKD_pub_batch(cK, c, sequence)
+
+
+def derive_branches(keys, sequence):
+    '''keys is a list of (cK, c) branch keys.  For each of them, return
+    the list of hex compressed public keys at the indices of sequence.'''
+    sequence = list(sequence)
+    total = len(keys) * len(sequence)
+    pool = get_pool() if total >= MIN_PARALLEL_SIZE else None
+    if pool is None:
+        results = [CKD_pub_batch(cK, c, sequence) for cK, c in keys]
+    else:
+        n_chunks = get_num_processes() * CHUNKS_PER_PROCESS
+        size = max(1, -(-total // n_chunks))
+        jobs = []
+        for cK, c in keys:
+            for i in range(0, len(sequence), size):
+                jobs.append((cK, c, sequence[i:i + size]))
+        chunks = iter(pool.map(_derive_chunk, jobs))
+        # jobs were created key by key, in index order
+        results = []
+        for cK, c in keys:
+            out = []
+            while len(out) < len(sequence):
+                out.extend(next(chunks))
+            results.append(out)
+    return [[x.encode('hex') for x in r] for r in results]
+
+
+def _make_signatures(args):
+    from transaction import SigningSession
+    verify, jobs = args
+    return [SigningSession(tx, keypairs, verify).make_signatures() for tx, keypairs in jobs]
+
+
+def sign_transactions(jobs, verify=True):
+    '''jobs is a list of (tx, keypairs).  Sign each transaction with its
+    keypairs.  Signatures are made and verified by worker processes, and
+    added to the transactions in this process.
+
+    Private keys are not sent to the shared derivation pool: signing
+    uses its own pool, which is terminated as soon as the batch is
+    done, so no worker outlives the call holding secrets.'''
+    from transaction import SigningSession
+    # Sort pubkeys here: workers sign pickled copies, and signature
+    # slots refer to the sorted order of x_pubkeys.
+    for tx, keypairs in jobs:
+        for txin in tx.inputs():
+            tx.get_sorted_pubkeys(txin)
+    n = get_num_processes() if len(jobs) >= MIN_PARALLEL_TXS else 1
+    pool = None
+    if n > 1:
+        try:
+            pool = multiprocessing.Pool(n, _init_worker)
+        except BaseException as e:
+            print_error("[derivation] cannot start signing pool:", e)
+    if pool is None:
+        results = _make_signatures((verify, jobs))
+    else:
+        try:
+            n_chunks = n * CHUNKS_PER_PROCESS
+            size = max(1, -(-len(jobs) // n_chunks))
+            chunks = [(verify, jobs[i:i + size]) for i in range(0, len(jobs), size)]
+            results = [x for r in pool.map(_make_signatures, chunks) for x in r]
+        finally:
+            pool.terminate()
+            pool.join()
+    for (tx, keypairs), signed in zip(jobs, results):
+        SigningSession(tx, keypairs, verify).add_signatures(signed)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2017 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''secp256k1 operations, run by libsecp256k1 when it can be loaded,
+and by the python ecdsa package otherwise.
+
+Both backends take and return byte strings: 32-byte secrets, tweaks
+and message hashes, serialized public keys, and 64-byte compact
+signatures (r and s, big-endian).  Signatures are deterministic
+(RFC6979) and have a low S, so both backends produce the same ones.
+
+The backend is loaded on first use, see get_backend().  The libsecp256k1
+backend is in ecc_libsecp256k1, so that ctypes is only imported then.'''
+
+import hashlib
+
+import ecdsa
+from ecdsa.ecdsa import curve_secp256k1, generator_secp256k1
+from ecdsa.curves import SECP256k1
+from ecdsa.ellipticcurve import Point, INFINITY
+try:
+    # ecdsa >= 0.14: faster arithmetic in jacobian coordinates
+    from ecdsa.ellipticcurve import PointJacobi
+except ImportError:
+    PointJacobi = None
+from ecdsa.numbertheory import inverse_mod
+from ecdsa.util import string_to_number, number_to_string, sigencode_string, sigdecode_string
+
+import msqr
+from util import print_error
+
+
+_p = curve_secp256k1.p()
+_order = generator_secp256k1.order()
+
+
+class PythonBackend(object):
+
+    name = 'python'
+
+    def decode_point(self, pubkey):
+        if len(pubkey) == 33 and pubkey[0] in '\x02\x03':
+            x = string_to_number(pubkey[1:])
+            alpha = (pow(x, 3, _p) + 7) % _p
+            y = pow(alpha, (_p + 1) // 4, _p)
+            if x >= _p or y * y % _p != alpha:
+                raise Exception('invalid pubkey')
+            if (y & 1) != (ord(pubkey[0]) & 1):
+                y = _p - y
+        elif len(pubkey) == 65 and pubkey[0] == '\x04':
+            x = string_to_number(pubkey[1:33])
+            y = string_to_number(pubkey[33:])
+            if not ecdsa.ecdsa.point_is_valid(generator_secp256k1, x, y):
+                raise Exception('invalid pubkey')
+        else:
+            raise Exception('invalid pubkey')
+        return self.point(x, y)
+
+    def point(self, x, y):
+        if PointJacobi is not None:
+            return PointJacobi(curve_secp256k1, x, y, 1)
+        return Point(curve_secp256k1, x, y)
+
+    def encode_point(self, point, compressed=True):
+        if point == INFINITY:
+            raise Exception('point at infinity')
+        if compressed:
+            return chr(2 + (point.y() & 1)) + number_to_string(point.x(), _order)
+        return '\x04' + number_to_string(point.x(), _order) + number_to_string(point.y(), _order)
+
+    def pubkey_from_secret(self, secret, compressed=True):
+        return self.encode_point(generator_secp256k1 * string_to_number(secret), compressed)
+
+    def sign(self, secret, msg_hash):
+        key = ecdsa.SigningKey.from_string(secret, curve=SECP256k1)
+        r, s = key.sign_digest_deterministic(msg_hash, hashfunc=hashlib.sha256, sigencode=lambda r, s, order: (r, s))
+        if s > _order // 2:
+            s = _order - s
+        return sigencode_string(r, s, _order)
+
+    def verify(self, pubkey, sig, msg_hash):
+        try:
+            key = ecdsa.VerifyingKey.from_public_point(self.decode_point(pubkey), curve=SECP256k1)
+            return key.verify_digest(sig, msg_hash, sigdecode=sigdecode_string)
+        except Exception:
+            return False
+
+    def recover(self, sig, recid, msg_hash, compressed=True):
+        ''' See http://www.secg.org/download/aid-780/sec1-v2.pdf, chapter 4.1.6 '''
+        r, s = sigdecode_string(sig, _order)
+        if not (0 < r < _order and 0 < s < _order):
+            raise Exception('invalid signature')
+        # 1.1
+        x = r + (recid // 2) * _order
+        if x >= _p:
+            raise Exception('invalid signature')
+        # 1.3
+        alpha = (x * x * x + 7) % _p
+        beta = msqr.modular_sqrt(alpha, _p)
+        if beta * beta % _p != alpha:
+            raise Exception('invalid signature')
+        y = beta if (beta - recid) % 2 == 0 else _p - beta
+        R = self.point(x, y)
+        # 1.5 compute e from message:
+        e = string_to_number(msg_hash)
+        minus_e = -e % _order
+        # 1.6 compute Q = r^-1 (sR - eG)
+        inv_r = inverse_mod(r, _order)
+        Q = inv_r * (s * R + minus_e * generator_secp256k1)
+        return self.encode_point(Q, compressed)
+
+    def pubkey_tweak_add(self, pubkey, tweak, compressed=True):
+        return self.pubkey_tweak_add_many(pubkey, [tweak], compressed)[0]
+
+    def pubkey_tweak_add_many(self, pubkey, tweaks, compressed=True):
+        # the public key is decoded once for all the tweaks
+        point = self.decode_point(pubkey)
+        return [self.encode_point(string_to_number(t) * generator_secp256k1 + point, compressed) for t in tweaks]
+
+    def pubkey_tweak_mul(self, pubkey, tweak, compressed=True):
+        return self.encode_point(self.decode_point(pubkey) * string_to_number(tweak), compressed)
+
+
+_backend = None
+
+
+def load_backend(name=None):
+    '''Return the backend called name, or the fastest available one.'''
+    if name in [None, 'libsecp256k1']:
+        import ecc_libsecp256k1
+        lib = ecc_libsecp256k1.load_library()
+        if lib is not None:
+            try:
+                return ecc_libsecp256k1.LibSecp256k1Backend(lib, PythonBackend())
+            except BaseException as e:
+                print_error('[ecc] cannot use libsecp256k1:', e)
+        if name is not None:
+            raise Exception('libsecp256k1 is not available')
+    elif name != PythonBackend.name:
+        raise Exception('unknown ecc backend', name)
+    return PythonBackend()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = load_backend()
+    return _backend
+
+
+def set_backend(name):
+    global _backend
+    _backend = load_backend(name)
+    return _backend
+
+
+def scalar_to_bytes(x):
+    '''32-byte encoding of x modulo the order of the curve.'''
+    return number_to_string(x % _order, _order)
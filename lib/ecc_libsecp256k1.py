@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2017 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''The libsecp256k1 backend of ecc_backend, through ctypes.
+
+The library is not shipped: the one installed on the system is used,
+or one placed next to this file.'''
+
+import os
+import sys
+import ctypes
+import ctypes.util
+
+
+# flags of secp256k1.h
+SECP256K1_CONTEXT_VERIFY = (1 << 0) | (1 << 8)
+SECP256K1_CONTEXT_SIGN = (1 << 0) | (1 << 9)
+SECP256K1_EC_COMPRESSED = (1 << 1) | (1 << 8)
+SECP256K1_EC_UNCOMPRESSED = (1 << 1)
+
+LIBRARY_NAMES = ['libsecp256k1.so.0', 'libsecp256k1.so', 'libsecp256k1.0.dylib',
+                 'libsecp256k1.dylib', 'libsecp256k1-0.dll', 'libsecp256k1.dll']
+
+
+def load_library():
+    here = os.path.dirname(os.path.realpath(__file__))
+    names = [os.path.join(here, n) for n in LIBRARY_NAMES] + LIBRARY_NAMES
+    if not sys.platform.startswith('linux'):
+        # on linux, find_library runs ldconfig or gcc; the names above
+        # are what it would find
+        path = ctypes.util.find_library('secp256k1')
+        if path:
+            names.append(path)
+    for name in names:
+        try:
+            return ctypes.cdll.LoadLibrary(name)
+        except OSError:
+            continue
+    return None
+
+
+class LibSecp256k1Backend(object):
+
+    name = 'libsecp256k1'
+
+    def __init__(self, lib, python):
+        self.lib = lib
+        c_char_p, c_size_t, c_int, c_uint = ctypes.c_char_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_uint
+        ctx = ctypes.c_void_p
+        lib.secp256k1_context_create.argtypes = [c_uint]
+        lib.secp256k1_context_create.restype = ctypes.c_void_p
+        if hasattr(lib, 'secp256k1_context_randomize'):
+            lib.secp256k1_context_randomize.argtypes = [ctx, c_char_p]
+        lib.secp256k1_ec_pubkey_parse.argtypes = [ctx, c_char_p, c_char_p, c_size_t]
+        lib.secp256k1_ec_pubkey_serialize.argtypes = [ctx, c_char_p, ctypes.POINTER(c_size_t), c_char_p, c_uint]
+        lib.secp256k1_ec_pubkey_create.argtypes = [ctx, c_char_p, c_char_p]
+        lib.secp256k1_ecdsa_sign.argtypes = [ctx, c_char_p, c_char_p, c_char_p, ctypes.c_void_p, ctypes.c_void_p]
+        lib.secp256k1_ecdsa_signature_serialize_compact.argtypes = [ctx, c_char_p, c_char_p]
+        lib.secp256k1_ecdsa_signature_parse_compact.argtypes = [ctx, c_char_p, c_char_p]
+        lib.secp256k1_ecdsa_signature_normalize.argtypes = [ctx, c_char_p, c_char_p]
+        lib.secp256k1_ecdsa_verify.argtypes = [ctx, c_char_p, c_char_p, c_char_p]
+        lib.secp256k1_ec_pubkey_tweak_add.argtypes = [ctx, c_char_p, c_char_p]
+        lib.secp256k1_ec_pubkey_tweak_mul.argtypes = [ctx, c_char_p, c_char_p]
+        # the recovery module is optional
+        self.has_recovery = hasattr(lib, 'secp256k1_ecdsa_recover')
+        if self.has_recovery:
+            lib.secp256k1_ecdsa_recoverable_signature_parse_compact.argtypes = [ctx, c_char_p, c_char_p, c_int]
+            lib.secp256k1_ecdsa_recover.argtypes = [ctx, c_char_p, c_char_p, c_char_p]
+        self.ctx = lib.secp256k1_context_create(SECP256K1_CONTEXT_SIGN | SECP256K1_CONTEXT_VERIFY)
+        if not self.ctx:
+            raise Exception('cannot create secp256k1 context')
+        # protection against side channels
+        if hasattr(lib, 'secp256k1_context_randomize'):
+            if not lib.secp256k1_context_randomize(self.ctx, os.urandom(32)):
+                raise Exception('cannot randomize secp256k1 context')
+        # for what the library was built without
+        self.python = python
+
+    def parse_pubkey(self, pubkey):
+        p = ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ec_pubkey_parse(self.ctx, p, pubkey, len(pubkey)):
+            raise Exception('invalid pubkey')
+        return p
+
+    def serialize_pubkey(self, p, compressed=True):
+        n = 33 if compressed else 65
+        out = ctypes.create_string_buffer(n)
+        size = ctypes.c_size_t(n)
+        flags = SECP256K1_EC_COMPRESSED if compressed else SECP256K1_EC_UNCOMPRESSED
+        self.lib.secp256k1_ec_pubkey_serialize(self.ctx, out, ctypes.byref(size), p, flags)
+        return out.raw[:size.value]
+
+    def pubkey_from_secret(self, secret, compressed=True):
+        p = ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ec_pubkey_create(self.ctx, p, secret):
+            raise Exception('invalid secret')
+        return self.serialize_pubkey(p, compressed)
+
+    def sign(self, secret, msg_hash):
+        sig = ctypes.create_string_buffer(64)
+        # the default nonce function is RFC6979, and signatures are low S
+        if not self.lib.secp256k1_ecdsa_sign(self.ctx, sig, msg_hash, secret, None, None):
+            raise Exception('cannot sign')
+        out = ctypes.create_string_buffer(64)
+        self.lib.secp256k1_ecdsa_signature_serialize_compact(self.ctx, out, sig)
+        return out.raw
+
+    def verify(self, pubkey, sig, msg_hash):
+        s = ctypes.create_string_buffer(64)
+        if len(sig) != 64 or not self.lib.secp256k1_ecdsa_signature_parse_compact(self.ctx, s, sig):
+            return False
+        # libsecp256k1 only accepts low S; the ecdsa package accepts both
+        self.lib.secp256k1_ecdsa_signature_normalize(self.ctx, s, s)
+        try:
+            p = self.parse_pubkey(pubkey)
+        except Exception:
+            return False
+        return self.lib.secp256k1_ecdsa_verify(self.ctx, s, msg_hash, p) == 1
+
+    def recover(self, sig, recid, msg_hash, compressed=True):
+        if not self.has_recovery:
+            return self.python.recover(sig, recid, msg_hash, compressed)
+        s = ctypes.create_string_buffer(65)
+        if not self.lib.secp256k1_ecdsa_recoverable_signature_parse_compact(self.ctx, s, sig, recid):
+            raise Exception('invalid signature')
+        p = ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ecdsa_recover(self.ctx, p, s, msg_hash):
+            raise Exception('invalid signature')
+        return self.serialize_pubkey(p, compressed)
+
+    def pubkey_tweak_add(self, pubkey, tweak, compressed=True):
+        p = self.parse_pubkey(pubkey)
+        if not self.lib.secp256k1_ec_pubkey_tweak_add(self.ctx, p, tweak):
+            raise Exception('invalid tweak')
+        return self.serialize_pubkey(p, compressed)
+
+    def pubkey_tweak_add_many(self, pubkey, tweaks, compressed=True):
+        return [self.pubkey_tweak_add(pubkey, t, compressed) for t in tweaks]
+
+    def pubkey_tweak_mul(self, pubkey, tweak, compressed=True):
+        p = self.parse_pubkey(pubkey)
+        if not self.lib.secp256k1_ec_pubkey_tweak_mul(self.ctx, p, tweak):
+            raise Exception('invalid tweak')
+        return self.serialize_pubkey(p, compressed)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2017 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''Streaming export of the wallet history.
+
+Rows are produced by a generator and written one at a time, so the
+labels, formatted amounts and fiat values of the whole history are
+never held in memory together.
+'''
+
+import csv
+import json
+import time
+from collections import OrderedDict
+
+from i18n import _
+from util import format_satoshis, format_time, timestamp_to_datetime
+
+
+EXPORT_FORMATS = ['csv', 'json']
+
+# csv headers kept compatible with files exported by older versions
+CSV_HEADERS = {
+    'txid': 'transaction_hash',
+    'date': 'timestamp',
+}
+
+
+def history_columns(fx=None):
+    columns = ['txid', 'label', 'confirmations', 'value', 'date']
+    if fx:
+        columns += ['fiat_value', 'fiat_balance']
+    return columns
+
+
+def history_rows(wallet, history, fx=None):
+    '''Yield one row per item of history, as returned by
+    wallet.get_history().  If fx is passed, fiat columns are
+    added using historical exchange rates.'''
+    for item in history:
+        tx_hash, height, conf, timestamp, value, balance = item
+        if height > 0:
+            if timestamp is not None:
+                time_string = format_time(timestamp)
+            else:
+                time_string = _("unverified")
+        else:
+            time_string = _("unconfirmed")
+        row = OrderedDict()
+        row['txid'] = tx_hash
+        row['label'] = wallet.get_label(tx_hash) if tx_hash else ''
+        row['confirmations'] = conf
+        row['value'] = format_satoshis(value, True) if value is not None else '--'
+        row['date'] = time_string
+        if fx:
+            date = timestamp_to_datetime(time.time() if conf <= 0 else timestamp)
+            row['fiat_value'] = fx.historical_value_str(value, date)
+            row['fiat_balance'] = fx.historical_value_str(balance, date)
+        yield row
+
+
+def _csv_value(v):
+    return v.encode('utf-8') if isinstance(v, unicode) else v
+
+
+class CSVWriter(object):
+
+    def __init__(self, f, columns):
+        self.writer = csv.writer(f, lineterminator='\n')
+        self.writer.writerow([CSV_HEADERS.get(c, c) for c in columns])
+
+    def write(self, row):
+        self.writer.writerow([_csv_value(v) for v in row.values()])
+
+
+class JSONLinesWriter(object):
+
+    def __init__(self, f, columns):
+        self.f = f
+
+    def write(self, row):
+        self.f.write(json.dumps(row) + '\n')
+
+
+writers = {
+    'csv': CSVWriter,
+    'json': JSONLinesWriter,
+}
+
+
+def export_history(wallet, f, fmt='csv', fx=None, domain=None, callback=None, step=100):
+    '''Write the history of wallet to the file object f, either as csv
+    or as JSON lines.  callback(n, total) is called every step rows
+    and once at the end.  Returns the number of rows written.'''
+    if fmt not in writers:
+        raise BaseException("Unknown export format: %s" % fmt)
+    history = wallet.get_history(domain)
+    total = len(history)
+    writer = writers[fmt](f, history_columns(fx))
+    n = 0
+    for row in history_rows(wallet, history, fx):
+        writer.write(row)
+        n += 1
+        if callback and n % step == 0:
+            callback(n, total)
+    f.flush()
+    if callback:
+        callback(n, total)
+    return n
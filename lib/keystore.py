@@ -30,12 +30,14 @@ from unicodedata import normalize
 
 from version import *
 import bitcoin
+import ecc_backend
 from bitcoin import pw_encode, pw_decode, bip32_root, bip32_private_derivation, bip32_public_derivation, bip32_private_key, deserialize_xprv, deserialize_xpub
 from bitcoin import public_key_from_private_key, public_key_to_p2pkh
 from bitcoin import *
 
 from bitcoin import is_old_seed, is_new_seed, is_seed
 from util import PrintError, InvalidPassword
+from derivation import derive_branches
 from mnemonic import Mnemonic, load_wordlist
 
 
@@ -100,15 +102,30 @@ class Software_KeyStore(KeyStore):
         decrypted = ec.decrypt_message(message)
         return decrypted
 
+    def get_private_keys(self, sequences, password):
+        '''Private keys of a list of derivations, in the same order.'''
+        return [self.get_private_key(sequence, password) for sequence in sequences]
+
+    def get_tx_keypairs(self, txs, password):
+        '''For each transaction of txs, the dict of x_pubkey -> private key
+        of the inputs this keystore can sign.  The password is checked
+        once, and each private key is derived once for all of them.'''
+        # Raise if password is not correct.
+        self.check_password(password)
+        derivations = [self.get_tx_derivations(tx) for tx in txs]
+        # derivations are lists or pubkeys
+        key = lambda v: tuple(v) if type(v) is list else v
+        sequences = {}
+        for d in derivations:
+            for v in d.values():
+                sequences[key(v)] = v
+        keys = dict(zip(sequences.keys(), self.get_private_keys(sequences.values(), password)))
+        return [dict((x_pubkey, keys[key(v)]) for x_pubkey, v in d.items()) for d in derivations]
+
     def sign_transaction(self, tx, password):
         if self.is_watching_only():
             return
-        # Raise if password is not correct.
-        self.check_password(password)
-        # Add private keys
-        keypairs = self.get_tx_derivations(tx)
-        for k, v in keypairs.items():
-            keypairs[k] = self.get_private_key(v, password)
+        keypairs = self.get_tx_keypairs([tx], password)[0]
         # Sign
         if keypairs:
             tx.sign(keypairs)
@@ -228,11 +245,13 @@ class Xpub:
         self.xpub = None
         self.xpub_receive = None
         self.xpub_change = None
+        # decoded (cK, c) of the receiving and change branches
+        self.branch_keys = {}
 
     def get_master_public_key(self):
         return self.xpub
 
-    def derive_pubkey(self, for_change, n):
+    def get_branch_key(self, for_change):
         xpub = self.xpub_change if for_change else self.xpub_receive
         if xpub is None:
             xpub = bip32_public_derivation(self.xpub, "", "/%d"%for_change)
@@ -240,7 +259,17 @@ class Xpub:
                 self.xpub_change = xpub
             else:
                 self.xpub_receive = xpub
-        return self.get_pubkey_from_xpub(xpub, (n,))
+        key = self.branch_keys.get(for_change)
+        if key is None:
+            _, _, _, _, c, cK = deserialize_xpub(xpub)
+            key = self.branch_keys[for_change] = (cK, c)
+        return key
+
+    def derive_pubkey(self, for_change, n):
+        return self.derive_pubkey_batch(for_change, [n])[0]
+
+    def derive_pubkey_batch(self, for_change, sequence):
+        return derive_branches([self.get_branch_key(for_change)], sequence)[0]
 
     @classmethod
     def get_pubkey_from_xpub(self, xpub, sequence):
@@ -336,6 +365,23 @@ class BIP32_KeyStore(Deterministic_KeyStore, Xpub):
         pk = bip32_private_key(sequence, k, c)
         return pk
 
+    def get_private_keys(self, sequences, password):
+        # the master key is decrypted once, and the nodes shared by
+        # several derivations (branches) are derived once
+        xprv = self.get_master_private_key(password)
+        _, _, _, _, c, k = deserialize_xprv(xprv)
+        nodes = {(): (k, c)}
+        keys = []
+        for sequence in sequences:
+            path = ()
+            for i in sequence:
+                parent = nodes[path]
+                path += (i,)
+                if path not in nodes:
+                    nodes[path] = CKD_priv(parent[0], parent[1], i)
+            keys.append(SecretToASecret(nodes[path][0], True))
+        return keys
+
     def is_segwit(self):
         return bool(deserialize_xpub(self.xpub)[0])
 
@@ -386,8 +432,7 @@ class Old_KeyStore(Deterministic_KeyStore):
     @classmethod
     def mpk_from_seed(klass, seed):
         secexp = klass.stretch_key(seed)
-        master_private_key = ecdsa.SigningKey.from_secret_exponent(secexp, curve = SECP256k1)
-        master_public_key = master_private_key.get_verifying_key().to_string()
+        master_public_key = ecc_backend.get_backend().pubkey_from_secret(ecc_backend.scalar_to_bytes(secexp), False)[1:]
         return master_public_key.encode('hex')
 
     @classmethod
@@ -409,14 +454,15 @@ class Old_KeyStore(Deterministic_KeyStore):
     @classmethod
     def get_pubkey_from_mpk(self, mpk, for_change, n):
         z = self.get_sequence(mpk, for_change, n)
-        master_public_key = ecdsa.VerifyingKey.from_string(mpk.decode('hex'), curve = SECP256k1)
-        pubkey_point = master_public_key.pubkey.point + z*SECP256k1.generator
-        public_key2 = ecdsa.VerifyingKey.from_public_point(pubkey_point, curve = SECP256k1)
-        return '04' + public_key2.to_string().encode('hex')
+        pubkey = ecc_backend.get_backend().pubkey_tweak_add('\x04' + mpk.decode('hex'), ecc_backend.scalar_to_bytes(z), False)
+        return pubkey.encode('hex')
 
     def derive_pubkey(self, for_change, n):
         return self.get_pubkey_from_mpk(self.mpk, for_change, n)
 
+    def derive_pubkey_batch(self, for_change, sequence):
+        return [self.derive_pubkey(for_change, n) for n in sequence]
+
     def get_private_key_from_stretched_exponent(self, for_change, n, secexp):
         order = generator_secp256k1.order()
         secexp = (secexp + self.get_sequence(self.mpk, for_change, n)) % order
@@ -432,10 +478,16 @@ class Old_KeyStore(Deterministic_KeyStore):
         pk = self.get_private_key_from_stretched_exponent(for_change, n, secexp)
         return pk
 
+    def get_private_keys(self, sequences, password):
+        # the seed is stretched once
+        seed = self.get_hex_seed(password)
+        self.check_seed(seed)
+        secexp = self.stretch_key(seed)
+        return [self.get_private_key_from_stretched_exponent(for_change, n, secexp) for for_change, n in sequences]
+
     def check_seed(self, seed):
         secexp = self.stretch_key(seed)
-        master_private_key = ecdsa.SigningKey.from_secret_exponent( secexp, curve = SECP256k1 )
-        master_public_key = master_private_key.get_verifying_key().to_string()
+        master_public_key = ecc_backend.get_backend().pubkey_from_secret(ecc_backend.scalar_to_bytes(secexp), False)[1:]
         if master_public_key != self.mpk.decode('hex'):
             print_error('invalid password (mpk)', self.mpk, master_public_key.encode('hex'))
             raise InvalidPassword()
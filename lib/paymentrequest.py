@@ -64,10 +64,7 @@ def load_ca_list():
 
 
 # status of payment requests
-PR_UNPAID  = 0
-PR_EXPIRED = 1
-PR_UNKNOWN = 2     # sent but not propagated
-PR_PAID    = 3     # send and propagated
+from util import PR_UNPAID, PR_EXPIRED, PR_UNKNOWN, PR_PAID
 
 
 
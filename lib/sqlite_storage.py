@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2017 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''SQLite engine for WalletStorage.
+
+The large wallet dictionaries (transactions, txi/txo, history,
+verified transactions and labels) are stored one item per row in
+their own table; other keys are stored as JSON values in the 'data'
+table.  WalletStorage reports which keys and items were changed by
+put(), and only those rows are written, in a single transaction.
+'''
+
+import json
+import sqlite3
+
+
+SQLITE_MAGIC = 'SQLite format 3\x00'
+
+# storage key -> table.  Values of these keys are dicts; each item is a row.
+TABLES = {
+    'transactions': 'transactions',
+    'txi': 'txi',
+    'txo': 'txo',
+    'addr_history': 'history',
+    'verified_tx3': 'verified_tx',
+    'labels': 'labels',
+}
+
+# tables that are not loaded at startup; their items are read on demand
+# with get_item
+LAZY_KEYS = ['transactions']
+
+
+def is_sqlite_file(path):
+    with open(path, 'rb') as f:
+        return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+
+class SQLiteDB(object):
+
+    def __init__(self, path):
+        self.path = path
+        # writes are serialized by the WalletStorage lock
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS data (key TEXT PRIMARY KEY, value TEXT)')
+            for table in TABLES.values():
+                self.conn.execute('CREATE TABLE IF NOT EXISTS %s (k TEXT PRIMARY KEY, v TEXT NOT NULL)' % table)
+        # keys to rewrite entirely, and changed items of table keys
+        self.dirty_keys = set()
+        self.dirty_items = {}
+        # items of lazy keys written with put_item, not saved yet
+        self.pending_items = {}
+
+    def close(self):
+        self.conn.close()
+
+    def load(self):
+        data = {}
+        for key, value in self.conn.execute('SELECT key, value FROM data').fetchall():
+            if value is None and key in LAZY_KEYS:
+                continue
+            if value is None and key in TABLES:
+                rows = self.conn.execute('SELECT k, v FROM %s' % TABLES[key])
+                data[key] = dict((k, json.loads(v)) for k, v in rows)
+            else:
+                data[key] = json.loads(value)
+        return data
+
+    def mark(self, key, old, new):
+        '''Record the change of key from old to new (None if removed).'''
+        if key in self.dirty_keys:
+            return
+        if key in TABLES and isinstance(old, dict) and isinstance(new, dict):
+            items = self.dirty_items.setdefault(key, set())
+            for k, v in new.iteritems():
+                if old.get(k) != v:
+                    items.add(k)
+            items.update(k for k in old if k not in new)
+        else:
+            self.dirty_items.pop(key, None)
+            self.dirty_keys.add(key)
+
+    def item_keys(self, key):
+        keys = set(k for k, in self.conn.execute('SELECT k FROM %s' % TABLES[key]))
+        for k, v in self.pending_items.get(key, {}).iteritems():
+            if v is None:
+                keys.discard(k)
+            else:
+                keys.add(k)
+        return keys
+
+    def get_item(self, key, k):
+        pending = self.pending_items.get(key, {})
+        if k in pending:
+            return pending[k]
+        row = self.conn.execute('SELECT v FROM %s WHERE k = ?' % TABLES[key], (k,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_item(self, key, k, value):
+        self.pending_items.setdefault(key, {})[k] = value
+
+    def is_dirty(self):
+        return bool(self.dirty_keys or self.dirty_items or self.pending_items)
+
+    def save(self, data, full=False):
+        '''Write the pending changes of data in one transaction.
+        If full is set, all keys are written.'''
+        keys = set(data.keys()) if full else self.dirty_keys
+        with self.conn:
+            for key in keys:
+                self._write_key(key, data.get(key))
+            for key, items in self.dirty_items.iteritems():
+                if key in keys:
+                    continue
+                d = data[key]
+                table = TABLES[key]
+                self.conn.executemany('INSERT OR REPLACE INTO %s VALUES (?, ?)' % table,
+                                      [(k, json.dumps(d[k])) for k in items if k in d])
+                self.conn.executemany('DELETE FROM %s WHERE k = ?' % table,
+                                      [(k,) for k in items if k not in d])
+            for key, items in self.pending_items.iteritems():
+                table = TABLES[key]
+                self.conn.execute('INSERT OR REPLACE INTO data VALUES (?, NULL)', (key,))
+                self.conn.executemany('INSERT OR REPLACE INTO %s VALUES (?, ?)' % table,
+                                      [(k, json.dumps(v)) for k, v in items.iteritems() if v is not None])
+                self.conn.executemany('DELETE FROM %s WHERE k = ?' % table,
+                                      [(k,) for k, v in items.iteritems() if v is None])
+        self.dirty_keys = set()
+        self.dirty_items = {}
+        self.pending_items = {}
+
+    def _write_key(self, key, value):
+        if key in TABLES:
+            self.conn.execute('DELETE FROM %s' % TABLES[key])
+        if value is None:
+            self.conn.execute('DELETE FROM data WHERE key = ?', (key,))
+        elif key in TABLES and isinstance(value, dict):
+            self.conn.execute('INSERT OR REPLACE INTO data VALUES (?, NULL)', (key,))
+            self.conn.executemany('INSERT INTO %s VALUES (?, ?)' % TABLES[key],
+                                  [(k, json.dumps(v)) for k, v in value.iteritems()])
+        else:
+            self.conn.execute('INSERT OR REPLACE INTO data VALUES (?, ?)', (key, json.dumps(value)))
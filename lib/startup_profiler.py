@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2017 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''Startup profiler, enabled with --profile-startup.
+
+Times the first import of every module, and the initialization phases
+marked by the caller, and prints them to stderr at exit.  The time of
+an import excludes the modules it imports.'''
+
+import sys
+import time
+import atexit
+import __builtin__
+
+
+class StartupProfiler(object):
+
+    def __init__(self):
+        self.t0 = time.time()
+        self.last_mark = self.t0
+        # module -> (self time, total time)
+        self.imports = {}
+        # (phase, time)
+        self.phases = []
+        # time spent in the imports made by the import being run
+        self.stack = []
+        self.orig_import = None
+
+    def start(self):
+        self.orig_import = __builtin__.__import__
+        __builtin__.__import__ = self.timed_import
+        atexit.register(self.report)
+
+    def stop(self):
+        if self.orig_import:
+            __builtin__.__import__ = self.orig_import
+            self.orig_import = None
+
+    def timed_import(self, name, *args, **kwargs):
+        before = set(sys.modules)
+        self.stack.append(0.)
+        t = time.time()
+        try:
+            return self.orig_import(name, *args, **kwargs)
+        finally:
+            dt = time.time() - t
+            children = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += dt
+            new = [m for m in set(sys.modules) - before if sys.modules[m] is not None]
+            if new:
+                self.record(name, new, dt - children, dt)
+
+    def record(self, name, new, self_time, total):
+        # implicit relative imports are registered under the package
+        if name not in new:
+            names = [m for m in new if m.endswith('.' + name)]
+            name = names[0] if names else min(new, key=len)
+        if name in self.imports:
+            s, t = self.imports[name]
+            self_time, total = s + self_time, t + total
+        self.imports[name] = (self_time, total)
+
+    def mark(self, phase):
+        '''Record the time since the previous mark.'''
+        now = time.time()
+        self.phases.append((phase, now - self.last_mark))
+        self.last_mark = now
+
+    def report(self, limit=30):
+        self.stop()
+        out = sys.stderr
+        total = time.time() - self.t0
+        out.write("startup profile: %.3fs since start\n" % total)
+        out.write("%-8s %-8s %s\n" % ('self', 'total', 'import'))
+        rows = sorted(self.imports.items(), key=lambda x: -x[1][0])
+        for name, (self_time, t) in rows[:limit]:
+            out.write("%.3f    %.3f    %s\n" % (self_time, t, name))
+        out.write("%d modules imported in %.3fs\n" % (len(rows), sum(x[0] for _, x in rows)))
+        for phase, t in self.phases:
+            out.write("%.3f    %s\n" % (t, phase))
@@ -32,8 +32,7 @@ import json
 import copy
 import re
 import stat
-import pbkdf2, hmac, hashlib
-import base64
+import hashlib
 import zlib
 
 from i18n import _
@@ -41,6 +40,11 @@ from util import NotEnoughFunds, PrintError, profiler
 from plugins import run_hook, plugin_loaders
 from keystore import bip44_derivation
 import bitcoin
+from sqlite_storage import SQLiteDB, is_sqlite_file, LAZY_KEYS
+from storage_journal import Journal
+from compact_maps import pack_data, unpack_data
+from storage_crypto import StorageCipher, derive_secret, get_magic, MAGIC_V1, MAGIC_V3
+from storage_writer import StorageWriter
 
 
 # seed_version is now used for the version of the wallet file
@@ -66,19 +70,37 @@ class WalletStorage(PrintError):
     def __init__(self, path):
         self.print_error("wallet path", path)
         self.lock = threading.RLock()
+        # serializes writes of the file; taken before self.lock
+        self.write_lock = threading.RLock()
+        self.writer = StorageWriter(self)
         self.data = {}
+        self.raw = ''
         self.path = path
         self.modified = False
         self.pubkey = None
+        # encryption session, set if the file is encrypted
+        self.cipher = None
+        # (password hash, EC_KEY) of the last password used
+        self.cached_key = None
+        # SQLite engine, if the wallet file is an SQLite database
+        self.db = None
+        # append-only journal, if enabled for a JSON wallet file
+        self.journal = None
         if self.file_exists():
+            if is_sqlite_file(self.path):
+                self.db = SQLiteDB(self.path)
+                self.data = self.db.load()
+                self.load_plugin()
+                return
             with open(self.path, "r") as f:
                 self.raw = f.read()
             if not self.is_encrypted():
                 self.load_data(self.raw)
+                self.open_journal()
 
     def load_data(self, s):
         try:
-            self.data = json.loads(s)
+            self.data = unpack_data(json.loads(s))
         except:
             try:
                 d = ast.literal_eval(s)
@@ -100,39 +122,62 @@ class WalletStorage(PrintError):
                     self.print_error('Failed to convert label to json format', key)
                     continue
                 self.data[key] = value
+        self.load_plugin()
 
+    def load_plugin(self):
         # check here if I need to load a plugin
         t = self.get('wallet_type')
         l = plugin_loaders.get(t)
         if l: l()
 
     def is_encrypted(self):
-        try:
-            return base64.b64decode(self.raw).startswith('BIE1')
-        except:
-            return False
+        return get_magic(self.raw) in [MAGIC_V1, MAGIC_V3]
 
     def file_exists(self):
         return self.path and os.path.exists(self.path)
 
     def get_key(self, password):
-        secret = pbkdf2.PBKDF2(password, '', iterations = 1024, macmodule = hmac, digestmodule = hashlib.sha512).read(64)
-        ec_key = bitcoin.EC_KEY(secret)
+        # key stretching and the EC public key cost as much as the
+        # decryption of a small wallet: do them once per session
+        pw_hash = hashlib.sha256(password.encode('utf-8') if isinstance(password, unicode) else password).digest()
+        if self.cached_key and self.cached_key[0] == pw_hash:
+            return self.cached_key[1]
+        ec_key = bitcoin.EC_KEY(derive_secret(password))
+        self.cached_key = (pw_hash, ec_key)
         return ec_key
 
     def decrypt(self, password):
         ec_key = self.get_key(password)
-        s = zlib.decompress(ec_key.decrypt_message(self.raw)) if self.raw else None
-        self.pubkey = ec_key.get_public_key()
+        cipher = StorageCipher(ec_key.get_public_key(), ec_key)
+        s = zlib.decompress(cipher.decrypt(self.raw)) if self.raw else None
+        self.pubkey = cipher.pubkey
+        self.cipher = cipher
         self.load_data(s)
+        self.open_journal()
+
+    def open_journal(self):
+        if not self.data.get('use_journal'):
+            return
+        self.journal = Journal(self.path, self.data.get('journal_generation', 0))
+        n = self.journal.replay(self.data, self.cipher)
+        self.print_error("replayed %d journal records" % n)
 
     def set_password(self, password, encrypt):
+        if encrypt and password and self.db:
+            raise BaseException(_("SQLite wallet files cannot be encrypted"))
         self.put('use_encryption', bool(password))
         if encrypt and password:
             ec_key = self.get_key(password)
             self.pubkey = ec_key.get_public_key()
+            if self.cipher is None or self.cipher.pubkey != self.pubkey:
+                self.cipher = StorageCipher(self.pubkey, ec_key)
         else:
             self.pubkey = None
+            self.cipher = None
+        if self.journal:
+            # records are encrypted with the key of the wallet file
+            self.journal.compact_next = True
+            self.modified = True
 
     def get(self, key, default=None):
         with self.lock:
@@ -143,6 +188,13 @@ class WalletStorage(PrintError):
                 v = copy.deepcopy(v)
         return v
 
+    def borrow(self, key, default=None):
+        '''Like get, without a copy: the caller must not modify the
+        returned value, which is owned by the storage.'''
+        with self.lock:
+            v = self.data.get(key)
+        return default if v is None else v
+
     def put(self, key, value):
         try:
             json.dumps(key)
@@ -151,31 +203,143 @@ class WalletStorage(PrintError):
             self.print_error("json error: cannot save", key)
             return
         with self.lock:
+            if value is not None and self.data.get(key) == value:
+                return
+            self.move(key, copy.deepcopy(value))
+
+    def move(self, key, value):
+        '''Like put, without a copy: ownership of value is passed to the
+        storage, and the caller must not modify it afterwards.  value
+        must be serializable to JSON.'''
+        with self.lock:
+            old = self.data.get(key)
             if value is not None:
-                if self.data.get(key) != value:
+                if old != value:
                     self.modified = True
-                    self.data[key] = copy.deepcopy(value)
+                    self.data[key] = value
+                    if self.db:
+                        self.db.mark(key, old, value)
+                    if self.journal:
+                        self.journal.mark(key, old, value)
             elif key in self.data:
                 self.modified = True
                 self.data.pop(key)
+                if self.db:
+                    self.db.mark(key, old, None)
+                if self.journal:
+                    self.journal.mark(key, old, None)
+
+    def item_keys(self, key):
+        '''Return the set of keys of the dict stored at key.  With the
+        SQLite engine, the items of large tables are not loaded in
+        memory, and must be accessed with get_item and put_item.'''
+        with self.lock:
+            if self.db and key in LAZY_KEYS:
+                return self.db.item_keys(key)
+            return set(self.data.get(key, {}).keys())
+
+    def get_item(self, key, k):
+        with self.lock:
+            if self.db and key in LAZY_KEYS:
+                return self.db.get_item(key, k)
+            return self.data.get(key, {}).get(k)
+
+    def put_item(self, key, k, value):
+        '''Set item k of the dict stored at key.  value is owned by
+        the storage, like with move.  None removes the item.'''
+        with self.lock:
+            if self.db and key in LAZY_KEYS:
+                self.db.put_item(key, k, value)
+                self.modified = True
+                return
+            d = self.data.setdefault(key, {})
+            if d.get(k) == value:
+                return
+            if value is None:
+                d.pop(k)
+            else:
+                d[k] = value
+            self.modified = True
+            if self.db:
+                self.db.mark(key, {}, {k: value})
+            if self.journal:
+                self.journal.mark_item(key, k)
 
     @profiler
     def write(self):
         # this ensures that previous versions of electrum won't open the wallet
         self.put('seed_version', FINAL_SEED_VERSION)
-        with self.lock:
+        with self.write_lock:
+            self._write()
+
+    def write_later(self, callback=None):
+        '''Write on the writer thread, within a few seconds.  Requests
+        are coalesced.  callback is called on the writer thread before
+        the write, e.g. to put the latest state of the wallet.'''
+        self.writer.request(callback)
+
+    def flush(self):
+        '''Wait for the pending background write, if any.'''
+        self.writer.flush()
+
+    def get_write_stats(self):
+        return self.writer.get_stats()
+
+    def compact(self):
+        '''Fold the journal into the wallet file.'''
+        if not self.journal:
+            return
+        with self.write_lock:
+            with self.lock:
+                if not self.journal.is_empty() or self.journal.compact_next:
+                    self.journal.compact_next = True
+                    self.modified = True
             self._write()
 
     def _write(self):
         if threading.currentThread().isDaemon():
             self.print_error('warning: daemon thread cannot write wallet')
             return
-        if not self.modified:
-            return
-        s = json.dumps(self.data, indent=4, sort_keys=True)
-        if self.pubkey:
-            s = bitcoin.encrypt_message(zlib.compress(s), self.pubkey)
+        # serialize under the lock, but encrypt and write without it,
+        # so that readers of the storage are not blocked by the disk
+        with self.lock:
+            if not self.modified:
+                return
+            generation = None
+            if self.db:
+                self.db.save(self.data)
+                self.print_error("saved", self.path)
+                self.modified = False
+                return
+            if self.journal:
+                if not self.journal.needs_compaction(self.path):
+                    n = self.journal.save(self.data, self.cipher)
+                    self.print_error("saved %d records to journal" % n)
+                    self.modified = False
+                    return
+                # not a put(): this key is never journaled
+                generation = self.data['journal_generation'] = self.journal.generation + 1
+                # changes made from now on go to the new journal
+                self.journal.clear()
+            data = pack_data(self.data) if self.data.get('use_compact_maps') else self.data
+            s = json.dumps(data, indent=4, sort_keys=True)
+            cipher = self.cipher
+            self.modified = False
+        try:
+            if cipher:
+                s = cipher.encrypt(zlib.compress(s))
+            self._write_file(s)
+            if generation is not None:
+                self.journal.reset(generation)
+        except:
+            with self.lock:
+                self.modified = True
+                if self.journal:
+                    self.journal.compact_next = True
+            raise
+        self.print_error("saved", self.path)
 
+    def _write_file(self, s):
         temp_path = "%s.tmp.%s" % (self.path, os.getpid())
         with open(temp_path, "w") as f:
             f.write(s)
@@ -190,8 +354,57 @@ class WalletStorage(PrintError):
             os.remove(self.path)
             os.rename(temp_path, self.path)
         os.chmod(self.path, mode)
-        self.print_error("saved", self.path)
-        self.modified = False
+
+    def enable_journal(self):
+        '''Save changes to an append-only journal, which is folded into
+        the wallet file when it grows larger than the file.'''
+        if self.db:
+            raise BaseException(_("SQLite wallet files do not use a journal"))
+        with self.write_lock, self.lock:
+            if self.journal:
+                return
+            self.put('use_journal', True)
+            self.journal = Journal(self.path, self.data.get('journal_generation', 0))
+            # the wallet file must record use_journal before anything is journaled
+            self.journal.compact_next = True
+            self.compact()
+
+    def enable_compact_maps(self):
+        '''Store the transaction and history maps as a compact binary
+        blob.  Older versions of Electrum cannot read the maps of such
+        files, and will have to synchronize the wallet again.'''
+        if self.db:
+            raise BaseException(_("SQLite wallet files do not use compact maps"))
+        self.put('use_compact_maps', True)
+        self.write()
+
+    def convert_to_sqlite(self):
+        '''Convert the wallet file to the SQLite format.  The JSON file
+        is kept, with a .json extension.  Returns the path of the copy.'''
+        if self.db:
+            raise BaseException(_("Wallet file is already in SQLite format"))
+        if self.journal:
+            raise BaseException(_("Wallet file uses a journal"))
+        if self.pubkey or (self.file_exists() and self.is_encrypted()):
+            raise BaseException(_("Encrypted wallet files cannot be converted. Disable file encryption first."))
+        with self.write_lock, self.lock:
+            temp_path = "%s.tmp.%s" % (self.path, os.getpid())
+            db = SQLiteDB(temp_path)
+            db.save(self.data, full=True)
+            db.close()
+            json_path = self.path + '.json'
+            mode = os.stat(self.path).st_mode if os.path.exists(self.path) else stat.S_IREAD | stat.S_IWRITE
+            os.chmod(temp_path, mode)
+            if os.path.exists(self.path):
+                os.rename(self.path, json_path)
+            os.rename(temp_path, self.path)
+            self.db = SQLiteDB(self.path)
+            # read from the database from now on
+            for key in LAZY_KEYS:
+                self.data.pop(key, None)
+            self.modified = False
+        self.print_error("converted to sqlite", self.path)
+        return json_path
 
     def requires_split(self):
         d = self.get('accounts', {})
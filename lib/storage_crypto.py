@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2017 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''Encryption of wallet files.
+
+BIE1 files are encrypted with ECIES (bitcoin.EC_KEY.encrypt_message):
+an ephemeral key and an ECDH exchange per message, and AES-CBC, which
+is pure Python unless pycryptodomex is installed.
+
+BIE3 files keep the ECIES key exchange, but only once per session:
+the keys derived from it are reused for every save, with a fresh
+nonce.  The payload is encrypted with AES-256 in counter mode, starting
+at the nonce, and authenticated with HMAC-SHA256.
+
+    'BIE3' | ephemeral pubkey (33) | nonce (16) | ciphertext | mac (32)
+
+Both formats are read; BIE3 is written.
+'''
+
+import os
+import hmac
+import base64
+import hashlib
+
+import ecdsa
+import pbkdf2
+import pyaes
+
+import bitcoin
+import ecc_backend
+from bitcoin import EC_KEY, generator_secp256k1, number_to_string
+from util import InvalidPassword
+
+
+MAGIC_V1 = 'BIE1'
+MAGIC_V3 = 'BIE3'
+
+
+def derive_secret(password):
+    '''Stretch password to the 64-byte secret of the wallet file key.'''
+    if isinstance(password, unicode):
+        password = password.encode('utf-8')
+    if hasattr(hashlib, 'pbkdf2_hmac'):
+        return hashlib.pbkdf2_hmac('sha512', password, '', 1024, 64)
+    return pbkdf2.PBKDF2(password, '', iterations = 1024, macmodule = hmac, digestmodule = hashlib.sha512).read(64)
+
+
+def get_magic(raw):
+    try:
+        return base64.b64decode(raw[:8])[:4]
+    except:
+        return None
+
+
+def aes_ctr_xor(key, nonce, data):
+    '''Encrypt or decrypt data with AES-256 in counter mode.  nonce is
+    the initial value of the 128-bit big-endian counter.'''
+    if bitcoin.AES:
+        cipher = bitcoin.AES.new(key, bitcoin.AES.MODE_CTR, nonce='', initial_value=nonce)
+        return cipher.encrypt(data)
+    counter = pyaes.Counter(long(nonce.encode('hex'), 16))
+    return pyaes.AESModeOfOperationCTR(key, counter=counter).encrypt(data)
+
+
+def derive_keys(ecdh_key):
+    key = hashlib.sha512(ecdh_key).digest()
+    return key[0:32], key[32:64]
+
+
+class StorageCipher(object):
+    '''Encryption session for a wallet file.  pubkey is the hex public
+    key of the file; ec_key, if known, allows decryption.'''
+
+    def __init__(self, pubkey, ec_key=None):
+        self.pubkey = pubkey
+        self.ec_key = ec_key
+        # (ephemeral pubkey, key_e, key_m) used for encryption
+        self.session = None
+        # ephemeral pubkey -> (key_e, key_m), for decryption
+        self.keys = {}
+
+    def get_session(self):
+        if self.session is None:
+            exponent = number_to_string(ecdsa.util.randrange(pow(2,256)), generator_secp256k1.order())
+            ephemeral = EC_KEY(exponent)
+            # raises if the pubkey is invalid
+            ecdh_key = ecc_backend.get_backend().pubkey_tweak_mul(self.pubkey.decode('hex'), ephemeral.secret_bytes)
+            key_e, key_m = derive_keys(ecdh_key)
+            ephemeral_pubkey = ephemeral.get_public_key(compressed=True).decode('hex')
+            self.session = (ephemeral_pubkey, key_e, key_m)
+        return self.session
+
+    def encrypt(self, message):
+        ephemeral_pubkey, key_e, key_m = self.get_session()
+        nonce = os.urandom(16)
+        encrypted = MAGIC_V3 + ephemeral_pubkey + nonce + aes_ctr_xor(key_e, nonce, message)
+        mac = hmac.new(key_m, encrypted, hashlib.sha256).digest()
+        return base64.b64encode(encrypted + mac)
+
+    def decrypt(self, raw):
+        if self.ec_key is None:
+            raise InvalidPassword()
+        magic = get_magic(raw)
+        if magic == MAGIC_V1:
+            return self.ec_key.decrypt_message(raw)
+        if magic != MAGIC_V3:
+            raise Exception('invalid ciphertext: invalid magic bytes')
+        encrypted = base64.b64decode(raw)
+        if len(encrypted) < 85:
+            raise Exception('invalid ciphertext: length')
+        ephemeral_pubkey = encrypted[4:37]
+        nonce = encrypted[37:53]
+        ciphertext = encrypted[53:-32]
+        mac = encrypted[-32:]
+        keys = self.keys.get(ephemeral_pubkey)
+        if keys is None:
+            try:
+                ecdh_key = ecc_backend.get_backend().pubkey_tweak_mul(ephemeral_pubkey, self.ec_key.secret_bytes)
+            except Exception:
+                raise Exception('invalid ciphertext: invalid ephemeral pubkey')
+            keys = derive_keys(ecdh_key)
+            self.keys[ephemeral_pubkey] = keys
+            # the exchange gives the same keys to both sides: keep
+            # using them to save the file
+            if self.session is None:
+                self.session = (ephemeral_pubkey,) + keys
+        key_e, key_m = keys
+        if not hmac.compare_digest(mac, hmac.new(key_m, encrypted[:-32], hashlib.sha256).digest()):
+            raise InvalidPassword()
+        return aes_ctr_xor(key_e, nonce, ciphertext)
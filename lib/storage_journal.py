@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2017 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''Append-only journal for JSON wallet files.
+
+In journal mode, write() appends the changes made since the last write
+to <wallet>.journal and fsyncs it; the wallet file itself is only
+rewritten when the journal is compacted.  Loading replays the journal
+over the wallet file.
+
+The first line of the journal holds its generation.  Compaction writes
+the wallet file with a new generation before resetting the journal, so
+a journal left over by an interrupted compaction is recognized as
+stale and ignored.
+
+Records are JSON lists, one per line:
+    ["s", key, value]            set key
+    ["d", key]                   delete key
+    ["u", key, items, removed]   update items of a dict value
+If the wallet file is encrypted, each record is compressed and
+encrypted separately, with the StorageCipher of the file.
+'''
+
+import os
+import stat
+import json
+import zlib
+
+from util import print_error
+
+
+# the journal is compacted once it is larger than the wallet file,
+# and at least this size
+COMPACT_MIN_SIZE = 1024 * 1024
+
+
+class Journal(object):
+
+    def __init__(self, wallet_path, generation):
+        self.path = wallet_path + '.journal'
+        self.generation = generation
+        # set when the journal must be folded into the wallet file
+        # before anything is appended
+        self.compact_next = False
+        self.dirty_keys = set()
+        self.dirty_items = {}
+
+    def replay(self, data, cipher=None):
+        '''Apply the records of the journal to data.'''
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, 'r') as f:
+            lines = f.read().split('\n')
+        # a complete journal ends with a newline
+        if lines[-1] != '':
+            print_error("[journal] ignoring incomplete record")
+            self.compact_next = True
+        lines = lines[:-1]
+        if not lines or json.loads(lines[0]).get('generation') != self.generation:
+            print_error("[journal] ignoring stale journal", self.path)
+            self.compact_next = True
+            return 0
+        for line in lines[1:]:
+            if cipher:
+                line = zlib.decompress(cipher.decrypt(line))
+            self.apply(data, json.loads(line))
+        return len(lines) - 1
+
+    def apply(self, data, record):
+        op, key = record[0], record[1]
+        if op == 's':
+            data[key] = record[2]
+        elif op == 'd':
+            data.pop(key, None)
+        elif op == 'u':
+            d = data.setdefault(key, {})
+            d.update(record[2])
+            for k in record[3]:
+                d.pop(k, None)
+        else:
+            raise IOError("Unknown journal record: %s" % op)
+
+    def mark(self, key, old, new):
+        '''Record the change of key from old to new (None if removed).'''
+        if key in self.dirty_keys:
+            return
+        if isinstance(old, dict) and isinstance(new, dict):
+            items = self.dirty_items.setdefault(key, set())
+            for k, v in new.iteritems():
+                if old.get(k) != v:
+                    items.add(k)
+            items.update(k for k in old if k not in new)
+        else:
+            self.dirty_items.pop(key, None)
+            self.dirty_keys.add(key)
+
+    def mark_item(self, key, k):
+        if key not in self.dirty_keys:
+            self.dirty_items.setdefault(key, set()).add(k)
+
+    def needs_compaction(self, wallet_path):
+        if self.compact_next:
+            return True
+        if not os.path.exists(self.path):
+            return False
+        size = os.path.getsize(self.path)
+        base_size = os.path.getsize(wallet_path) if os.path.exists(wallet_path) else 0
+        return size > max(COMPACT_MIN_SIZE, base_size)
+
+    def is_empty(self):
+        return not os.path.exists(self.path) or os.path.getsize(self.path) <= len(self.header())
+
+    def records(self, data):
+        for key in self.dirty_keys:
+            if key in data:
+                yield ['s', key, data[key]]
+            else:
+                yield ['d', key]
+        for key, items in self.dirty_items.iteritems():
+            if key in self.dirty_keys:
+                continue
+            d = data[key]
+            updated = dict((k, d[k]) for k in items if k in d)
+            removed = [k for k in items if k not in d]
+            yield ['u', key, updated, removed]
+
+    def save(self, data, cipher=None):
+        '''Append the pending changes of data, and fsync.'''
+        lines = []
+        for record in self.records(data):
+            s = json.dumps(record, separators=(',', ':'))
+            if cipher:
+                s = cipher.encrypt(zlib.compress(s))
+            lines.append(s + '\n')
+        if not os.path.exists(self.path):
+            lines.insert(0, self.header())
+        with open(self.path, 'a') as f:
+            os.chmod(self.path, stat.S_IREAD | stat.S_IWRITE)
+            f.write(''.join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        self.dirty_keys = set()
+        self.dirty_items = {}
+        return len(lines)
+
+    def header(self):
+        return json.dumps({'generation': self.generation}) + '\n'
+
+    def clear(self):
+        '''Forget the pending changes, which are being written to the
+        wallet file.'''
+        self.compact_next = False
+        self.dirty_keys = set()
+        self.dirty_items = {}
+
+    def reset(self, generation):
+        '''Start an empty journal, once the wallet file has been written
+        with the given generation.'''
+        self.generation = generation
+        temp_path = "%s.tmp.%s" % (self.path, os.getpid())
+        with open(temp_path, 'w') as f:
+            f.write(self.header())
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp_path, stat.S_IREAD | stat.S_IWRITE)
+        os.rename(temp_path, self.path)
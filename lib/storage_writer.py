@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2017 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''Background writes of wallet files.
+
+WalletStorage.write_later() hands the write to a StorageWriter, which
+runs it on its own thread, at most WRITE_DELAY seconds after the first
+pending request.  Requests made in the meantime are coalesced into the
+same write.
+
+The thread is not a daemon thread, and only runs while writes are
+pending: the interpreter waits for it at exit, so requested writes are
+never lost, and an idle wallet costs no thread.
+'''
+
+import os
+import sys
+import time
+import threading
+import traceback
+
+from util import PrintError
+
+
+WRITE_DELAY = 2.0
+
+
+class StorageWriter(PrintError):
+
+    def __init__(self, storage, delay=WRITE_DELAY):
+        self.storage = storage
+        self.delay = delay
+        self.cond = threading.Condition()
+        self.thread = None
+        # time of the first pending request, None if nothing is pending
+        self.requested = None
+        self.pending_requests = 0
+        # functions called on the writer thread before the write
+        self.callbacks = []
+        self.flushing = False
+        # stats
+        self.writes = 0
+        self.coalesced = 0
+        self.last_saved = None
+        self.last_duration = None
+        self.last_error = None
+
+    def diagnostic_name(self):
+        return 'writer %s' % os.path.basename(self.storage.path or '')
+
+    def request(self, callback=None):
+        '''Schedule a write.  callback, if set, is called on the writer
+        thread before the write, once per write.'''
+        with self.cond:
+            if self.requested is None:
+                self.requested = time.time()
+            self.pending_requests += 1
+            if callback is not None and callback not in self.callbacks:
+                self.callbacks.append(callback)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='StorageWriter')
+                self.thread.daemon = False
+                self.thread.start()
+
+    def run(self):
+        while True:
+            with self.cond:
+                if self.requested is None:
+                    self.thread = None
+                    self.flushing = False
+                    self.cond.notify_all()
+                    return
+                remaining = self.requested + self.delay - time.time()
+                if remaining > 0 and not self.flushing:
+                    self.cond.wait(remaining)
+                    continue
+                self.requested = None
+                self.coalesced += self.pending_requests - 1
+                self.pending_requests = 0
+                callbacks, self.callbacks = self.callbacks, []
+            self.write(callbacks)
+
+    def write(self, callbacks):
+        t0 = time.time()
+        try:
+            for callback in callbacks:
+                callback()
+            self.storage.write()
+            error = None
+        except BaseException as e:
+            # the storage stays modified: the next write retries
+            traceback.print_exc(file=sys.stderr)
+            error = str(e)
+        with self.cond:
+            self.writes += 1
+            self.last_duration = time.time() - t0
+            self.last_error = error
+            if error is None:
+                self.last_saved = time.time()
+
+    def flush(self):
+        '''Run the pending write now, and wait for it.'''
+        if threading.current_thread() is self.thread:
+            return
+        with self.cond:
+            if self.thread is None:
+                return
+            self.flushing = True
+            self.cond.notify_all()
+            while self.thread is not None:
+                self.cond.wait()
+
+    def is_pending(self):
+        with self.cond:
+            return self.requested is not None
+
+    def get_stats(self):
+        with self.cond:
+            return {
+                'pending': self.requested is not None,
+                'pending_requests': self.pending_requests,
+                'writes': self.writes,
+                'coalesced': self.coalesced,
+                'last_saved': self.last_saved,
+                'last_duration': self.last_duration,
+                'last_error': self.last_error,
+            }
@@ -157,7 +157,7 @@ class Synchronizer(ThreadJob):
         # "hist" is a list of [tx_hash, tx_height] lists
         missing = set()
         for tx_hash, tx_height in hist:
-            if self.wallet.transactions.get(tx_hash) is None:
+            if tx_hash not in self.wallet.transactions:
                 missing.add((tx_hash, tx_height))
         missing -= self.requested_tx
         if missing:
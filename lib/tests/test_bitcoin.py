@@ -7,7 +7,10 @@ from lib.bitcoin import (
     bip32_root, bip32_public_derivation, bip32_private_derivation, pw_encode,
     pw_decode, Hash, public_key_from_private_key, address_from_private_key,
     is_valid, is_private_key, xpub_from_xprv, is_new_seed, is_old_seed,
-    var_int, op_push)
+    var_int, op_push, deserialize_xpub, CKD_pub, CKD_pub_batch, base_encode,
+    base_decode, EncodeBase58Check, DecodeBase58Check, hash160_to_p2pkh,
+    bc_address_to_hash_160, ADDRTYPE_P2PKH, is_address)
+from lib.util import LRUCache
 
 try:
     import ecdsa
@@ -75,6 +78,13 @@ class Test_bitcoin(unittest.TestCase):
 
         return xpub, xprv
 
+    def test_CKD_pub_batch(self):
+        xpub = "xpub6H1LXWLaKsWFhvm6RVpEL9P4KfRZSW7abD2ttkWP3SSQvnyA8FSVqNTEcYFgJS2UaFcxupHiYkro49S8yGasTvXEYBVPamhGW6cFJodrTHy"
+        _, _, _, _, c, cK = deserialize_xpub(xpub)
+        sequence = [0, 1, 7, 1000]
+        batch = CKD_pub_batch(cK, c, sequence)
+        self.assertEqual([CKD_pub(cK, c, n)[0] for n in sequence], batch)
+
     def test_aes_homomorphic(self):
         """Make sure AES is homomorphic."""
         payload = u'\u66f4\u7a33\u5b9a\u7684\u4ea4\u6613\u5e73\u53f0'
@@ -149,6 +159,49 @@ class Test_bitcoin(unittest.TestCase):
         self.assertEqual(op_push(0x10000), '4e00000100')
         self.assertEqual(op_push(0x12345678), '4e78563412')
 
+    def test_base58(self):
+        self.assertEqual(base_encode('', base=58), '1')
+        self.assertEqual(base_encode('\0\0\x01', base=58), '112')
+        self.assertEqual(base_decode('112', None, base=58), '\0\0\x01')
+        self.assertEqual(base_encode('hello world', base=58), 'StV1DL6CwTryKyV')
+        self.assertEqual(EncodeBase58Check('\0' * 21), '1111111111111111111114oLvT2')
+        for v in ['\x01', '\xff' * 100, '\0\0' + 'abc' * 50]:
+            self.assertEqual(base_decode(base_encode(v, base=58), len(v), base=58), v)
+            self.assertEqual(base_decode(base_encode(v, base=43), len(v), base=43), v)
+        self.assertEqual(base_decode('StV1DL6CwTryKyV', 5, base=58), None)
+        self.assertEqual(DecodeBase58Check('1111111111111111111114oLvT3'), None)
+        with self.assertRaises(ValueError):
+            base_decode('0OIl', None, base=58)
+        self.assertEqual(DecodeBase58Check('0OIl'), None)
+
+    def test_not_base58(self):
+        addr = hash160_to_p2pkh('\x42' * 20)
+        for text in ['hello world', '0OIl', addr.lower(), u'caf\xe9', '']:
+            self.assertFalse(is_address(text))
+            self.assertFalse(is_private_key(text))
+
+    def test_address_cache(self):
+        h = '\x42' * 20
+        addr = hash160_to_p2pkh(h)
+        self.assertEqual(hash160_to_p2pkh(h), addr)
+        self.assertEqual(bc_address_to_hash_160(addr), (ADDRTYPE_P2PKH, h))
+        with self.assertRaises(Exception):
+            bc_address_to_hash_160(addr[:-3])
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(len(cache), 2)
+        cache.resize(1)
+        self.assertEqual(cache.keys(), ['a'])
+        cache.clear()
+        self.assertEqual(cache.get('a'), None)
+
 
 class Test_keyImport(unittest.TestCase):
     """ The keys used in this class are TEST keys from
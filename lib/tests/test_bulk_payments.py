@@ -0,0 +1,41 @@
+import unittest
+from StringIO import StringIO
+
+from lib import bulk_payments
+
+
+class TestBulkPayments(unittest.TestCase):
+
+    def test_read_csv(self):
+        f = StringIO('address,amount\nLaddr1, 0.5\n\n"Laddr2",1\nLaddr3,!\n')
+        outputs = list(bulk_payments.read_outputs(f))
+        self.assertEqual(outputs, [('Laddr1', '0.5'), ('Laddr2', '1'), ('Laddr3', '!')])
+
+    def test_read_json_lines(self):
+        lines = [
+            '{"address": "Laddr1", "amount": 0.10000001}',
+            '["Laddr2", 2]',
+            '',
+            '{"amount": "3", "address": "Laddr3"}',
+        ]
+        outputs = list(bulk_payments.read_outputs(lines))
+        # amounts are not rounded through floats
+        self.assertEqual(outputs, [('Laddr1', '0.10000001'), ('Laddr2', '2'), ('Laddr3', '3')])
+
+    def test_format(self):
+        self.assertEqual(list(bulk_payments.read_outputs(['["Laddr1", 1]'], 'json')), [('Laddr1', '1')])
+        self.assertEqual(list(bulk_payments.read_outputs([])), [])
+        self.assertRaises(BaseException, list, bulk_payments.read_outputs(['Laddr1,1'], 'xml'))
+
+    def test_errors(self):
+        for lines in [['Laddr1,1', 'Laddr2'],
+                      ['Laddr1,1', 'Laddr2,-1'],
+                      ['Laddr1,1', 'Laddr2,abc'],
+                      ['Laddr1,1', ',1'],
+                      ['{"address": "Laddr1", "amount": 1}', '{"amount": 1}'],
+                      ['{"address": "Laddr1", "amount": 1}', '{"address": ']]:
+            outputs = bulk_payments.read_outputs(lines)
+            self.assertEqual(next(outputs), ('Laddr1', '1'))
+            with self.assertRaises(BaseException) as cm:
+                next(outputs)
+            self.assertTrue(str(cm.exception).startswith('line 2:'), str(cm.exception))
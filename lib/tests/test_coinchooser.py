@@ -0,0 +1,119 @@
+import unittest
+
+from lib import coinchooser
+from lib.bitcoin import TYPE_ADDRESS, hash160_to_p2pkh, hash160_to_p2sh
+from lib.transaction import Transaction
+from lib.util import NotEnoughFunds
+
+
+def make_coin(n, _type='p2pkh', value=100000):
+    coin = {
+        'type': _type,
+        'address': hash160_to_p2pkh(chr(n % 256) * 20),
+        'prevout_hash': '%064x' % (n + 1),
+        'prevout_n': n % 3,
+        'value': value,
+        'height': 1000 + n,
+        'num_sig': 1,
+        'signatures': [None],
+        'x_pubkeys': ['02' + '11' * 32],
+        'pubkeys': ['02' + '11' * 32],
+    }
+    if _type == 'p2sh':
+        coin['num_sig'] = 2
+        coin['signatures'] = [None] * 3
+        coin['x_pubkeys'] = coin['pubkeys'] = ['02' + ('%02x' % i) * 32 for i in range(3)]
+    elif _type == 'p2wpkh-p2sh':
+        coin['redeemScript'] = '0014' + '22' * 20
+    return coin
+
+
+class TestSizeModel(unittest.TestCase):
+
+    outputs = [(TYPE_ADDRESS, hash160_to_p2pkh('\x33' * 20), 50000),
+               (TYPE_ADDRESS, hash160_to_p2sh('\x44' * 20), 60000)]
+
+    def check(self, coins, change_addrs=[]):
+        chooser = coinchooser.CoinChooserOldestFirst()
+        buckets = chooser.bucketize_coins(coins)
+        tx = Transaction.from_io([], self.outputs[:])
+        model = coinchooser.SizeModel(tx)
+        change = [(TYPE_ADDRESS, addr, 1000) for addr in change_addrs]
+        change_sizes = [len(tx.serialize_output_bytes(o)) for o in change]
+        size = Transaction.from_io(coins, self.outputs + change).estimated_size()
+        self.assertEqual(model.size(buckets, change_sizes), size)
+
+    def test_size_model(self):
+        self.check([])
+        self.check([make_coin(0)])
+        self.check([make_coin(i) for i in range(3)], [hash160_to_p2pkh('\x55' * 20)])
+        self.check([make_coin(i, 'p2sh') for i in range(3)], [hash160_to_p2sh('\x55' * 20)])
+        # the count of inputs takes 3 bytes from 253 inputs on
+        self.check([make_coin(i) for i in range(260)])
+
+    def test_size_model_segwit(self):
+        self.check([make_coin(i, 'p2wpkh-p2sh') for i in range(2)], [hash160_to_p2sh('\x55' * 20)])
+        # with a segwit coin, every input has a witness
+        self.check([make_coin(0, 'p2wpkh-p2sh'), make_coin(1)])
+
+    def test_make_tx(self):
+        sizes = []
+        def fee_estimator(size):
+            sizes.append(size)
+            return size * 10
+        coins = [make_coin(i, value=40000) for i in range(5)]
+        chooser = coinchooser.CoinChooserOldestFirst()
+        tx = chooser.make_tx(coins, self.outputs[:], [hash160_to_p2sh('\x55' * 20)], fee_estimator, 546)
+        self.assertEqual(len(tx.outputs()), 3)
+        # the fee of the change was computed for the size of tx
+        self.assertEqual(sizes[-1], tx.estimated_size())
+        self.assertTrue(tx.get_fee() >= tx.estimated_size() * 10)
+
+
+class TestBranchAndBound(unittest.TestCase):
+
+    def test_branch_and_bound(self):
+        bnb = coinchooser.branch_and_bound
+        values = [9, 7, 5, 5, 3, 1]
+        fees = [0] * len(values)
+        self.assertEqual(sum(values[i] for i in bnb(values, fees, 12, 0, 1000)), 12)
+        # the least excess within the window
+        self.assertEqual(sorted(values[i] for i in bnb(values, fees, 11, 2, 1000)), [1, 3, 7])
+        self.assertEqual(bnb(values, fees, 2, 0, 1000), None)
+        self.assertEqual(bnb(values, fees, 31, 10, 1000), None)
+        # with fees, fewer values waste less
+        self.assertEqual(bnb([6, 4, 3, 3], [1] * 4, 6, 3, 1000), [0])
+        # the budget is respected
+        self.assertEqual(bnb([2] * 30 + [1], [0] * 31, 61, 0, 10), None)
+
+    def test_approximate_best_subset(self):
+        values = [50, 40, 30, 20, 10]
+        prng = coinchooser.PRNG('seed')
+        subset = coinchooser.approximate_best_subset(values, 60, 100, prng.get_bytes)
+        self.assertEqual(sum(values[i] for i in subset), 60)
+
+    def test_changeless(self):
+        outputs = [(TYPE_ADDRESS, hash160_to_p2pkh('\x33' * 20), 1000000)]
+        change_addrs = [hash160_to_p2pkh('\x55' * 20)]
+        fee_estimator = lambda size: size * 10
+        values = [2000000, 700000, 450000, 303500, 120000]
+        coins = [make_coin(i, value=v) for i, v in enumerate(values)]
+        chooser = coinchooser.CoinChooserBranchAndBound()
+        tx = chooser.make_tx(coins, outputs[:], change_addrs, fee_estimator, 10000)
+        # 700000 + 303500 pays for the output and a fee of 10 per byte,
+        # with 100 left over
+        self.assertEqual(len(tx.outputs()), 1)
+        self.assertEqual(sorted(x['value'] for x in tx.inputs()), [303500, 700000])
+        self.assertTrue(tx.get_fee() >= tx.estimated_size() * 10)
+        # no set of coins fits: there is change
+        tx = chooser.make_tx(coins[:1], outputs[:], change_addrs, fee_estimator, 10000)
+        self.assertEqual(len(tx.outputs()), 2)
+        self.assertTrue(tx.get_fee() >= tx.estimated_size() * 10)
+        self.assertRaises(NotEnoughFunds, chooser.make_tx, coins[4:], outputs[:], change_addrs, fee_estimator, 10000)
+
+    def test_time_budget(self):
+        # selection is bounded in steps unless a time budget is set
+        chooser = coinchooser.get_coin_chooser({'coin_chooser': 'Changeless'})
+        self.assertIsNone(chooser.time_budget)
+        chooser = coinchooser.get_coin_chooser({'coin_chooser': 'Changeless', 'coin_chooser_time_budget': 0.5})
+        self.assertEqual(chooser.time_budget, 0.5)
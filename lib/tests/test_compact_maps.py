@@ -0,0 +1,46 @@
+import unittest
+
+from lib import compact_maps
+
+
+TX1 = 'aa' * 32
+TX2 = 'bb' * 32
+
+DATA = {
+    'txo': {TX1: {'addr1': [(0, 1000, True), (2, 5, False)]}, TX2: {}},
+    'txi': {TX2: {'addr1': [(TX1 + ':0', 1000)]}, TX1: {}},
+    'pruned_txo': {TX1 + ':1': TX2},
+    'addr_history': {'addr1': [(TX1, 10), (TX2, -1)], 'addr2': []},
+    'verified_tx3': {TX1: (10, 1490000000, 3)},
+}
+
+
+class TestCompactMaps(unittest.TestCase):
+
+    def test_roundtrip(self):
+        blob = compact_maps.encode_maps(DATA)
+        self.assertEqual(DATA, compact_maps.decode_maps(blob))
+
+    def test_txids_are_shared(self):
+        maps = compact_maps.decode_maps(compact_maps.encode_maps(DATA))
+        tx1 = [k for k in maps['txo'] if k == TX1][0]
+        self.assertIs(tx1, maps['addr_history']['addr1'][0][0])
+        self.assertIs(tx1, [k for k in maps['verified_tx3']][0])
+
+    def test_pack_data(self):
+        data = dict(DATA, seed_version=13)
+        packed = compact_maps.pack_data(data)
+        self.assertEqual(['compact_maps', 'seed_version'], sorted(packed.keys()))
+        self.assertEqual(data, compact_maps.unpack_data(packed))
+        # nothing to pack
+        self.assertEqual({'a': 1}, compact_maps.pack_data({'a': 1}))
+
+    def test_not_encodable(self):
+        data = {'txo': {'not a txid': {}}}
+        self.assertRaises(ValueError, compact_maps.encode_maps, data)
+        self.assertIs(data, compact_maps.pack_data(data))
+
+    def test_unknown_version(self):
+        blob = compact_maps.encode_maps(DATA)
+        blob = blob[:3] + chr(compact_maps.VERSION + 1) + blob[4:]
+        self.assertRaises(IOError, compact_maps.decode_maps, blob)
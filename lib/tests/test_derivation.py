@@ -0,0 +1,148 @@
+import sys
+import unittest
+
+from lib import bitcoin, derivation, keystore, transaction
+from lib.bitcoin import deserialize_xpub, CKD_pub, bip32_root, hash160_to_p2pkh, TYPE_ADDRESS
+from lib.bitcoin import public_key_from_private_key
+
+
+XPUBS = [
+    "xpub6H1LXWLaKsWFhvm6RVpEL9P4KfRZSW7abD2ttkWP3SSQvnyA8FSVqNTEcYFgJS2UaFcxupHiYkro49S8yGasTvXEYBVPamhGW6cFJodrTHy",
+    "xpub6FnCn6nSzZAw5Tw7cgR9bi15UV96gLZhjDstkXXxvCLsUXBGXPdSnLFbdpq8p9HmGsApME5hQTZ3emM2rnY5agb9rXpVGyy3bdW6EEgAtqt",
+]
+
+
+def branch_key(xpub, for_change):
+    _, _, _, _, c, cK = deserialize_xpub(xpub)
+    return CKD_pub(cK, c, for_change)
+
+
+class TestParallelDerivation(unittest.TestCase):
+
+    def setUp(self):
+        derivation.set_num_processes(2)
+        self.keys = [branch_key(xpub, 0) for xpub in XPUBS] + [branch_key(XPUBS[0], 1)]
+
+    def tearDown(self):
+        derivation.set_num_processes(None)
+
+    def serial(self, sequence):
+        return [[CKD_pub(cK, c, i)[0].encode('hex') for i in sequence] for cK, c in self.keys]
+
+    def test_parallel_matches_serial(self):
+        sequence = range(5, 5 + derivation.MIN_PARALLEL_SIZE)
+        self.assertIsNotNone(derivation.get_pool())
+        self.assertEqual(self.serial(sequence), derivation.derive_branches(self.keys, sequence))
+
+    def test_small_batch_is_serial(self):
+        sequence = [0, 3]
+        self.assertEqual(self.serial(sequence), derivation.derive_branches(self.keys, sequence))
+
+    def test_pool_disabled(self):
+        derivation.set_num_processes(1)
+        self.assertIsNone(derivation.get_pool())
+        sequence = range(derivation.MIN_PARALLEL_SIZE)
+        self.assertEqual(self.serial(sequence), derivation.derive_branches(self.keys, sequence))
+
+    def test_frozen(self):
+        sys.frozen = True
+        try:
+            self.assertEqual(1, derivation.get_num_processes())
+            self.assertIsNone(derivation.get_pool())
+        finally:
+            del sys.frozen
+
+    def test_fork_with_held_lock(self):
+        # another thread is using an address cache when the pool starts
+        derivation.stop_pool()
+        cache = bitcoin.address_caches[1]
+        with cache.lock:
+            pool = derivation.get_pool()
+        result = pool.apply_async(hash160_to_p2pkh, ('\x01' * 20,))
+        self.assertEqual(hash160_to_p2pkh('\x01' * 20), result.get(10))
+
+
+class TestParallelSigning(unittest.TestCase):
+
+    def setUp(self):
+        derivation.set_num_processes(2)
+        xprv, xpub = bip32_root('\x01' * 32, 0)
+        self.keystore = keystore.from_xprv(xprv)
+
+    def tearDown(self):
+        derivation.set_num_processes(None)
+
+    def make_txs(self, n):
+        txs = []
+        for i in range(n):
+            inputs = []
+            # each key is used by two transactions
+            for for_change, index in [(0, i // 2), (1, i // 2)]:
+                inputs.append({
+                    'type': 'p2pkh',
+                    'address': hash160_to_p2pkh('\x01' * 20),
+                    'prevout_hash': '%064x' % i,
+                    'prevout_n': for_change,
+                    'num_sig': 1,
+                    'signatures': [None],
+                    'x_pubkeys': [self.keystore.get_xpubkey(for_change, index)],
+                    'pubkeys': [public_key_from_private_key(self.keystore.get_private_key([for_change, index], None))],
+                })
+            outputs = [(TYPE_ADDRESS, hash160_to_p2pkh('\x02' * 20), 1000)]
+            txs.append(transaction.Transaction.from_io(inputs, outputs))
+        return txs
+
+    def test_tx_keypairs(self):
+        txs = self.make_txs(4)
+        keypairs = self.keystore.get_tx_keypairs(txs, None)
+        self.assertEqual(len(keypairs), 4)
+        for tx, d in zip(txs, keypairs):
+            for txin in tx.inputs():
+                x_pubkey = txin['x_pubkeys'][0]
+                sequence = self.keystore.get_pubkey_derivation(x_pubkey)
+                self.assertEqual(d[x_pubkey], self.keystore.get_private_key(sequence, None))
+
+    def test_parallel_matches_serial(self):
+        n = derivation.MIN_PARALLEL_TXS * 2
+        txs = self.make_txs(n)
+        jobs = zip(txs, self.keystore.get_tx_keypairs(txs, None))
+        self.assertIsNotNone(derivation.get_pool())
+        derivation.sign_transactions(jobs)
+        expected = self.make_txs(n)
+        for tx in expected:
+            self.keystore.sign_transaction(tx, None)
+        self.assertEqual([tx.raw for tx in txs], [tx.raw for tx in expected])
+        self.assertTrue(all(tx.is_complete() for tx in txs))
+
+    def make_multisig_txs(self, keystores, n):
+        txs = []
+        for i in range(n):
+            # pubkeys are unknown and x_pubkeys are not sorted
+            x_pubkeys = [k.get_xpubkey(0, i) for k in keystores]
+            x_pubkeys.sort(reverse=True)
+            inputs = [{
+                'type': 'p2sh',
+                'address': hash160_to_p2pkh('\x01' * 20),
+                'prevout_hash': '%064x' % i,
+                'prevout_n': 0,
+                'num_sig': 2,
+                'signatures': [None] * 3,
+                'x_pubkeys': x_pubkeys,
+            }]
+            outputs = [(TYPE_ADDRESS, hash160_to_p2pkh('\x02' * 20), 1000)]
+            txs.append(transaction.Transaction.from_io(inputs, outputs))
+        return txs
+
+    def test_parallel_multisig(self):
+        keystores = [self.keystore] + [keystore.from_xprv(bip32_root(c * 32, 0)[0]) for c in '\x02\x03']
+        n = derivation.MIN_PARALLEL_TXS * 2
+        txs = self.make_multisig_txs(keystores, n)
+        keypairs = [dict(a.items() + b.items()) for a, b in
+                    zip(keystores[0].get_tx_keypairs(txs, None), keystores[1].get_tx_keypairs(txs, None))]
+        derivation.sign_transactions(zip(txs, keypairs))
+        expected = self.make_multisig_txs(keystores, n)
+        for tx in expected:
+            keystores[0].sign_transaction(tx, None)
+            keystores[1].sign_transaction(tx, None)
+        self.assertEqual([tx.raw for tx in txs], [tx.raw for tx in expected])
+        self.assertTrue(all(tx.is_complete() for tx in txs))
@@ -0,0 +1,138 @@
+import hashlib
+import unittest
+
+from lib import ecc_backend
+from lib.bitcoin import EC_KEY, MySigningKey
+from ecdsa.curves import SECP256k1
+from ecdsa.util import sigencode_string, sigdecode_string
+
+
+def available(name):
+    try:
+        ecc_backend.load_backend(name)
+        return True
+    except Exception:
+        return False
+
+HAS_LIBSECP256K1 = available('libsecp256k1')
+
+G = '0279be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798'
+G_UNCOMPRESSED = '0479be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798483ada7726a3c4655da4fbfc0e1108a8fd17b448a68554199c47d08ffb10d4b8'
+
+
+def secret(i):
+    return ecc_backend.scalar_to_bytes(i)
+
+
+def msg_hash(i):
+    return hashlib.sha256(str(i)).digest()
+
+
+class BackendTests(object):
+
+    backend_name = None
+
+    def setUp(self):
+        self.backend = ecc_backend.load_backend(self.backend_name)
+
+    def test_pubkey_from_secret(self):
+        self.assertEqual(self.backend.pubkey_from_secret(secret(1)).encode('hex'), G)
+        self.assertEqual(self.backend.pubkey_from_secret(secret(1), False).encode('hex'), G_UNCOMPRESSED)
+
+    def test_sign(self):
+        # same signatures as the ecdsa package, with a low S
+        for i in range(1, 4):
+            key = MySigningKey.from_string(secret(i * 1000003), curve=SECP256k1)
+            expected = key.sign_digest_deterministic(msg_hash(i), hashfunc=hashlib.sha256, sigencode=sigencode_string)
+            self.assertEqual(self.backend.sign(secret(i * 1000003), msg_hash(i)), expected)
+
+    def test_verify(self):
+        pubkey = self.backend.pubkey_from_secret(secret(7))
+        sig = self.backend.sign(secret(7), msg_hash(1))
+        self.assertTrue(self.backend.verify(pubkey, sig, msg_hash(1)))
+        self.assertFalse(self.backend.verify(pubkey, sig, msg_hash(2)))
+        self.assertFalse(self.backend.verify(self.backend.pubkey_from_secret(secret(8)), sig, msg_hash(1)))
+        # a high S is accepted
+        order = SECP256k1.order
+        r, s = sigdecode_string(sig, order)
+        self.assertTrue(self.backend.verify(pubkey, sigencode_string(r, order - s, order), msg_hash(1)))
+
+    def test_recover(self):
+        sig = self.backend.sign(secret(9), msg_hash(3))
+        for compressed in [True, False]:
+            pubkey = self.backend.pubkey_from_secret(secret(9), compressed)
+            recovered = []
+            for recid in range(4):
+                try:
+                    recovered.append(self.backend.recover(sig, recid, msg_hash(3), compressed))
+                except Exception:
+                    pass
+            self.assertIn(pubkey, recovered)
+
+    def test_tweak_add(self):
+        pubkey = self.backend.pubkey_from_secret(secret(5))
+        self.assertEqual(self.backend.pubkey_tweak_add(pubkey, secret(6)), self.backend.pubkey_from_secret(secret(11)))
+        self.assertEqual(self.backend.pubkey_tweak_add(pubkey, secret(6), False), self.backend.pubkey_from_secret(secret(11), False))
+        self.assertEqual(self.backend.pubkey_tweak_add_many(pubkey, [secret(1), secret(2)]),
+                         [self.backend.pubkey_from_secret(secret(6)), self.backend.pubkey_from_secret(secret(7))])
+
+    def test_tweak_mul(self):
+        pubkey = self.backend.pubkey_from_secret(secret(5))
+        self.assertEqual(self.backend.pubkey_tweak_mul(pubkey, secret(6)), self.backend.pubkey_from_secret(secret(30)))
+
+    def test_invalid_pubkey(self):
+        for pubkey in ['', '\x02' + '\xff' * 32, '\x05' + G[2:].decode('hex')]:
+            with self.assertRaises(Exception):
+                self.backend.pubkey_tweak_mul(pubkey, secret(2))
+            self.assertFalse(self.backend.verify(pubkey, '\x01' * 64, msg_hash(1)))
+
+
+class TestPythonBackend(BackendTests, unittest.TestCase):
+    backend_name = 'python'
+
+
+@unittest.skipUnless(HAS_LIBSECP256K1, 'libsecp256k1 is not available')
+class TestLibSecp256k1Backend(BackendTests, unittest.TestCase):
+    backend_name = 'libsecp256k1'
+
+
+@unittest.skipUnless(HAS_LIBSECP256K1, 'libsecp256k1 is not available')
+class TestCrossBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.python = ecc_backend.load_backend('python')
+        self.libsecp256k1 = ecc_backend.load_backend('libsecp256k1')
+
+    def test_same_results(self):
+        for i in range(20):
+            k = hashlib.sha256('secret %d' % i).digest()
+            h = msg_hash(i)
+            pubkey = self.python.pubkey_from_secret(k)
+            sig = self.python.sign(k, h)
+            self.assertEqual(self.libsecp256k1.pubkey_from_secret(k), pubkey)
+            self.assertEqual(self.libsecp256k1.sign(k, h), sig)
+            self.assertTrue(self.libsecp256k1.verify(pubkey, sig, h))
+            for recid in range(2):
+                results = []
+                for backend in [self.python, self.libsecp256k1]:
+                    try:
+                        results.append(backend.recover(sig, recid, h))
+                    except Exception:
+                        results.append(None)
+                self.assertEqual(results[0], results[1])
+            self.assertEqual(self.libsecp256k1.pubkey_tweak_add(pubkey, h), self.python.pubkey_tweak_add(pubkey, h))
+            self.assertEqual(self.libsecp256k1.pubkey_tweak_mul(pubkey, h), self.python.pubkey_tweak_mul(pubkey, h))
+
+
+class TestECKey(unittest.TestCase):
+
+    def test_secret_larger_than_order(self):
+        # wallet file keys are derived from 64-byte secrets
+        k = hashlib.sha512('password').digest()
+        key = EC_KEY(k)
+        self.assertEqual(key.get_public_key(), EC_KEY(secret(key.secret)).get_public_key())
+        self.assertEqual(key.decrypt_message(EC_KEY.encrypt_message('hello', key.get_public_key_bytes())), 'hello')
+
+    def test_pubkey_point(self):
+        key = EC_KEY(secret(1))
+        self.assertEqual(key.pubkey.point.x(), SECP256k1.generator.x())
@@ -0,0 +1,65 @@
+import unittest
+import json
+from StringIO import StringIO
+
+from lib import history_export
+
+
+class FakeWallet(object):
+
+    def __init__(self, history, labels):
+        self.history = history
+        self.labels = labels
+
+    def get_history(self, domain=None):
+        return self.history
+
+    def get_label(self, tx_hash):
+        return self.labels.get(tx_hash, '')
+
+
+class FakeFx(object):
+
+    def historical_value_str(self, satoshis, d_t):
+        return '%.2f' % (satoshis / 1e8 * 10)
+
+
+HISTORY = [
+    ('aa' * 32, 100, 5, 1490000000, 150000000, 150000000),
+    ('bb' * 32, 0, 0, False, -50000000, 100000000),
+]
+
+
+class TestHistoryExport(unittest.TestCase):
+
+    def setUp(self):
+        self.wallet = FakeWallet(HISTORY, {'aa' * 32: u'caf\xe9'})
+
+    def test_export_csv(self):
+        f = StringIO()
+        n = history_export.export_history(self.wallet, f, 'csv')
+        self.assertEqual(2, n)
+        lines = f.getvalue().splitlines()
+        self.assertEqual('transaction_hash,label,confirmations,value,timestamp', lines[0])
+        self.assertEqual(3, len(lines))
+        self.assertTrue(lines[1].startswith('aa' * 32 + ',caf\xc3\xa9,5,+1.5,'))
+        self.assertEqual('bb' * 32 + ',,0,-0.5,unconfirmed', lines[2])
+
+    def test_export_json_lines(self):
+        f = StringIO()
+        history_export.export_history(self.wallet, f, 'json', fx=FakeFx())
+        rows = [json.loads(line) for line in f.getvalue().splitlines()]
+        self.assertEqual(2, len(rows))
+        self.assertEqual(u'caf\xe9', rows[0]['label'])
+        self.assertEqual('15.00', rows[0]['fiat_value'])
+        self.assertEqual('10.00', rows[1]['fiat_balance'])
+
+    def test_progress_callback(self):
+        calls = []
+        history_export.export_history(self.wallet, StringIO(), 'csv',
+                                      callback=lambda n, total: calls.append((n, total)), step=1)
+        self.assertEqual([(1, 2), (2, 2), (2, 2)], calls)
+
+    def test_unknown_format(self):
+        with self.assertRaises(BaseException):
+            history_export.export_history(self.wallet, StringIO(), 'xml')
@@ -0,0 +1,53 @@
+import hmac
+import hashlib
+import unittest
+
+import pbkdf2
+
+from lib import bitcoin
+from lib import storage_crypto
+from lib.storage_crypto import StorageCipher, derive_secret, get_magic
+from lib.util import InvalidPassword
+
+
+class TestStorageCrypto(unittest.TestCase):
+
+    def setUp(self):
+        self.ec_key = bitcoin.EC_KEY(derive_secret(u'p\xe4ssword'))
+        self.pubkey = self.ec_key.get_public_key()
+
+    def test_derive_secret(self):
+        password = u'p\xe4ssword'
+        expected = pbkdf2.PBKDF2(password, '', iterations = 1024, macmodule = hmac, digestmodule = hashlib.sha512).read(64)
+        self.assertEqual(expected, derive_secret(password))
+
+    def test_aes_ctr(self):
+        # NIST SP 800-38A, F.5.5 CTR-AES256.Encrypt
+        key = '603deb1015ca71be2b73aef0857d77811f352c073b6108d72d9810a30914dff4'.decode('hex')
+        counter = 'f0f1f2f3f4f5f6f7f8f9fafbfcfdfeff'.decode('hex')
+        data = '6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac45af8e51'.decode('hex')
+        ct = '601ec313775789a5b7a7f504bbf3d228f443e3ca4d62b59aca84e990cacaf5c5'.decode('hex')
+        self.assertEqual(ct, storage_crypto.aes_ctr_xor(key, counter, data))
+        self.assertEqual(data, storage_crypto.aes_ctr_xor(key, counter, ct))
+        self.assertEqual('', storage_crypto.aes_ctr_xor(key, counter, ''))
+
+    def test_roundtrip(self):
+        writer = StorageCipher(self.pubkey)
+        raw1 = writer.encrypt('hello')
+        raw2 = writer.encrypt('hello')
+        self.assertEqual('BIE3', get_magic(raw1))
+        self.assertNotEqual(raw1, raw2)
+        reader = StorageCipher(self.pubkey, self.ec_key)
+        self.assertEqual('hello', reader.decrypt(raw1))
+        # the session of the file is reused to save it
+        self.assertEqual(writer.session, reader.session)
+
+    def test_legacy_format(self):
+        raw = bitcoin.encrypt_message('hello', self.pubkey)
+        self.assertEqual('BIE1', get_magic(raw))
+        self.assertEqual('hello', StorageCipher(self.pubkey, self.ec_key).decrypt(raw))
+
+    def test_wrong_key(self):
+        raw = StorageCipher(self.pubkey).encrypt('hello')
+        other = bitcoin.EC_KEY(derive_secret('other'))
+        self.assertRaises(InvalidPassword, StorageCipher(other.get_public_key(), other).decrypt, raw)
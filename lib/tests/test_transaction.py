@@ -1,6 +1,10 @@
 import unittest
+import json
+import pickle
 from lib import transaction
-from lib.bitcoin import TYPE_ADDRESS
+from lib import ecc_backend
+from lib.commands import Commands
+from lib.bitcoin import TYPE_ADDRESS, Hash, hash160_to_p2pkh, hash160_to_p2sh, SecretToASecret, der_to_sig_string
 
 import pprint
 from lib.keystore import xpubkey_to_address
@@ -145,6 +149,166 @@ class TestTransaction(unittest.TestCase):
         tx = transaction.Transaction(v2_blob)
         self.assertEquals(tx.txid(), "b97f9180173ab141b61b9f944d841e60feec691d6daab4d4d932b24dd36606fe")
 
+    def test_serialize_bytes(self):
+        tx = transaction.Transaction(v2_blob)
+        self.assertEquals(tx.serialize_bytes(), v2_blob.decode('hex'))
+        self.assertEquals(tx.serialize(), v2_blob)
+        self.assertEquals(tx.estimated_size(), len(v2_blob) / 2)
+        # without raw, the txid is computed from the inputs and outputs
+        tx.raw = None
+        self.assertEquals(tx.txid(), "b97f9180173ab141b61b9f944d841e60feec691d6daab4d4d932b24dd36606fe")
+
+    def test_deserialize_truncated(self):
+        with self.assertRaises(transaction.SerializationError):
+            transaction.deserialize(v2_blob[:100])
+
+    def test_sighash_cache(self):
+        def txin(n):
+            return {
+                'type': 'p2pkh',
+                'address': hash160_to_p2pkh(chr(n) * 20),
+                'prevout_hash': chr(n).encode('hex') * 32,
+                'prevout_n': n,
+                'num_sig': 1,
+                'signatures': [None],
+                'x_pubkeys': ['02' + '11' * 32],
+                'pubkeys': ['02' + '11' * 32],
+            }
+        outputs = [(TYPE_ADDRESS, hash160_to_p2pkh('\x22' * 20), 1000)]
+        tx = transaction.Transaction.from_io([txin(n) for n in range(3)], list(outputs))
+        preimages = [tx.serialize_preimage(i) for i in range(3)]
+        self.assertEquals(tx.sighash(1), Hash(preimages[1].decode('hex')))
+        # input 1 is the only input with a script, the other one is the output's
+        self.assertEquals(preimages[1].count('76a914' + '01' * 20 + '88ac'), 1)
+        self.assertEquals(preimages[1].count('76a914'), 2)
+        # changes made by the transaction reset the cache
+        tx.set_rbf(True)
+        self.assertNotEqual(tx.serialize_preimage(1), preimages[1])
+        tx.add_outputs(outputs)
+        tx2 = transaction.Transaction.from_io([txin(n) for n in range(3)], outputs * 2)
+        tx2.set_rbf(True)
+        self.assertEquals(tx.serialize_preimage(2), tx2.serialize_preimage(2))
+
+
+    def test_txinput(self):
+        sig = '30' + '00' * 69 + '01'
+        output = '01' + '00' * 8 + '19' + '76a914' + '22' * 20 + '88ac'
+        raw = '01000000' + '01' + '11' * 32 + '00000000' + '48' + '47' + sig + 'ffffffff' + output + '00000000'
+        tx = transaction.Transaction(raw)
+        txin = tx.inputs()[0]
+        self.assertEquals(txin['type'], 'p2pk')
+        self.assertEquals(txin['num_sig'], 1)
+        # the other fields are read from the script when they are used
+        self.assertEquals(txin.fields, None)
+        self.assertEquals(tx.signature_count(), (1, 1))
+        self.assertEquals(txin.fields, None)
+        self.assertEquals(txin.get('redeemScript'), None)
+        self.assertEquals(txin['signatures'], [sig])
+        txin['signatures'][0] = None
+        txin['value'] = 1000
+        self.assertEquals(tx.signature_count(), (0, 1))
+        self.assertEquals(txin, {
+            'prevout_hash': '11' * 32,
+            'prevout_n': 0,
+            'sequence': 0xffffffff,
+            'scriptSig': '47' + sig,
+            'type': 'p2pk',
+            'address': '(pubkey)',
+            'num_sig': 1,
+            'x_pubkeys': ['(pubkey)'],
+            'pubkeys': ['(pubkey)'],
+            'signatures': [None],
+            'value': 1000,
+        })
+        self.assertRaises(KeyError, txin.__getitem__, 'prev_tx')
+        # the txid and the outputs are computed once for a raw transaction
+        tx = transaction.Transaction(raw)
+        self.assertIs(tx.get_outputs(), tx.get_outputs())
+        txid = tx.txid()
+        self.assertEquals(txid, tx._txid())
+        self.assertEquals(tx.get_outputs(), [(hash160_to_p2pkh('\x22' * 20), 0)])
+        # until the transaction changes
+        tx.set_rbf(True)
+        self.assertNotEqual(tx.txid(), txid)
+        # or is changed in place
+        tx = transaction.Transaction(raw)
+        txid = tx.txid()
+        tx.get_outputs()
+        tx.outputs()[0] = (TYPE_ADDRESS, hash160_to_p2pkh('\x33' * 20), 0)
+        tx.invalidate_sighash_cache()
+        self.assertEquals(tx.get_outputs(), [(hash160_to_p2pkh('\x33' * 20), 0)])
+        self.assertNotEqual(tx.txid(), txid)
+        self.assertEquals(tx.txid(), transaction.Transaction(str(tx)).txid())
+
+    def test_txinput_pickle(self):
+        sig = '30' + '00' * 69 + '01'
+        output = '01' + '00' * 8 + '19' + '76a914' + '22' * 20 + '88ac'
+        raw = '01000000' + '01' + '11' * 32 + '00000000' + '48' + '47' + sig + 'ffffffff' + output + '00000000'
+        txin = transaction.Transaction(raw).inputs()[0]
+        txin['value'] = 1000
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(txin, protocol))
+            self.assertIsInstance(copy, transaction.TxInput)
+            self.assertEquals(copy, txin)
+        # the deserialize command returns plain dicts, for JSON-RPC
+        d = Commands(None, None, None).deserialize(raw)
+        self.assertIs(type(d['inputs'][0]), dict)
+        self.assertEquals(json.loads(json.dumps(d))['inputs'][0]['signatures'], [sig])
+
+    def test_signing_session(self):
+        backend = ecc_backend.get_backend()
+        secrets = [ecc_backend.scalar_to_bytes(n) for n in range(1, 4)]
+        pubkeys = sorted(backend.pubkey_from_secret(k).encode('hex') for k in secrets)
+        keypairs = dict((backend.pubkey_from_secret(k).encode('hex'), SecretToASecret(k, True)) for k in secrets)
+        txin = {
+            'type': 'p2sh',
+            'address': hash160_to_p2pkh('\x01' * 20),
+            'prevout_hash': '01' * 32,
+            'prevout_n': 0,
+            'num_sig': 2,
+            'signatures': [None] * 3,
+            'x_pubkeys': list(pubkeys),
+            'pubkeys': list(pubkeys),
+            'redeemScript': transaction.multisig_script(pubkeys, 2),
+        }
+        outputs = [(TYPE_ADDRESS, hash160_to_p2pkh('\x22' * 20), 1000)]
+        tx = transaction.Transaction.from_io([txin], outputs)
+        pre_hash = tx.sighash(0)
+        tx.sign(keypairs)
+        # two signatures are enough
+        signatures = tx.inputs()[0]['signatures']
+        self.assertEquals(signatures[2], None)
+        for pubkey, sig in zip(pubkeys, signatures[:2]):
+            self.assertTrue(backend.verify(pubkey.decode('hex'), der_to_sig_string(sig[:-2].decode('hex')), pre_hash))
+        self.assertTrue(tx.is_complete())
+        # a bad signature is not added
+        class BadBackend(object):
+            def sign(self, secret, h):
+                return backend.sign(secret, Hash(h))
+            def verify(self, pubkey, sig, h):
+                return backend.verify(pubkey, sig, h)
+            def pubkey_from_secret(self, secret, compressed=True):
+                return backend.pubkey_from_secret(secret, compressed)
+        tx = transaction.Transaction.from_io([dict(txin, signatures=[None] * 3)], outputs)
+        session = transaction.SigningSession(tx, keypairs)
+        session.backend = BadBackend()
+        self.assertRaises(BaseException, session.sign)
+        self.assertEquals(tx.inputs()[0]['signatures'], [None] * 3)
+
+    def test_output_bytes(self):
+        p2pkh = (TYPE_ADDRESS, hash160_to_p2pkh('\x33' * 20), 5000)
+        p2sh = (TYPE_ADDRESS, hash160_to_p2sh('\x11' * 20), 5000)
+        tx = transaction.Transaction.from_io([], [p2sh, (TYPE_ADDRESS, p2pkh[1], 7000), p2pkh])
+        size = tx.estimated_size()
+        self.assertEquals(tx.output_script_bytes(p2sh), transaction.get_scriptPubKey_bytes(p2sh[1]))
+        # same amount: the p2pkh script (76a9...) sorts before the p2sh one (a914...)
+        tx.BIP_LI01_sort()
+        self.assertEquals(tx.outputs(), [p2pkh, p2sh, (TYPE_ADDRESS, p2pkh[1], 7000)])
+        self.assertEquals(tx.estimated_size(), size)
+        fresh = transaction.Transaction.from_io([], list(tx.outputs()))
+        self.assertEquals(tx.serialize(), fresh.serialize())
+        self.assertEquals(tx.serialize_output(p2sh), fresh.serialize_output(p2sh))
+
 
 class NetworkMock(object):
 
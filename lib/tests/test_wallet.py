@@ -4,6 +4,7 @@ import sys
 import unittest
 import os
 import json
+import threading
 
 from StringIO import StringIO
 from electrum_lbtc.storage import WalletStorage, FINAL_SEED_VERSION
@@ -67,3 +68,234 @@ class TestWalletStorage(WalletTestCase):
         with open(self.wallet_path, "r") as f:
             contents = f.read()
         self.assertEqual(some_dict, json.loads(contents))
+
+    def test_convert_to_sqlite(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('labels', {'aa': 'first', 'bb': 'second'})
+        storage.put('gap_limit', 30)
+        storage.write()
+        json_path = storage.convert_to_sqlite()
+        with open(json_path, "r") as f:
+            self.assertEqual('first', json.loads(f.read())['labels']['aa'])
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertIsNotNone(storage.db)
+        self.assertEqual({'aa': 'first', 'bb': 'second'}, storage.get('labels'))
+        self.assertEqual(30, storage.get('gap_limit'))
+
+    def test_sqlite_incremental_write(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('labels', {'aa': 'first', 'bb': 'second'})
+        storage.put('verified_tx3', {})
+        storage.convert_to_sqlite()
+        storage.put('labels', {'aa': 'changed', 'cc': 'third'})
+        self.assertEqual({'labels': set(['aa', 'bb', 'cc'])}, storage.db.dirty_items)
+        storage.put('gap_limit', 25)
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({'aa': 'changed', 'cc': 'third'}, storage.get('labels'))
+        self.assertEqual({}, storage.get('verified_tx3'))
+        self.assertEqual(25, storage.get('gap_limit'))
+        self.assertEqual(FINAL_SEED_VERSION, storage.get('seed_version'))
+        storage.put('labels', None)
+        storage.write()
+        self.assertIsNone(WalletStorage(self.wallet_path).get('labels'))
+
+    def test_journal(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('labels', {'aa': 'first', 'bb': 'second'})
+        storage.enable_journal()
+        with open(self.wallet_path, "r") as f:
+            base = f.read()
+        storage.put('labels', {'aa': 'changed', 'cc': 'third'})
+        storage.put('gap_limit', 25)
+        storage.write()
+        storage.put('gap_limit', None)
+        storage.write()
+        # changes went to the journal only
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual(base, f.read())
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({'aa': 'changed', 'cc': 'third'}, storage.get('labels'))
+        self.assertIsNone(storage.get('gap_limit'))
+        storage.compact()
+        self.assertTrue(storage.journal.is_empty())
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({'aa': 'changed', 'cc': 'third'}, storage.get('labels'))
+
+    def test_compact_maps(self):
+        txo = {'aa' * 32: {'addr1': [[0, 1000, False]]}}
+        storage = WalletStorage(self.wallet_path)
+        storage.put('txo', txo)
+        storage.write()
+        # files stay readable by older versions unless enabled
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual(txo, json.load(f)['txo'])
+        storage.enable_compact_maps()
+        with open(self.wallet_path, "r") as f:
+            d = json.load(f)
+        self.assertNotIn('txo', d)
+        self.assertIn('compact_maps', d)
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual(txo, json.loads(json.dumps(storage.get('txo'))))
+
+    def test_stale_journal_is_ignored(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.enable_journal()
+        storage.put('gap_limit', 25)
+        storage.write()
+        with open(storage.journal.path, "r") as f:
+            journal = f.read()
+        storage.put('gap_limit', 30)
+        storage.compact()
+        # compaction interrupted before the journal was reset
+        with open(storage.journal.path, "w") as f:
+            f.write(journal)
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual(30, storage.get('gap_limit'))
+        self.assertTrue(storage.journal.compact_next)
+
+
+    def test_write_later(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.writer.delay = 60
+        calls = []
+        def callback():
+            calls.append(1)
+            storage.put('gap_limit', 30)
+        # requests from a daemon thread are written by the writer thread
+        t = threading.Thread(target=storage.write_later, args=(callback,))
+        t.daemon = True
+        t.start()
+        t.join()
+        storage.write_later(callback)
+        self.assertFalse(os.path.exists(self.wallet_path))
+        self.assertTrue(storage.get_write_stats()['pending'])
+        storage.flush()
+        self.assertEqual([1], calls)
+        self.assertEqual(30, WalletStorage(self.wallet_path).get('gap_limit'))
+        stats = storage.get_write_stats()
+        self.assertFalse(stats['pending'])
+        self.assertEqual(1, stats['writes'])
+        self.assertEqual(1, stats['coalesced'])
+        self.assertIsNotNone(stats['last_saved'])
+        self.assertIsNone(storage.writer.thread)
+
+
+class TestLazyTransactions(WalletTestCase):
+
+    def setUp(self):
+        super(TestLazyTransactions, self).setUp()
+        self.storage = WalletStorage(self.wallet_path)
+        self.storage.put('transactions', {'aa': '0100', 'bb': '0200'})
+
+    def test_lru(self):
+        from electrum_lbtc.wallet import LazyTransactions, TxCache
+        txs = LazyTransactions(self.storage, cache=TxCache(1))
+        self.assertEqual(0, len(txs.cache))
+        self.assertEqual('0100', str(txs['aa']))
+        self.assertEqual('0200', str(txs.get('bb')))
+        self.assertEqual(['bb'], txs.cache.keys())
+        self.assertIsNone(txs.get('cc'))
+        self.assertNotIn('cc', txs)
+
+    def test_shared_cache(self):
+        from electrum_lbtc.wallet import LazyTransactions, TxCache
+        cache = TxCache(10)
+        txs = LazyTransactions(self.storage, cache=cache)
+        storage2 = WalletStorage(os.path.join(self.user_dir, "otherwallet"))
+        storage2.put('transactions', {'bb': '0200'})
+        txs2 = LazyTransactions(storage2, cache=cache)
+        tx = txs['bb']
+        tx2 = txs2['bb']
+        self.assertEqual(str(tx), str(tx2))
+        # wallets do not share mutable transactions
+        self.assertIsNot(tx, tx2)
+        tx.raw = '0300'
+        self.assertEqual('0200', str(txs2['bb']))
+        # but a wallet gets the same transaction until it is evicted
+        self.assertIs(tx, txs['bb'])
+        # transactions of other wallets are not visible
+        self.assertEqual('0100', str(txs['aa']))
+        self.assertIsNone(txs2.get('aa'))
+        self.assertEqual({'size': 2, 'capacity': 10, 'hits': 1, 'misses': 2}, cache.get_stats())
+
+    def test_parsed_lru(self):
+        from electrum_lbtc.wallet import LazyTransactions
+        txs = LazyTransactions(self.storage, parsed_size=1)
+        tx = txs['aa']
+        self.assertIs(tx, txs['aa'])
+        txs['bb']
+        self.assertIsNot(tx, txs['aa'])
+        self.assertEqual('0100', str(txs.pop('aa')))
+        self.assertIsNone(txs.parsed.get('aa'))
+
+    def test_write_through(self):
+        from electrum_lbtc.wallet import LazyTransactions
+        from electrum_lbtc.transaction import Transaction
+        txs = LazyTransactions(self.storage)
+        txs['cc'] = Transaction('0300')
+        txs.pop('aa')
+        self.assertEqual({'bb': '0200', 'cc': '0300'}, self.storage.get('transactions'))
+
+    def test_sqlite(self):
+        from electrum_lbtc.wallet import LazyTransactions
+        from electrum_lbtc.transaction import Transaction
+        self.storage.convert_to_sqlite()
+        self.assertIsNone(self.storage.get('transactions'))
+        txs = LazyTransactions(self.storage)
+        txs['cc'] = Transaction('0300')
+        txs.pop('aa')
+        self.storage.write()
+        storage = WalletStorage(self.wallet_path)
+        self.assertIsNone(storage.get('transactions'))
+        self.assertEqual(set(['bb', 'cc']), storage.item_keys('transactions'))
+        self.assertEqual('0300', str(LazyTransactions(storage)['cc']))
+
+
+class TestAddressChain(unittest.TestCase):
+
+    def setUp(self):
+        from electrum_lbtc.wallet import AddressChain
+        used = set(['a1', 'a4'])
+        self.chain = AddressChain(['a%d' % i for i in range(8)], lambda addr: addr in used)
+
+    def test_gaps(self):
+        self.assertEqual(4, self.chain.last_used)
+        self.assertEqual(3, self.chain.num_unused_trailing())
+        self.assertEqual(2, self.chain.max_gap())
+        self.assertEqual(0, self.chain.gap_before('a5'))
+        self.assertEqual(2, self.chain.gap_before('a7'))
+
+    def test_update(self):
+        self.chain.extend(['a8', 'a9'])
+        self.chain.set_used('a9', True)
+        self.assertEqual(9, self.chain.last_used)
+        self.assertEqual(4, self.chain.max_gap())
+        self.chain.set_used('a9', False)
+        self.chain.set_used('a4', False)
+        self.assertEqual(1, self.chain.last_used)
+        self.assertEqual(1, self.chain.max_gap())
+        self.assertEqual(7, self.chain.gap_before('a9'))
+
+
+class TestWalletSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        from electrum_lbtc.wallet import WalletSnapshot
+        verified = {'aa': (100, 1490000000, 2)}
+        unverified = {'bb': 0, 'cc': 105}
+        self.snapshot = WalletSnapshot(1, 110, {'addr': [('aa', 100)]}, verified, unverified)
+
+    def test_tx_height(self):
+        self.assertEqual((100, 11, 1490000000), self.snapshot.get_tx_height('aa'))
+        self.assertEqual((105, 0, False), self.snapshot.get_tx_height('cc'))
+        self.assertEqual((0, 0, False), self.snapshot.get_tx_height('dd'))
+        self.assertNotIn('dd', self.snapshot.unverified_tx)
+
+    def test_txpos_order(self):
+        txs = sorted(['bb', 'cc', 'aa'], key=self.snapshot.get_txpos)
+        self.assertEqual(['aa', 'cc', 'bb'], txs)
+        self.assertEqual([], self.snapshot.get_address_history('other'))
@@ -31,7 +31,8 @@
 import bitcoin
 from bitcoin import *
 from bitcoin import hash160_to_p2sh, hash160_to_p2pkh
-from util import print_error, profiler
+import ecc_backend
+from util import print_error, profiler, LRUCache
 import time
 import sys
 import struct
@@ -39,13 +40,30 @@ import struct
 #
 # Workalike python implementation of Bitcoin's CDataStream class.
 #
-import struct
 import StringIO
 import random
 from keystore import xpubkey_to_address, xpubkey_to_pubkey
 
 NO_SIGNATURE = 'ff'
 
+# op_dup, op_hash_160, push 20 bytes ... op_equalverify, op_checksig
+P2PKH_PREFIX = '\x76\xa9\x14'
+P2PKH_SUFFIX = '\x88\xac'
+# op_hash_160, push 20 bytes ... op_equal
+P2SH_PREFIX = '\xa9\x14'
+P2SH_SUFFIX = '\x87'
+
+unpack_uint16 = struct.Struct('<H').unpack_from
+unpack_int32 = struct.Struct('<i').unpack_from
+unpack_uint32 = struct.Struct('<I').unpack_from
+unpack_int64 = struct.Struct('<q').unpack_from
+unpack_uint64 = struct.Struct('<Q').unpack_from
+pack_uint16 = struct.Struct('<H').pack
+pack_int32 = struct.Struct('<i').pack
+pack_uint32 = struct.Struct('<I').pack
+pack_int64 = struct.Struct('<q').pack
+pack_uint64 = struct.Struct('<Q').pack
+
 
 class SerializationError(Exception):
     """ Thrown when there's a problem deserializing or serializing """
@@ -375,6 +393,13 @@ def parse_scriptSig(d, bytes):
 
 
 def get_address_from_output_script(bytes):
+    # standard scripts are recognized without decoding them
+    n = len(bytes)
+    if n == 25 and bytes[:3] == P2PKH_PREFIX and bytes[23:] == P2PKH_SUFFIX:
+        return TYPE_ADDRESS, hash160_to_p2pkh(bytes[3:23])
+    if n == 23 and bytes[:2] == P2SH_PREFIX and bytes[22] == P2SH_SUFFIX:
+        return TYPE_ADDRESS, hash160_to_p2sh(bytes[2:22])
+
     decoded = [ x for x in script_GetOp(bytes) ]
 
     # The Genesis Block, self-payments, and pay-by-IP-address payments look like:
@@ -397,85 +422,293 @@ def get_address_from_output_script(bytes):
     return TYPE_SCRIPT, bytes
 
 
+# The parser works on the binary transaction: every read_ function
+# takes the bytes and an offset, and returns the value and the offset
+# that follows it.  Only the scripts are copied out of the buffer.
 
+def read_compact_size(s, i):
+    size = ord(s[i])
+    if size < 253:
+        return size, i + 1
+    elif size == 253:
+        return unpack_uint16(s, i + 1)[0], i + 3
+    elif size == 254:
+        return unpack_uint32(s, i + 1)[0], i + 5
+    else:
+        return unpack_uint64(s, i + 1)[0], i + 9
 
+def read_string(s, i):
+    n, i = read_compact_size(s, i)
+    j = i + n
+    if j > len(s):
+        raise SerializationError("attempt to read past end of buffer")
+    return s[i:j], j
 
-def parse_input(vds):
-    d = {}
-    prevout_hash = hash_encode(vds.read_bytes(32))
-    prevout_n = vds.read_uint32()
-    scriptSig = vds.read_bytes(vds.read_compact_size())
-    sequence = vds.read_uint32()
-    d['scriptSig'] = scriptSig.encode('hex')
-    d['prevout_hash'] = prevout_hash
-    d['prevout_n'] = prevout_n
-    d['sequence'] = sequence
+def parse_input_script(prevout_hash, script):
+    '''The fields of an input that are read from its script.'''
     if prevout_hash == '00'*32:
-        d['type'] = 'coinbase'
-    else:
-        d['x_pubkeys'] = []
-        d['pubkeys'] = []
-        d['signatures'] = {}
-        d['address'] = None
-        d['type'] = 'unknown'
-        d['num_sig'] = 0
-        if scriptSig:
-            parse_scriptSig(d, scriptSig)
+        return {'type': 'coinbase'}
+    d = {}
+    d['x_pubkeys'] = []
+    d['pubkeys'] = []
+    d['signatures'] = {}
+    d['address'] = None
+    d['type'] = 'unknown'
+    d['num_sig'] = 0
+    if script:
+        parse_scriptSig(d, script)
     return d
 
-def parse_witness(vds):
-    n = vds.read_compact_size()
-    for i in range(n):
-        x = vds.read_bytes(vds.read_compact_size())
 
-def parse_output(vds, i):
+class TxInput(object):
+    '''An input of a deserialized transaction.
+
+    It has the keys of the input dicts of Transaction.from_io, and can
+    be read and updated like them.  The type, the address and the number
+    of signatures are found when the input is parsed.  The other fields
+    of the script are only read from it when they are used, and are then
+    kept with the keys that are set; those of incomplete inputs are kept
+    from the start.'''
+
+    __slots__ = ('prevout_hash', 'prevout_n', 'sequence', 'script',
+                 'type', 'address', 'num_sig', 'sig_count', 'fields')
+
+    # keys stored as attributes
+    attributes = ('prevout_hash', 'prevout_n', 'sequence', 'type', 'address', 'num_sig')
+    # keys read from the script when they are used
+    script_fields = ('x_pubkeys', 'pubkeys', 'signatures', 'redeemScript')
+
+    def __init__(self, prevout_hash, prevout_n, script, sequence):
+        self.prevout_hash = prevout_hash
+        self.prevout_n = prevout_n
+        self.script = script
+        self.sequence = sequence
+        self.fields = None
+        d = parse_input_script(prevout_hash, script)
+        self.type = d['type']
+        self.address = d.get('address')
+        self.num_sig = d.get('num_sig')
+        self.sig_count = len(filter(None, d.get('signatures', [])))
+        if self.num_sig and self.sig_count < self.num_sig:
+            # inputs that miss signatures are read to be signed
+            self.fields = dict((k, d[k]) for k in self.script_fields if k in d)
+
+    def is_coinbase(self):
+        return self.type == 'coinbase'
+
+    def read_script_fields(self):
+        d = parse_input_script(self.prevout_hash, self.script)
+        if self.fields is None:
+            self.fields = {}
+        for k in self.script_fields:
+            if k in d and k not in self.fields:
+                self.fields[k] = d[k]
+
+    def count_signatures(self):
+        if self.fields and 'signatures' in self.fields:
+            return len(filter(None, self.fields['signatures']))
+        return self.sig_count
+
+    def keys(self):
+        keys = ['prevout_hash', 'prevout_n', 'sequence', 'scriptSig', 'type']
+        if not self.is_coinbase():
+            keys += ['address', 'num_sig', 'x_pubkeys', 'pubkeys', 'signatures']
+            if self.type in ['p2sh', 'p2wpkh-p2sh']:
+                keys.append('redeemScript')
+        if self.fields:
+            keys += [k for k in self.fields if k not in keys]
+        return keys
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __getitem__(self, key):
+        if self.fields and key in self.fields:
+            return self.fields[key]
+        if key in self.attributes:
+            if key in ['address', 'num_sig'] and self.is_coinbase():
+                raise KeyError(key)
+            return getattr(self, key)
+        if key == 'scriptSig':
+            return self.script.encode('hex')
+        if key in self.script_fields and key in self.keys():
+            self.read_script_fields()
+            return self.fields[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.attributes:
+            setattr(self, key, value)
+            return
+        if key in self.script_fields:
+            # keep the other fields of the script
+            self.read_script_fields()
+        if self.fields is None:
+            self.fields = {}
+        self.fields[key] = value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def update(self, d):
+        for k, v in d.items():
+            self[k] = v
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def as_dict(self):
+        return dict(self.items())
+
+    # classes with __slots__ cannot be pickled with protocols 0 and 1
+    # unless they define their state
+    def __getstate__(self):
+        return [getattr(self, k) for k in self.__slots__]
+
+    def __setstate__(self, state):
+        for k, v in zip(self.__slots__, state):
+            setattr(self, k, v)
+
+    def __eq__(self, other):
+        if isinstance(other, TxInput):
+            other = other.as_dict()
+        return self.as_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+
+def parse_input(s, i):
+    prevout_hash = hash_encode(s[i:i+32])
+    prevout_n, = unpack_uint32(s, i + 32)
+    scriptSig, i = read_string(s, i + 36)
+    sequence, = unpack_uint32(s, i)
+    return TxInput(prevout_hash, prevout_n, scriptSig, sequence), i + 4
+
+def parse_witness(s, i):
+    n, i = read_compact_size(s, i)
+    for k in range(n):
+        x, i = read_string(s, i)
+    return None, i
+
+def parse_output(s, i, n):
     d = {}
-    d['value'] = vds.read_int64()
-    scriptPubKey = vds.read_bytes(vds.read_compact_size())
+    d['value'], = unpack_int64(s, i)
+    scriptPubKey, i = read_string(s, i + 8)
     d['type'], d['address'] = get_address_from_output_script(scriptPubKey)
     d['scriptPubKey'] = scriptPubKey.encode('hex')
-    d['prevout_n'] = i
-    return d
+    d['prevout_n'] = n
+    return d, i
 
 
 def deserialize(raw):
-    vds = BCDataStream()
-    vds.write(raw.decode('hex'))
+    return deserialize_bytes(raw.decode('hex'))
+
+
+def deserialize_bytes(s):
+    try:
+        return _deserialize_bytes(s)
+    except (IndexError, struct.error):
+        raise SerializationError("attempt to read past end of buffer")
+
+
+def _deserialize_bytes(s):
     d = {}
-    start = vds.read_cursor
-    d['version'] = vds.read_int32()
-    n_vin = vds.read_compact_size()
+    d['version'], = unpack_int32(s, 0)
+    n_vin, i = read_compact_size(s, 4)
     is_segwit = (n_vin == 0)
     if is_segwit:
-        marker = vds.read_bytes(1)
+        marker = s[i]
         assert marker == chr(1)
-        n_vin = vds.read_compact_size()
-    d['inputs'] = list(parse_input(vds) for i in xrange(n_vin))
-    n_vout = vds.read_compact_size()
-    d['outputs'] = list(parse_output(vds,i) for i in xrange(n_vout))
+        n_vin, i = read_compact_size(s, i + 1)
+    inputs = []
+    for k in xrange(n_vin):
+        txin, i = parse_input(s, i)
+        inputs.append(txin)
+    d['inputs'] = inputs
+    n_vout, i = read_compact_size(s, i)
+    outputs = []
+    for k in xrange(n_vout):
+        txout, i = parse_output(s, i, k)
+        outputs.append(txout)
+    d['outputs'] = outputs
     if is_segwit:
-        d['witness'] = list(parse_witness(vds) for i in xrange(n_vin))
-    d['lockTime'] = vds.read_uint32()
+        witness = []
+        for k in xrange(n_vin):
+            w, i = parse_witness(s, i)
+            witness.append(w)
+        d['witness'] = witness
+    d['lockTime'], = unpack_uint32(s, i)
     return d
 
 
+# The writers build binary strings.  Hex is only produced by the
+# methods that return it to the caller.
+
+def pack_compact_size(i):
+    if i < 0xfd:
+        return chr(i)
+    elif i <= 0xffff:
+        return '\xfd' + pack_uint16(i)
+    elif i <= 0xffffffff:
+        return '\xfe' + pack_uint32(i)
+    else:
+        return '\xff' + pack_uint64(i)
+
+def pack_string(x):
+    return pack_compact_size(len(x)) + x
+
+def pack_push(x):
+    # same encoding as op_push
+    n = len(x)
+    if n < 0x4c:
+        return chr(n) + x
+    elif n < 0xff:
+        return '\x4c' + chr(n) + x
+    elif n < 0xffff:
+        return '\x4d' + pack_uint16(n) + x
+    else:
+        return '\x4e' + pack_uint32(n) + x
+
+
 # pay & redeem scripts
 
 def push_script(x):
     return op_push(len(x)/2) + x
 
 def get_scriptPubKey(addr):
+    return get_scriptPubKey_bytes(addr).encode('hex')
+
+# address -> scriptPubKey
+_script_cache = LRUCache(bitcoin.ADDRESS_CACHE_SIZE)
+bitcoin.address_caches.append(_script_cache)
+
+def get_scriptPubKey_bytes(addr):
+    script = _script_cache.get(addr)
+    if script is not None:
+        return script
     addrtype, hash_160 = bc_address_to_hash_160(addr)
     if addrtype == bitcoin.ADDRTYPE_P2PKH:
-        script = '76a9'                                      # op_dup, op_hash_160
-        script += push_script(hash_160.encode('hex'))
-        script += '88ac'                                     # op_equalverify, op_checksig
+        script = P2PKH_PREFIX + hash_160 + P2PKH_SUFFIX
     elif addrtype in [bitcoin.ADDRTYPE_P2SH, bitcoin.ADDRTYPE_P2SH_ALT]:
-        script = 'a9'                                        # op_hash_160
-        script += push_script(hash_160.encode('hex'))
-        script += '87'                                       # op_equal
+        script = P2SH_PREFIX + hash_160 + P2SH_SUFFIX
     else:
         raise BaseException('unknown address type')
+    _script_cache.put(addr, script)
     return script
 
 def segwit_script(pubkey):
@@ -495,6 +728,124 @@ def multisig_script(public_keys, m):
 
 
 
+class SighashCache(object):
+    '''The parts of the signature preimages that are shared by all the
+    inputs of a transaction, computed once per transaction.
+
+    For segwit inputs, these are the hashes of BIP143.  Legacy
+    preimages are built from the inputs serialized with an empty
+    script, and from the serialized outputs.'''
+
+    def __init__(self, tx):
+        inputs = tx.inputs()
+        outputs = tx.outputs()
+        self.outpoints = [tx.serialize_outpoint_bytes(txin) for txin in inputs]
+        self.sequences = [pack_uint32(txin.get('sequence', 0xffffffff - 1)) for txin in inputs]
+        outputs_ser = ''.join(tx.serialize_output_bytes(o) for o in outputs)
+        self.outputs = pack_compact_size(len(outputs)) + outputs_ser
+        self.inputs_count = pack_compact_size(len(inputs))
+        # inputs with an empty script, and the offset of each of them
+        self.empty_inputs = ''.join(o + '\x00' + q for o, q in zip(self.outpoints, self.sequences))
+        self.offsets = [0]
+        for o, q in zip(self.outpoints, self.sequences):
+            self.offsets.append(self.offsets[-1] + len(o) + 1 + len(q))
+        self._bip143 = None
+        self._outputs_ser = outputs_ser
+
+    def bip143_hashes(self):
+        '''hashPrevouts, hashSequence, hashOutputs'''
+        if self._bip143 is None:
+            self._bip143 = (Hash(''.join(self.outpoints)),
+                            Hash(''.join(self.sequences)),
+                            Hash(self._outputs_ser))
+        return self._bip143
+
+    def legacy_inputs(self, i, script):
+        '''The serialized inputs, with script in input i.'''
+        e = self.empty_inputs
+        return ''.join((
+            self.inputs_count,
+            e[:self.offsets[i]],
+            self.outpoints[i],
+            pack_string(script),
+            self.sequences[i],
+            e[self.offsets[i+1]:]))
+
+
+class SigningSession(object):
+    '''Signs the inputs of a transaction with a set of private keys.
+
+    Each private key is decoded once per session, and the preimage of
+    each input is hashed once.  Signatures are not verified one by one
+    as they are made: if verify is set, they are all verified at the
+    end, before any of them is added to the transaction.'''
+
+    def __init__(self, tx, keypairs, verify=True):
+        self.tx = tx
+        self.keypairs = keypairs
+        self.verify = verify
+        self.backend = ecc_backend.get_backend()
+        # x_pubkey -> (secret, pubkey)
+        self.keys = {}
+
+    def get_key(self, x_pubkey):
+        key = self.keys.get(x_pubkey)
+        if key is None:
+            b = ASecretToSecret(self.keypairs[x_pubkey])
+            if not b:
+                raise BaseException('Invalid private key')
+            secret = b[0:32]
+            pubkey = self.backend.pubkey_from_secret(secret, len(b) == 33).encode('hex')
+            key = self.keys[x_pubkey] = (secret, pubkey)
+        return key
+
+    def sign(self):
+        self.add_signatures(self.make_signatures())
+
+    def make_signatures(self):
+        '''Return the new signatures, as (input index, slot, pubkey,
+        preimage hash, signature) tuples, without adding them.'''
+        tx = self.tx
+        tx.invalidate_sighash_cache()
+        signed = []
+        for i, txin in enumerate(tx.inputs()):
+            num = txin['num_sig']
+            pubkeys, x_pubkeys = tx.get_sorted_pubkeys(txin)
+            count = len(filter(None, txin['signatures']))
+            pre_hash = None
+            for j, x_pubkey in enumerate(x_pubkeys):
+                if count == num:
+                    # txin is complete
+                    break
+                if x_pubkey in self.keypairs:
+                    print_error("adding signature for", x_pubkey)
+                    secret, pubkey = self.get_key(x_pubkey)
+                    if pre_hash is None:
+                        pre_hash = tx.sighash(i)
+                    sig = self.backend.sign(secret, pre_hash)
+                    signed.append((i, j, pubkey, pre_hash, sig))
+                    if not txin['signatures'][j]:
+                        count += 1
+        if self.verify:
+            for i, j, pubkey, pre_hash, sig in signed:
+                if not self.backend.verify(pubkey.decode('hex'), sig, pre_hash):
+                    raise BaseException('Signature verification failed for input %d' % i)
+        return signed
+
+    def add_signatures(self, signed):
+        tx = self.tx
+        inputs = tx.inputs()
+        for i, j, pubkey, pre_hash, sig in signed:
+            txin = inputs[i]
+            txin['signatures'][j] = sig_string_to_der(sig).encode('hex') + '01'
+            txin['x_pubkeys'][j] = pubkey
+            txin['pubkeys'][j] = pubkey # needed for fd keys
+        tx.invalidate_sighash_cache()
+        tx.raw = tx.serialize()
+        print_error("is_complete", tx.is_complete())
+        return len(signed)
+
+
 class Transaction:
 
     def __str__(self):
@@ -515,10 +866,16 @@ class Transaction:
         self._outputs = None
         self.locktime = 0
         self.version = 1
+        self._sighash_cache = None
+        self._derived = None
+        # scripts and serializations of outputs, see get_output_bytes
+        self._output_bytes = {}
 
     def update(self, raw):
         self.raw = raw
         self._inputs = None
+        self._sighash_cache = None
+        self._derived = None
         self.deserialize()
 
     def inputs(self):
@@ -546,24 +903,27 @@ class Transaction:
     def update_signatures(self, raw):
         """Add new signatures to a transaction"""
         d = deserialize(raw)
+        self.invalidate_sighash_cache()
         for i, txin in enumerate(self.inputs()):
             pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
             sigs1 = txin.get('signatures')
             sigs2 = d['inputs'][i].get('signatures')
+            pre_hash = None
             for sig in sigs2:
                 if sig in sigs1:
                     continue
-                pre_hash = Hash(self.serialize_preimage(i).decode('hex'))
-                # der to string
-                order = ecdsa.ecdsa.generator_secp256k1.order()
-                r, s = ecdsa.util.sigdecode_der(sig.decode('hex')[:-1], order)
-                sig_string = ecdsa.util.sigencode_string(r, s, order)
-                compressed = True
+                if pre_hash is None:
+                    pre_hash = self.sighash(i)
+                sig_string = der_to_sig_string(sig.decode('hex')[:-1])
+                backend = ecc_backend.get_backend()
                 for recid in range(4):
-                    public_key = MyVerifyingKey.from_signature(sig_string, recid, pre_hash, curve = SECP256k1)
-                    pubkey = point_to_ser(public_key.pubkey.point, compressed).encode('hex')
+                    try:
+                        pubkey = backend.recover(sig_string, recid, pre_hash).encode('hex')
+                    except Exception:
+                        continue
                     if pubkey in pubkeys:
-                        public_key.verify_digest(sig_string, pre_hash, sigdecode = ecdsa.util.sigdecode_string)
+                        if not backend.verify(pubkey.decode('hex'), sig_string, pre_hash):
+                            raise Exception("Bad signature")
                         j = pubkeys.index(pubkey)
                         print_error("adding sig", i, j, pubkey, sig)
                         self._inputs[i]['signatures'][j] = sig
@@ -581,6 +941,7 @@ class Transaction:
             return
         d = deserialize(self.raw)
         self._inputs = d['inputs']
+        self._sighash_cache = None
         self._outputs = [(x['type'], x['address'], x['value']) for x in d['outputs']]
         self.locktime = d['lockTime']
         self.version = d['version']
@@ -596,13 +957,16 @@ class Transaction:
 
     @classmethod
     def pay_script(self, output_type, addr):
+        return self.pay_script_bytes(output_type, addr).encode('hex')
+
+    @classmethod
+    def pay_script_bytes(self, output_type, addr):
         if output_type == TYPE_SCRIPT:
-            return addr.encode('hex')
+            return addr
         elif output_type == TYPE_ADDRESS:
-            return get_scriptPubKey(addr)
+            return get_scriptPubKey_bytes(addr)
         else:
             raise TypeError('Unknown output type')
-        return script
 
     @classmethod
     def get_siglist(self, txin, estimate_size=False):
@@ -628,9 +992,13 @@ class Transaction:
 
     @classmethod
     def serialize_witness(self, txin):
-        pubkeys, sig_list = self.get_siglist(txin)
+        return self.serialize_witness_bytes(txin).encode('hex')
+
+    @classmethod
+    def serialize_witness_bytes(self, txin, estimate_size=False):
+        pubkeys, sig_list = self.get_siglist(txin, estimate_size)
         n = len(pubkeys) + len(sig_list)
-        return var_int(n) + ''.join(push_script(x) for x in sig_list) + ''.join(push_script(x) for x in pubkeys)
+        return pack_compact_size(n) + ''.join(pack_push(x.decode('hex')) for x in sig_list) + ''.join(pack_push(x.decode('hex')) for x in pubkeys)
 
     @classmethod
     def is_segwit_input(self, txin):
@@ -678,99 +1046,173 @@ class Transaction:
 
     @classmethod
     def serialize_outpoint(self, txin):
-        return txin['prevout_hash'].decode('hex')[::-1].encode('hex') + int_to_hex(txin['prevout_n'], 4)
+        return self.serialize_outpoint_bytes(txin).encode('hex')
+
+    @classmethod
+    def serialize_outpoint_bytes(self, txin):
+        return hash_decode(txin['prevout_hash']) + pack_uint32(txin['prevout_n'])
 
     @classmethod
     def serialize_input(self, txin, script):
-        # Prev hash and index
-        s = self.serialize_outpoint(txin)
-        # Script length, script, sequence
-        s += var_int(len(script)/2)
-        s += script
-        s += int_to_hex(txin.get('sequence', 0xffffffff - 1), 4)
-        return s
+        return self.serialize_input_bytes(txin, script.decode('hex')).encode('hex')
+
+    @classmethod
+    def serialize_input_bytes(self, txin, script):
+        # Prev hash and index, script length, script, sequence
+        return ''.join((
+            hash_decode(txin['prevout_hash']),
+            pack_uint32(txin['prevout_n']),
+            pack_compact_size(len(script)),
+            script,
+            pack_uint32(txin.get('sequence', 0xffffffff - 1))))
 
     def set_rbf(self, rbf):
         nSequence = 0xffffffff - (2 if rbf else 1)
         for txin in self.inputs():
             txin['sequence'] = nSequence
+        self.raw = None
+        self._sighash_cache = None
+        self._derived = None
 
     def BIP_LI01_sort(self):
         # See https://github.com/kristovatlas/rfc/blob/master/bips/bip-li01.mediawiki
         self._inputs.sort(key = lambda i: (i['prevout_hash'], i['prevout_n']))
-        self._outputs.sort(key = lambda o: (o[2], self.pay_script(o[0], o[1])))
+        self._outputs.sort(key = lambda o: (o[2], self.output_script_bytes(o)))
+        self.raw = None
+        self._sighash_cache = None
+        self._derived = None
 
     def serialize_output(self, output):
-        output_type, addr, amount = output
-        s = int_to_hex(amount, 8)
-        script = self.pay_script(output_type, addr)
-        s += var_int(len(script)/2)
-        s += script
-        return s
+        return self.serialize_output_bytes(output).encode('hex')
+
+    def serialize_output_bytes(self, output):
+        return self.get_output_bytes(output)[1]
+
+    def output_script_bytes(self, output):
+        return self.get_output_bytes(output)[0]
+
+    def get_output_bytes(self, output):
+        '''The script and the serialization of output.  They are found
+        once: transactions with thousands of outputs are serialized
+        again to estimate, sort, sign and send them.'''
+        key = tuple(output)
+        r = self._output_bytes.get(key)
+        if r is None:
+            output_type, addr, amount = output
+            script = self.pay_script_bytes(output_type, addr)
+            r = script, pack_int64(amount) + pack_compact_size(len(script)) + script
+            self._output_bytes[key] = r
+        return r
 
     def serialize_preimage(self, i):
-        nVersion = int_to_hex(self.version, 4)
-        nHashType = int_to_hex(1, 4)
-        nLocktime = int_to_hex(self.locktime, 4)
-        inputs = self.inputs()
-        outputs = self.outputs()
-        txin = inputs[i]
+        return self.serialize_preimage_bytes(i).encode('hex')
+
+    def invalidate_sighash_cache(self):
+        '''Must be called when inputs or outputs are changed in place.'''
+        if self._inputs is not None:
+            # raw no longer matches the parsed transaction
+            self.raw = None
+        self._sighash_cache = None
+        self._derived = None
+
+    def get_sighash_cache(self):
+        if self._sighash_cache is None:
+            self._sighash_cache = SighashCache(self)
+        return self._sighash_cache
+
+    def serialize_preimage_bytes(self, i):
+        nVersion = pack_int32(self.version)
+        nHashType = pack_uint32(1)
+        nLocktime = pack_uint32(self.locktime)
+        cache = self.get_sighash_cache()
+        txin = self.inputs()[i]
+        preimage_script = self.get_preimage_script(txin).decode('hex')
         if self.is_segwit_input(txin):
-            hashPrevouts = Hash(''.join(self.serialize_outpoint(txin) for txin in inputs).decode('hex')).encode('hex')
-            hashSequence = Hash(''.join(int_to_hex(txin.get('sequence', 0xffffffff - 1), 4) for txin in inputs).decode('hex')).encode('hex')
-            hashOutputs = Hash(''.join(self.serialize_output(o) for o in outputs).decode('hex')).encode('hex')
-            outpoint = self.serialize_outpoint(txin)
-            preimage_script = self.get_preimage_script(txin)
-            scriptCode = var_int(len(preimage_script)/2) + preimage_script
-            amount = int_to_hex(txin['value'], 8)
-            nSequence = int_to_hex(txin.get('sequence', 0xffffffff - 1), 4)
+            hashPrevouts, hashSequence, hashOutputs = cache.bip143_hashes()
+            outpoint = cache.outpoints[i]
+            scriptCode = pack_string(preimage_script)
+            amount = pack_int64(txin['value'])
+            nSequence = cache.sequences[i]
             preimage = nVersion + hashPrevouts + hashSequence + outpoint + scriptCode + amount + nSequence + hashOutputs + nLocktime + nHashType
         else:
-            txins = var_int(len(inputs)) + ''.join(self.serialize_input(txin, self.get_preimage_script(txin) if i==k else '') for k, txin in enumerate(inputs))
-            txouts = var_int(len(outputs)) + ''.join(self.serialize_output(o) for o in outputs)
-            preimage = nVersion + txins + txouts + nLocktime + nHashType
+            txins = cache.legacy_inputs(i, preimage_script)
+            preimage = nVersion + txins + cache.outputs + nLocktime + nHashType
         return preimage
 
+    def sighash(self, i):
+        '''Hash signed by input i'''
+        return Hash(self.serialize_preimage_bytes(i))
+
     def is_segwit(self):
         return any(self.is_segwit_input(x) for x in self.inputs())
 
     def serialize(self, estimate_size=False, witness=True):
-        nVersion = int_to_hex(self.version, 4)
-        nLocktime = int_to_hex(self.locktime, 4)
+        return self.serialize_bytes(estimate_size, witness).encode('hex')
+
+    def serialize_bytes(self, estimate_size=False, witness=True):
         inputs = self.inputs()
         outputs = self.outputs()
-        txins = var_int(len(inputs)) + ''.join(self.serialize_input(txin, self.input_script(txin, estimate_size)) for txin in inputs)
-        txouts = var_int(len(outputs)) + ''.join(self.serialize_output(o) for o in outputs)
-        if witness and self.is_segwit():
-            marker = '00'
-            flag = '01'
-            witness = ''.join(self.serialize_witness(x) for x in inputs)
-            return nVersion + marker + flag + txins + txouts + witness + nLocktime
-        else:
-            return nVersion + txins + txouts + nLocktime
+        s = [pack_int32(self.version)]
+        is_segwit = witness and self.is_segwit()
+        if is_segwit:
+            # marker, flag
+            s.append('\x00\x01')
+        s.append(pack_compact_size(len(inputs)))
+        for txin in inputs:
+            s.append(self.serialize_input_bytes(txin, self.input_script(txin, estimate_size).decode('hex')))
+        s.append(pack_compact_size(len(outputs)))
+        for o in outputs:
+            s.append(self.serialize_output_bytes(o))
+        if is_segwit:
+            for txin in inputs:
+                s.append(self.serialize_witness_bytes(txin, estimate_size))
+        s.append(pack_uint32(self.locktime))
+        return ''.join(s)
 
     def hash(self):
         print "warning: deprecated tx.hash()"
         return self.txid()
 
+    def get_derived(self):
+        '''Values derived from the raw transaction.  They are reset with
+        the sighash cache, and when raw is replaced.'''
+        if self._derived is None or self._derived[0] is not self.raw:
+            self._derived = (self.raw, {})
+        return self._derived[1]
+
     def txid(self):
+        if self.raw is None:
+            return self._txid()
+        d = self.get_derived()
+        if 'txid' not in d:
+            d['txid'] = self._txid()
+        return d['txid']
+
+    def _txid(self):
         all_segwit = all(self.is_segwit_input(x) for x in self.inputs())
         if not all_segwit and not self.is_complete():
             return None
-        ser = self.serialize(witness=False)
-        return Hash(ser.decode('hex'))[::-1].encode('hex')
+        if self.raw and self.raw[8:10] != '00':
+            # the raw transaction has no witness: it is what gets hashed
+            ser = self.raw.decode('hex')
+        else:
+            ser = self.serialize_bytes(witness=False)
+        return hash_encode(Hash(ser))
 
     def wtxid(self):
-        ser = self.serialize(witness=True)
-        return Hash(ser.decode('hex'))[::-1].encode('hex')
+        return hash_encode(Hash(self.serialize_bytes(witness=True)))
 
     def add_inputs(self, inputs):
         self._inputs.extend(inputs)
         self.raw = None
+        self._sighash_cache = None
+        self._derived = None
 
     def add_outputs(self, outputs):
         self._outputs.extend(outputs)
         self.raw = None
+        self._sighash_cache = None
+        self._derived = None
 
     def input_value(self):
         return sum(x['value'] for x in self.inputs())
@@ -787,13 +1229,19 @@ class Transaction:
     @profiler
     def estimated_size(self):
         '''Return an estimated tx size in bytes.'''
-        return len(self.serialize(True)) / 2 if not self.is_complete() or self.raw is None else len(self.raw) / 2 # ASCII hex string
+        return len(self.serialize_bytes(True)) if not self.is_complete() or self.raw is None else len(self.raw) / 2 # ASCII hex string
 
     @classmethod
     def estimated_input_size(self, txin):
         '''Return an estimated of serialized input size in bytes.'''
         script = self.input_script(txin, True)
-        return len(self.serialize_input(txin, script)) / 2
+        return len(self.serialize_input_bytes(txin, script.decode('hex')))
+
+    @classmethod
+    def estimated_witness_size(self, txin):
+        '''Return an estimate of the serialized witness of txin in bytes.
+        Transactions only have witnesses if one of their inputs is segwit.'''
+        return len(self.serialize_witness_bytes(txin, True))
 
     def signature_count(self):
         r = 0
@@ -801,8 +1249,10 @@ class Transaction:
         for txin in self.inputs():
             if txin['type'] == 'coinbase':
                 continue
-            signatures = filter(None, txin.get('signatures',[]))
-            s += len(signatures)
+            if isinstance(txin, TxInput):
+                s += txin.count_signatures()
+            else:
+                s += len(filter(None, txin.get('signatures',[])))
             r += txin.get('num_sig',-1)
         return s, r
 
@@ -810,36 +1260,21 @@ class Transaction:
         s, r = self.signature_count()
         return r == s
 
-    def sign(self, keypairs):
-        for i, txin in enumerate(self.inputs()):
-            num = txin['num_sig']
-            pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
-            for j, x_pubkey in enumerate(x_pubkeys):
-                signatures = filter(None, txin['signatures'])
-                if len(signatures) == num:
-                    # txin is complete
-                    break
-                if x_pubkey in keypairs.keys():
-                    print_error("adding signature for", x_pubkey)
-                    sec = keypairs.get(x_pubkey)
-                    pubkey = public_key_from_private_key(sec)
-                    # add signature
-                    pre_hash = Hash(self.serialize_preimage(i).decode('hex'))
-                    pkey = regenerate_key(sec)
-                    secexp = pkey.secret
-                    private_key = bitcoin.MySigningKey.from_secret_exponent(secexp, curve = SECP256k1)
-                    public_key = private_key.get_verifying_key()
-                    sig = private_key.sign_digest_deterministic(pre_hash, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_der)
-                    assert public_key.verify_digest(sig, pre_hash, sigdecode = ecdsa.util.sigdecode_der)
-                    txin['signatures'][j] = sig.encode('hex') + '01'
-                    txin['x_pubkeys'][j] = pubkey
-                    txin['pubkeys'][j] = pubkey # needed for fd keys
-                    self._inputs[i] = txin
-        print_error("is_complete", self.is_complete())
-        self.raw = self.serialize()
+    def sign(self, keypairs, verify=True):
+        '''Sign the inputs we have keys for.  Signatures are checked
+        before they are added, unless verify is False.'''
+        SigningSession(self, keypairs, verify).sign()
 
     def get_outputs(self):
         """convert pubkeys to addresses"""
+        if self.raw is None:
+            return self._get_outputs()
+        d = self.get_derived()
+        if 'outputs' not in d:
+            d['outputs'] = self._get_outputs()
+        return d['outputs']
+
+    def _get_outputs(self):
         o = []
         for type, x, v in self.outputs():
             if type == TYPE_ADDRESS:
@@ -26,7 +26,7 @@
 import os, sys, re, json
 import platform
 import shutil
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from datetime import datetime
 from decimal import Decimal
 import traceback
@@ -41,6 +41,12 @@ fee_levels = [_('Within 25 blocks'), _('Within 10 blocks'), _('Within 5 blocks')
 def normalize_version(v):
     return [int(x) for x in re.sub(r'(\.0+)*$','', v).split(".")]
 
+# status of payment requests
+PR_UNPAID  = 0
+PR_EXPIRED = 1
+PR_UNKNOWN = 2     # sent but not propagated
+PR_PAID    = 3     # send and propagated
+
 class NotEnoughFunds(Exception): pass
 
 class InvalidPassword(Exception):
@@ -55,8 +61,8 @@ class UserCancelled(Exception):
 
 class MyEncoder(json.JSONEncoder):
     def default(self, obj):
-        from transaction import Transaction
-        if isinstance(obj, Transaction):
+        from transaction import Transaction, TxInput
+        if isinstance(obj, (Transaction, TxInput)):
             return obj.as_dict()
         return super(MyEncoder, self).default(obj)
 
@@ -203,6 +209,55 @@ def profiler(func):
     return lambda *args, **kw_args: do_profile(func, args, kw_args)
 
 
+class LRUCache(object):
+    """
+    Mapping of at most size items, that drops the least recently used
+    ones.  Values cannot be None.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def keys(self):
+        with self.lock:
+            return self.items.keys()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is not None:
+                self.items[key] = value
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            self._trim()
+
+    def pop(self, key):
+        with self.lock:
+            return self.items.pop(key, None)
+
+    def resize(self, size):
+        with self.lock:
+            self.size = size
+            self._trim()
+
+    def _trim(self):
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
 def android_ext_dir():
     import jnius
     env = jnius.autoclass('android.os.Environment')
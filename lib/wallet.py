@@ -42,15 +42,17 @@ import copy
 import re
 import stat
 import errno
-from functools import partial
+import gc
+import itertools
 from collections import namedtuple, defaultdict
 
 from i18n import _
-from util import NotEnoughFunds, PrintError, UserCancelled, profiler
+from util import NotEnoughFunds, PrintError, UserCancelled, profiler, LRUCache
 
 from bitcoin import *
 from version import *
-from keystore import load_keystore, Hardware_KeyStore
+from keystore import load_keystore, Hardware_KeyStore, Xpub
+from derivation import derive_branches, sign_transactions
 from storage import multisig_type
 
 import transaction
@@ -77,6 +79,235 @@ TX_STATUS = [
 
 
 
+def copy_txio(d):
+    '''Copy a txi or txo map, {tx_hash: {address: [item, ...]}}.
+    The wallet adds and removes items, but never modifies them, so
+    they are shared with the copy.'''
+    # the copy only allocates containers, which would trigger
+    # many useless collections
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return {k: {addr: l[:] for addr, l in v.iteritems()} for k, v in d.iteritems()}
+    finally:
+        if enabled:
+            gc.enable()
+
+
+# number of raw transactions kept in memory
+TX_CACHE_SIZE = 1000
+
+# number of parsed transactions kept in memory, per wallet
+PARSED_TX_CACHE_SIZE = 100
+
+
+class TxCache(LRUCache):
+    """
+    LRU cache of raw transactions, by txid.  A txid always refers to
+    the same transaction, so one cache is shared by all the wallets of
+    the process, and its size bounds the memory they use for it.  Raw
+    strings are cached rather than Transaction objects, which are
+    mutable and must not be shared between wallets.
+    """
+
+    def __init__(self, size=TX_CACHE_SIZE):
+        LRUCache.__init__(self, size)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tx_hash):
+        tx = LRUCache.get(self, tx_hash)
+        with self.lock:
+            if tx is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return tx
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'size': len(self.items),
+                'capacity': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+# shared by all the wallets of the process
+tx_cache = TxCache()
+
+
+class LazyTransactions(object):
+    """
+    Map of tx_hash -> Transaction, read from the wallet storage on first
+    access.  Only the set of txids is loaded at startup; raw
+    transactions are kept in a bounded LRU cache, by default the one
+    shared by all wallets.  The Transaction objects parsed from them
+    are kept in a smaller LRU cache of the wallet's own, so repeated
+    lookups return the same object.
+    """
+
+    def __init__(self, storage, cache=None, parsed_size=PARSED_TX_CACHE_SIZE):
+        self.storage = storage
+        self.txids = storage.item_keys('transactions')
+        self.cache = tx_cache if cache is None else cache
+        self.parsed = LRUCache(parsed_size)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.txids
+
+    def __len__(self):
+        return len(self.txids)
+
+    def __iter__(self):
+        return iter(list(self.txids))
+
+    def keys(self):
+        return list(self.txids)
+
+    def get(self, tx_hash, default=None):
+        # the cache may hold transactions of other wallets
+        if tx_hash not in self.txids:
+            return default
+        tx = self.parsed.get(tx_hash)
+        if tx is not None:
+            return tx
+        raw = self.cache.get(tx_hash)
+        if raw is None:
+            raw = self.storage.get_item('transactions', tx_hash)
+            if raw is None:
+                return default
+            self.cache.put(tx_hash, raw)
+        tx = Transaction(raw)
+        self.parsed.put(tx_hash, tx)
+        return tx
+
+    def __getitem__(self, tx_hash):
+        tx = self.get(tx_hash)
+        if tx is None:
+            raise KeyError(tx_hash)
+        return tx
+
+    def __setitem__(self, tx_hash, tx):
+        # a txid always refers to the same raw transaction
+        raw = str(tx)
+        if tx_hash not in self.txids:
+            self.storage.put_item('transactions', tx_hash, raw)
+        self.txids.add(tx_hash)
+        self.cache.put(tx_hash, raw)
+        self.parsed.put(tx_hash, tx)
+
+    def pop(self, tx_hash, *default):
+        if tx_hash not in self.txids and default:
+            return default[0]
+        tx = self[tx_hash]
+        self.storage.put_item('transactions', tx_hash, None)
+        self.txids.discard(tx_hash)
+        self.parsed.pop(tx_hash)
+        return tx
+
+
+class AddressChain(object):
+    """
+    Usage state of a sequence of addresses (receiving or change).
+    Keeps the position of each address and of the last used one, so that
+    gap checks do not scan the sequence or its history.
+    """
+
+    def __init__(self, addresses, is_used):
+        self.index = {}
+        self.used = set()
+        self.last_used = -1
+        self.size = 0
+        self.gaps = None
+        self.extend(addresses, is_used)
+
+    def extend(self, addresses, is_used=lambda addr: False):
+        for addr in addresses:
+            self.index[addr] = self.size
+            if is_used(addr):
+                self.used.add(self.size)
+                self.last_used = self.size
+            self.size += 1
+        self.gaps = None
+
+    def set_used(self, addr, used):
+        i = self.index.get(addr)
+        if i is None or (i in self.used) == used:
+            return
+        if used:
+            self.used.add(i)
+            self.last_used = max(self.last_used, i)
+        else:
+            self.used.discard(i)
+            if i == self.last_used:
+                self.last_used = max(self.used) if self.used else -1
+        self.gaps = None
+
+    def num_unused_trailing(self):
+        return self.size - 1 - self.last_used
+
+    def get_gaps(self):
+        # gaps[i] is the number of unused addresses right before address i
+        gaps = self.gaps
+        if gaps is None:
+            gaps = []
+            n = 0
+            for i in range(self.size):
+                gaps.append(n)
+                n = 0 if i in self.used else n + 1
+            self.gaps = gaps
+        return gaps
+
+    def gap_before(self, addr):
+        return self.get_gaps()[self.index[addr]]
+
+    def max_gap(self):
+        # largest run of unused addresses followed by a used one
+        gaps = self.get_gaps()
+        return max([gaps[i] for i in self.used] or [0])
+
+
+class WalletSnapshot(object):
+    """
+    Read-only view of the history and verification state of a wallet.
+    A snapshot is never modified once created, so it can be read
+    without locking; writers bump the wallet generation instead, and
+    a new snapshot is taken on the next read.
+    """
+
+    def __init__(self, generation, local_height, history, verified_tx, unverified_tx):
+        self.generation = generation
+        self.local_height = local_height
+        self.history = history
+        self.verified_tx = verified_tx
+        self.unverified_tx = unverified_tx
+
+    def get_address_history(self, address):
+        return self.history.get(address, [])
+
+    def get_tx_height(self, tx_hash):
+        if tx_hash in self.verified_tx:
+            height, timestamp, pos = self.verified_tx[tx_hash]
+            conf = max(self.local_height - height + 1, 0)
+            return height, conf, timestamp
+        else:
+            height = self.unverified_tx.get(tx_hash, 0)
+            return height, 0, False
+
+    def get_txpos(self, tx_hash):
+        x = self.verified_tx.get(tx_hash)
+        y = self.unverified_tx.get(tx_hash)
+        if x:
+            height, timestamp, pos = x
+            return height, pos
+        elif y > 0:
+            return y, 0
+        else:
+            return 1e12 - y, 0
+
+
 class Abstract_Wallet(PrintError):
     """
     Wallet classes are created to handle various address generation methods.
@@ -97,10 +328,11 @@ class Abstract_Wallet(PrintError):
         # saved fields
         self.use_change            = storage.get('use_change', True)
         self.multiple_change       = storage.get('multiple_change', False)
-        self.labels                = storage.get('labels', {})
+        self.labels                = dict(storage.borrow('labels', {}))
         self.frozen_addresses      = set(storage.get('frozen_addresses',[]))
         self.stored_height         = storage.get('stored_height', 0)       # last known height (for offline mode)
-        self.history               = storage.get('addr_history',{})        # address -> list(txid, height)
+        # history lists are replaced, never modified: a shallow copy is enough
+        self.history               = dict(storage.borrow('addr_history',{}))  # address -> list(txid, height)
 
         self.load_keystore()
         self.load_addresses()
@@ -114,15 +346,28 @@ class Abstract_Wallet(PrintError):
         # height.  Access is not contended so no lock is needed.
         self.unverified_tx = defaultdict(int)
 
-        # Verified transactions.  Each value is a (height, timestamp, block_pos) tuple.  Access with self.lock.
-        self.verified_tx = storage.get('verified_tx3', {})
+        # Verified transactions.  Each value is a (height, timestamp, block_pos) tuple.
+        # Access with self.verification_lock, which also guards unverified_tx.
+        self.verified_tx = dict(storage.borrow('verified_tx3', {}))
 
         # there is a difference between wallet.up_to_date and interface.is_up_to_date()
         # interface.is_up_to_date() returns true when all requests have been answered and processed
         # wallet.up_to_date is true when the wallet is synchronized (stronger requirement)
         self.up_to_date = False
+        # self.lock guards history and up_to_date. Lock order:
+        # addresses_lock -> lock -> transaction_lock; verification_lock
+        # is never held while taking another lock.
         self.lock = threading.Lock()
         self.transaction_lock = threading.Lock()
+        self.verification_lock = threading.Lock()
+        # serializes address generation, so that it does not block
+        # readers of the history. Taken before self.lock, never after.
+        self.addresses_lock = threading.RLock()
+        # writers of history and verification state take a new
+        # generation; see get_snapshot
+        self.generations = itertools.count(1)
+        self.generation = 0
+        self.snapshot = None
 
         self.check_history()
 
@@ -146,31 +391,27 @@ class Abstract_Wallet(PrintError):
 
     @profiler
     def load_transactions(self):
-        self.txi = self.storage.get('txi', {})
-        self.txo = self.storage.get('txo', {})
-        self.tx_fees = self.storage.get('tx_fees', {})
-        self.pruned_txo = self.storage.get('pruned_txo', {})
-        tx_list = self.storage.get('transactions', {})
-        self.transactions = {}
-        for tx_hash, raw in tx_list.items():
-            tx = Transaction(raw)
-            self.transactions[tx_hash] = tx
-            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in self.pruned_txo.values()):
+        self.txi = copy_txio(self.storage.borrow('txi', {}))
+        self.txo = copy_txio(self.storage.borrow('txo', {}))
+        self.tx_fees = dict(self.storage.borrow('tx_fees', {}))
+        self.pruned_txo = dict(self.storage.borrow('pruned_txo', {}))
+        self.transactions = LazyTransactions(self.storage)
+        pruned = set(self.pruned_txo.values())
+        for tx_hash in self.transactions.keys():
+            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in pruned):
                 self.print_error("removing unreferenced tx", tx_hash)
                 self.transactions.pop(tx_hash)
 
     @profiler
     def save_transactions(self, write=False):
         with self.transaction_lock:
-            tx = {}
-            for k,v in self.transactions.items():
-                tx[k] = str(v)
-            self.storage.put('transactions', tx)
-            self.storage.put('txi', self.txi)
-            self.storage.put('txo', self.txo)
-            self.storage.put('tx_fees', self.tx_fees)
-            self.storage.put('pruned_txo', self.pruned_txo)
-            self.storage.put('addr_history', self.history)
+            # raw transactions are saved by self.transactions
+            # the storage takes ownership of these copies
+            self.storage.move('txi', copy_txio(self.txi))
+            self.storage.move('txo', copy_txio(self.txo))
+            self.storage.move('tx_fees', dict(self.tx_fees))
+            self.storage.move('pruned_txo', dict(self.pruned_txo))
+            self.storage.move('addr_history', dict(self.history))
             if write:
                 self.storage.write()
 
@@ -184,6 +425,7 @@ class Abstract_Wallet(PrintError):
         with self.lock:
             self.history = {}
             self.tx_addr_hist = {}
+            self.invalidate_snapshot()
 
     @profiler
     def build_reverse_history(self):
@@ -200,6 +442,7 @@ class Abstract_Wallet(PrintError):
         for addr, hist in self.history.items():
             if not self.is_mine(addr):
                 self.history.pop(addr)
+                self.invalidate_snapshot()
                 save = True
                 continue
 
@@ -217,13 +460,13 @@ class Abstract_Wallet(PrintError):
         return os.path.basename(self.storage.path)
 
     def save_addresses(self):
-        self.storage.put('addresses', {'receiving':self.receiving_addresses, 'change':self.change_addresses})
+        self.storage.move('addresses', {'receiving':list(self.receiving_addresses), 'change':list(self.change_addresses)})
 
     def load_addresses(self):
-        d = self.storage.get('addresses', {})
+        d = self.storage.borrow('addresses', {})
         if type(d) != dict: d={}
-        self.receiving_addresses = d.get('receiving', [])
-        self.change_addresses = d.get('change', [])
+        self.receiving_addresses = list(d.get('receiving', []))
+        self.change_addresses = list(d.get('change', []))
 
     def synchronize(self):
         pass
@@ -232,7 +475,9 @@ class Abstract_Wallet(PrintError):
         with self.lock:
             self.up_to_date = up_to_date
         if up_to_date:
-            self.save_transactions(write=True)
+            # called from the network thread: copy and save the maps
+            # on the writer thread
+            self.storage.write_later(self.save_transactions)
 
     def is_up_to_date(self):
         with self.lock: return self.up_to_date
@@ -252,7 +497,7 @@ class Abstract_Wallet(PrintError):
 
         if changed:
             run_hook('set_label', self, name, text)
-            self.storage.put('labels', self.labels)
+            self.storage.move('labels', dict(self.labels))
 
         return changed
 
@@ -295,19 +540,22 @@ class Abstract_Wallet(PrintError):
         return self.get_pubkeys(*sequence)
 
     def add_unverified_tx(self, tx_hash, tx_height):
-        if tx_height == 0 and tx_hash in self.verified_tx:
-            self.verified_tx.pop(tx_hash)
-            self.verifier.merkle_roots.pop(tx_hash, None)
+        with self.verification_lock:
+            if tx_height == 0 and tx_hash in self.verified_tx:
+                self.verified_tx.pop(tx_hash)
+                self.verifier.merkle_roots.pop(tx_hash, None)
 
-        # tx will be verified only if height > 0
-        if tx_hash not in self.verified_tx:
-            self.unverified_tx[tx_hash] = tx_height
+            # tx will be verified only if height > 0
+            if tx_hash not in self.verified_tx and self.unverified_tx.get(tx_hash) != tx_height:
+                self.unverified_tx[tx_hash] = tx_height
+                self.invalidate_snapshot()
 
     def add_verified_tx(self, tx_hash, info):
         # Remove from the unverified map and add to the verified map and
-        self.unverified_tx.pop(tx_hash, None)
-        with self.lock:
+        with self.verification_lock:
+            self.unverified_tx.pop(tx_hash, None)
             self.verified_tx[tx_hash] = info  # (tx_height, timestamp, pos)
+            self.invalidate_snapshot()
         height, conf, timestamp = self.get_tx_height(tx_hash)
         self.network.trigger_callback('verified', tx_hash, height, conf, timestamp)
 
@@ -318,7 +566,7 @@ class Abstract_Wallet(PrintError):
     def undo_verifications(self, blockchain, height):
         '''Used by the verifier when a reorg has happened'''
         txs = set()
-        with self.lock:
+        with self.verification_lock:
             for tx_hash, item in self.verified_tx.items():
                 tx_height, timestamp, pos = item
                 if tx_height >= height:
@@ -327,6 +575,8 @@ class Abstract_Wallet(PrintError):
                     if not header or header.get('timestamp') != timestamp:
                         self.verified_tx.pop(tx_hash, None)
                         txs.add(tx_hash)
+            if txs:
+                self.invalidate_snapshot()
         return txs
 
     def get_local_height(self):
@@ -335,7 +585,7 @@ class Abstract_Wallet(PrintError):
 
     def get_tx_height(self, tx_hash):
         """ return the height and timestamp of a verified transaction. """
-        with self.lock:
+        with self.verification_lock:
             if tx_hash in self.verified_tx:
                 height, timestamp, pos = self.verified_tx[tx_hash]
                 conf = max(self.get_local_height() - height + 1, 0)
@@ -346,7 +596,7 @@ class Abstract_Wallet(PrintError):
 
     def get_txpos(self, tx_hash):
         "return position, even if the tx is unverified"
-        with self.lock:
+        with self.verification_lock:
             x = self.verified_tx.get(tx_hash)
             y = self.unverified_tx.get(tx_hash)
             if x:
@@ -442,7 +692,7 @@ class Abstract_Wallet(PrintError):
         height = conf = timestamp = None
         tx_hash = tx.txid()
         if tx.is_complete():
-            if tx_hash in self.transactions.keys():
+            if tx_hash in self.transactions:
                 label = self.get_label(tx_hash)
                 height, conf, timestamp = self.get_tx_height(tx_hash)
                 if height > 0:
@@ -684,6 +934,9 @@ class Abstract_Wallet(PrintError):
                     if not self.tx_addr_hist[tx_hash]:
                         self.remove_transaction(tx_hash)
             self.history[addr] = hist
+            self.invalidate_snapshot()
+        # takes addresses_lock, which must not be taken under self.lock
+        self.on_address_history(addr)
 
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
@@ -693,22 +946,51 @@ class Abstract_Wallet(PrintError):
             s.add(addr)
             self.tx_addr_hist[tx_hash] = s
             # if addr is new, we have to recompute txi and txo
-            tx = self.transactions.get(tx_hash)
-            if tx is not None and self.txi.get(tx_hash, {}).get(addr) is None and self.txo.get(tx_hash, {}).get(addr) is None:
-                self.add_transaction(tx_hash, tx)
+            if tx_hash in self.transactions and self.txi.get(tx_hash, {}).get(addr) is None and self.txo.get(tx_hash, {}).get(addr) is None:
+                self.add_transaction(tx_hash, self.transactions[tx_hash])
 
         # Store fees
         self.tx_fees.update(tx_fees)
 
+    def on_address_history(self, addr):
+        pass
+
+    def invalidate_snapshot(self):
+        # next() on a count is atomic, whichever lock the writer holds
+        self.generation = next(self.generations)
+
+    def get_snapshot(self):
+        '''Return a WalletSnapshot of history and verification state.
+        It is shared until the next write, and may be read without
+        holding any wallet lock.'''
+        local_height = self.get_local_height()
+        snapshot = self.snapshot
+        if snapshot and snapshot.generation == self.generation and snapshot.local_height == local_height:
+            return snapshot
+        # read the generation before copying: a concurrent write makes
+        # this snapshot stale rather than silently incomplete
+        generation = self.generation
+        # history lists are replaced, never modified in place, so a
+        # shallow copy is enough
+        with self.lock:
+            history = dict(self.history)
+        with self.verification_lock:
+            verified_tx = dict(self.verified_tx)
+            unverified_tx = dict(self.unverified_tx)
+        snapshot = WalletSnapshot(generation, local_height, history, verified_tx, unverified_tx)
+        self.snapshot = snapshot
+        return snapshot
+
     def get_history(self, domain=None):
         # get domain
         if domain is None:
             domain = self.get_addresses()
+        snapshot = self.get_snapshot()
         # 1. Get the history of each address in the domain, maintain the
         #    delta of a tx as the sum of its deltas on domain addresses
         tx_deltas = defaultdict(int)
         for addr in domain:
-            h = self.get_address_history(addr)
+            h = snapshot.get_address_history(addr)
             for tx_hash, height in h:
                 delta = self.get_tx_delta(tx_hash, addr)
                 if delta is None or tx_deltas[tx_hash] is None:
@@ -720,9 +1002,9 @@ class Abstract_Wallet(PrintError):
         history = []
         for tx_hash in tx_deltas:
             delta = tx_deltas[tx_hash]
-            height, conf, timestamp = self.get_tx_height(tx_hash)
+            height, conf, timestamp = snapshot.get_tx_height(tx_hash)
             history.append((tx_hash, height, conf, timestamp, delta))
-        history.sort(key = lambda x: self.get_txpos(x[0]))
+        history.sort(key = lambda x: snapshot.get_txpos(x[0]))
         history.reverse()
 
         # 3. add balance
@@ -842,7 +1124,10 @@ class Abstract_Wallet(PrintError):
 
         # Fee estimator
         if fixed_fee is None:
-            fee_estimator = partial(self.estimate_fee, config, outputs=outputs)
+            # the dust outputs are counted once, not for each set of
+            # coins the coin chooser tries
+            dust_fee = self.dust_fee(outputs)
+            fee_estimator = lambda size: self.estimate_fee(config, size) + dust_fee
         else:
             fee_estimator = lambda size: fixed_fee
 
@@ -871,11 +1156,12 @@ class Abstract_Wallet(PrintError):
         return tx
 
     def estimate_fee(self, config, size, outputs=[]):
-        fee = int(config.fee_per_kb() * (1 + size / 1000))
-        for _, _, value in outputs:
-            if value > 0 and value < DUST_SOFT_LIMIT:
-                fee += DUST_SOFT_LIMIT
-        return fee
+        return int(config.fee_per_kb() * (1 + size / 1000)) + self.dust_fee(outputs)
+
+    def dust_fee(self, outputs):
+        '''Extra fee paid for the outputs below the dust limit.'''
+        n = len([value for _, _, value in outputs if value > 0 and value < DUST_SOFT_LIMIT])
+        return n * DUST_SOFT_LIMIT
 
     def mktx(self, outputs, password, config, fee=None, change_addr=None, domain=None):
         coins = self.get_spendable_coins(domain, config)
@@ -949,7 +1235,7 @@ class Abstract_Wallet(PrintError):
                 self.add_unverified_tx(tx_hash, tx_height)
 
         # if we are on a pruning server, remove unverified transactions
-        with self.lock:
+        with self.verification_lock:
             vr = self.verified_tx.keys() + self.unverified_tx.keys()
         for tx_hash in self.transactions.keys():
             if tx_hash not in vr:
@@ -968,6 +1254,7 @@ class Abstract_Wallet(PrintError):
             self.synchronizer = None
 
     def stop_threads(self):
+        self.storage.flush()
         if self.network:
             self.network.remove_jobs([self.synchronizer, self.verifier])
             self.synchronizer.release()
@@ -977,8 +1264,10 @@ class Abstract_Wallet(PrintError):
             # remain so they will be GC-ed
             self.storage.put('stored_height', self.get_local_height())
         self.save_transactions()
-        self.storage.put('verified_tx3', self.verified_tx)
+        with self.verification_lock:
+            self.storage.move('verified_tx3', dict(self.verified_tx))
         self.storage.write()
+        self.storage.compact()
 
     def wait_until_synchronized(self, callback=None):
         def wait_for_wallet():
@@ -1146,6 +1435,25 @@ class Abstract_Wallet(PrintError):
             except UserCancelled:
                 continue
 
+    def sign_transactions(self, txs, password):
+        '''Sign a list of transactions.  Software keystores check the
+        password once, and derive each private key once for the whole
+        list.  Transactions are signed over the process pool.'''
+        if self.is_watching_only():
+            return
+        keystores = self.get_keystores()
+        if any(isinstance(k, Hardware_KeyStore) for k in keystores):
+            for tx in txs:
+                self.sign_transaction(tx, password)
+            return
+        keypairs = [{} for tx in txs]
+        for k in keystores:
+            if not any(k.can_sign(tx) for tx in txs):
+                continue
+            for d, kp in zip(keypairs, k.get_tx_keypairs(txs, password)):
+                d.update(kp)
+        sign_transactions([(tx, d) for tx, d in zip(txs, keypairs) if d])
+
     def get_unused_addresses(self):
         # fixme: use slots from expired requests
         domain = self.get_receiving_addresses()
@@ -1334,8 +1642,10 @@ class Abstract_Wallet(PrintError):
         return False
 
     def add_address(self, address):
-        if address not in self.history:
-            self.history[address] = []
+        with self.lock:
+            if address not in self.history:
+                self.history[address] = []
+                self.invalidate_snapshot()
         if self.synchronizer:
             self.synchronizer.add(address)
 
@@ -1454,6 +1764,27 @@ class Deterministic_Wallet(Abstract_Wallet):
     def add_seed(self, seed, pw):
         self.keystore.add_seed(seed, pw)
 
+    def load_addresses(self):
+        Abstract_Wallet.load_addresses(self)
+        self.load_address_chains()
+
+    def load_address_chains(self):
+        is_used = lambda addr: bool(self.history.get(addr))
+        self.address_chains = {
+            False: AddressChain(self.receiving_addresses, is_used),
+            True: AddressChain(self.change_addresses, is_used),
+        }
+
+    def on_address_history(self, addr):
+        used = bool(self.history.get(addr))
+        with self.addresses_lock:
+            for chain in self.address_chains.values():
+                chain.set_used(addr, used)
+
+    def clear_history(self):
+        Abstract_Wallet.clear_history(self)
+        self.load_address_chains()
+
     def change_gap_limit(self, value):
         '''This method is not called in the code, it is kept for console use'''
         if value >= self.gap_limit:
@@ -1461,10 +1792,10 @@ class Deterministic_Wallet(Abstract_Wallet):
             self.storage.put('gap_limit', self.gap_limit)
             return True
         elif value >= self.min_acceptable_gap():
-            addresses = self.get_receiving_addresses()
-            k = self.num_unused_trailing_addresses(addresses)
-            n = len(addresses) - k + value
+            k = self.address_chains[False].num_unused_trailing()
+            n = len(self.receiving_addresses) - k + value
             self.receiving_addresses = self.receiving_addresses[0:n]
+            self.load_address_chains()
             self.gap_limit = value
             self.storage.put('gap_limit', self.gap_limit)
             self.save_addresses()
@@ -1481,43 +1812,46 @@ class Deterministic_Wallet(Abstract_Wallet):
 
     def min_acceptable_gap(self):
         # fixme: this assumes wallet is synchronized
-        n = 0
-        nmax = 0
-        addresses = self.get_receiving_addresses()
-        k = self.num_unused_trailing_addresses(addresses)
-        for a in addresses[0:-k]:
-            if self.history.get(a):
-                n = 0
-            else:
-                n += 1
-                if n > nmax: nmax = n
-        return nmax + 1
+        return self.address_chains[False].max_gap() + 1
 
     def create_new_address(self, for_change=False):
+        return self.create_new_addresses(for_change, 1)[0]
+
+    def create_new_addresses(self, for_change, count):
         assert type(for_change) is bool
-        addr_list = self.change_addresses if for_change else self.receiving_addresses
-        n = len(addr_list)
-        x = self.derive_pubkeys(for_change, n)
-        address = self.pubkeys_to_address(x)
-        addr_list.append(address)
-        self.save_addresses()
-        self.add_address(address)
-        return address
+        with self.addresses_lock:
+            addr_list = self.change_addresses if for_change else self.receiving_addresses
+            n = len(addr_list)
+            pubkeys = self.derive_pubkeys_batch(for_change, range(n, n + count))
+            addresses = map(self.pubkeys_to_address, pubkeys)
+            addr_list.extend(addresses)
+            self.address_chains[for_change].extend(addresses)
+            self.save_addresses()
+        for address in addresses:
+            self.add_address(address)
+        return addresses
 
     def synchronize_sequence(self, for_change):
         limit = self.gap_limit_for_change if for_change else self.gap_limit
+        chain = self.address_chains[for_change]
         while True:
             addresses = self.get_change_addresses() if for_change else self.get_receiving_addresses()
             if len(addresses) < limit:
-                self.create_new_address(for_change)
+                self.create_new_addresses(for_change, limit - len(addresses))
                 continue
-            if map(lambda a: self.address_is_old(a), addresses[-limit:] ) == limit*[False]:
-                break
+            # addresses after the last used one have no history, so
+            # only the window up to it can contain old addresses.
+            # new addresses are never old: one batch restores the gap
+            start = len(addresses) - limit
+            for i in range(min(chain.last_used, len(addresses) - 1), start - 1, -1):
+                if self.address_is_old(addresses[i]):
+                    self.create_new_addresses(for_change, i - start + 1)
+                    break
             else:
-                self.create_new_address(for_change)
+                break
 
     def synchronize(self):
-        with self.lock:
+        with self.addresses_lock:
             if self.is_deterministic():
                 self.synchronize_sequence(False)
                 self.synchronize_sequence(True)
@@ -1525,22 +1859,14 @@ class Deterministic_Wallet(Abstract_Wallet):
                 if len(self.receiving_addresses) != len(self.keystore.keypairs):
                     pubkeys = self.keystore.keypairs.keys()
                     self.receiving_addresses = map(self.pubkeys_to_address, pubkeys)
+                    self.load_address_chains()
                     self.save_addresses()
                     for addr in self.receiving_addresses:
                         self.add_address(addr)
 
     def is_beyond_limit(self, address, is_change):
-        addr_list = self.get_change_addresses() if is_change else self.get_receiving_addresses()
-        i = addr_list.index(address)
-        prev_addresses = addr_list[:max(0, i)]
         limit = self.gap_limit_for_change if is_change else self.gap_limit
-        if len(prev_addresses) < limit:
-            return False
-        prev_addresses = prev_addresses[max(0, i - limit):]
-        for addr in prev_addresses:
-            if self.history.get(addr):
-                return False
-        return True
+        return self.address_chains[is_change].gap_before(address) >= limit
 
     def get_master_public_keys(self):
         return [self.get_master_public_key()]
@@ -1597,6 +1923,9 @@ class Simple_Deterministic_Wallet(Deterministic_Wallet, Simple_Wallet):
     def derive_pubkeys(self, c, i):
         return self.keystore.derive_pubkey(c, i)
 
+    def derive_pubkeys_batch(self, c, sequence):
+        return self.keystore.derive_pubkey_batch(c, sequence)
+
     def get_keystore(self):
         return self.keystore
 
@@ -1631,6 +1960,7 @@ class Simple_Deterministic_Wallet(Deterministic_Wallet, Simple_Wallet):
         self.keystore.delete_imported_key(pubkey)
         self.save_keystore()
         self.receiving_addresses.remove(address)
+        self.load_address_chains()
         self.save_addresses()
         self.storage.write()
 
@@ -1642,6 +1972,7 @@ class Simple_Deterministic_Wallet(Deterministic_Wallet, Simple_Wallet):
         self.save_keystore()
         addr = self.pubkeys_to_address(pubkey)
         self.receiving_addresses.append(addr)
+        self.address_chains[False].extend([addr])
         self.save_addresses()
         self.storage.write()
         self.add_address(addr)
@@ -1701,6 +2032,16 @@ class Multisig_Wallet(Deterministic_Wallet, P2SH):
     def derive_pubkeys(self, c, i):
         return [k.derive_pubkey(c, i) for k in self.get_keystores()]
 
+    def derive_pubkeys_batch(self, c, sequence):
+        keystores = self.get_keystores()
+        if all(isinstance(k, Xpub) for k in keystores):
+            # derive all cosigner branches on the same worker pool
+            keys = [k.get_branch_key(c) for k in keystores]
+            columns = derive_branches(keys, sequence)
+        else:
+            columns = [k.derive_pubkey_batch(c, sequence) for k in keystores]
+        return map(list, zip(*columns))
+
     def load_keystore(self):
         self.keystores = {}
         for i in range(self.n):
@@ -434,7 +434,7 @@ class DigitalBitbox_KeyStore(Hardware_KeyStore):
                     if x_pubkey in derivations:
                         index = derivations.get(x_pubkey)
                         inputPath = "%s/%d/%d" % (self.get_derivation(), index[0], index[1])
-                        inputHash = Hash(tx.serialize_preimage(i).decode('hex'))
+                        inputHash = tx.sighash(i)
                         hasharray_i = {'hash': inputHash.encode('hex'), 'keypath': inputPath}
                         hasharray.append(hasharray_i)
                         inputhasharray.append(inputHash)
@@ -37,6 +37,7 @@ setup(
     version=version.ELECTRUM_VERSION,
     install_requires=[
         'pyaes',
+        'pycryptodomex',
         'ecdsa>=0.9',
         'pbkdf2',
         'requests',